@@ -2,13 +2,48 @@
 automatically.
 """
 
-from .psftp import psftp, ExceptionPsftpLocal, ExceptionPsftpInteraction
+from .psftp import psftp, PsftpBatch, PsftpEntry, PsftpPipeline, PsftpResult
+from .psftp import PsftpProgress, PsftpTransferStats
+from .psftp import ExceptionPsftpLocal, ExceptionPsftpInteraction
+from .pool import PsftpPool
+from .scheduler import PsftpScheduler, PsftpSchedulerStats
+from .aio import AsyncPsftp
+from .multiplex import PsftpMaster, masters
+from .tuning import autotune, cached_tuning
+from .journal import PsftpJournal
+from .metrics import PsftpMetrics
+from .fanout import fanout, PsftpHostResult
+from .sftpv3 import PsftpV3, SFTPv3Client, RemoteFile, PsftpBlockCache
+from .sftpv3 import ExceptionPsftpStatus
 
 __version__ = '0.0.2'
 __revision__ = ''
 __all__ = [
     'psftp',
+    'PsftpBatch',
+    'PsftpEntry',
+    'PsftpPipeline',
+    'PsftpProgress',
+    'PsftpResult',
+    'PsftpTransferStats',
+    'PsftpPool',
+    'PsftpScheduler',
+    'PsftpSchedulerStats',
+    'AsyncPsftp',
+    'PsftpMaster',
+    'masters',
+    'autotune',
+    'PsftpJournal',
+    'PsftpMetrics',
+    'fanout',
+    'PsftpHostResult',
+    'cached_tuning',
+    'PsftpV3',
+    'SFTPv3Client',
+    'RemoteFile',
+    'PsftpBlockCache',
     'ExceptionPsftpLocal',
     'ExceptionPsftpInteraction',
+    'ExceptionPsftpStatus',
     '__version__',
     '__revision__']
@@ -0,0 +1,401 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import os
+import posixpath
+import shutil
+import tempfile
+import time
+
+from pexpect import TIMEOUT, EOF
+
+from .psftp import psftp, PsftpProgress, ExceptionPsftpLocal, \
+    ExceptionPsftpInteraction
+
+
+__all__ = ['AsyncPsftp']
+
+
+class AsyncPsftp(psftp):
+    """A psftp whose login, logout and commands are coroutines, waiting for
+    the sftp child with pexpect's asyncio support instead of blocking. Many
+    sessions can run concurrently in one event loop::
+
+        import asyncio
+        import psftp
+
+        async def upload(hostname):
+            s = psftp.AsyncPsftp()
+            await s.login(hostname, username, password)
+            await s.put('./hello.txt')
+            print(await s.ls())
+            await s.logout()
+
+        asyncio.get_event_loop().run_until_complete(asyncio.gather(
+            *[upload(h) for h in hostnames]))
+
+    The commands without output return what :meth:`_exec` returns, which is
+    a coroutine here. :meth:`batch`, :meth:`pipeline`, :meth:`sync`,
+    :meth:`get_many`, :meth:`put_many` and :meth:`copy_tree` are not
+    available, they chain several commands synchronously, nor are
+    :meth:`iter_ls` and :meth:`walk`.
+    :meth:`open_remote` takes absolute paths and its reads block.
+    """
+
+    async def login(
+            self,
+            server,
+            username,
+            password='',
+            terminal_type='ansi',
+            login_timeout=10,
+            port=None,
+            ssh_key=None,
+            quiet=True,
+            check_local_ip=True,
+            buffer_size=None,
+            num_requests=None,
+            compression=False,
+            bandwidth_limit=None,
+            cipher=None):
+        '''This logs the user into the given server, see :meth:`psftp.login`.
+        '''
+        self._login_spawn(server, username, password, port, ssh_key, quiet,
+                          check_local_ip, dict(
+                              buffer_size=buffer_size,
+                              num_requests=num_requests,
+                              compression=compression,
+                              bandwidth_limit=bandwidth_limit,
+                              cipher=cipher))
+        await self._login_wait(password, terminal_type, login_timeout)
+
+        return True
+
+    async def connect(self, command, password='', login_timeout=10):
+        '''Start sftp on a local sftp server, see :meth:`psftp.connect`.
+        '''
+        self._connect_spawn(command, password)
+        await self._login_wait(password, 'ansi', login_timeout)
+
+        return True
+
+    async def _login_wait(self, password, terminal_type, login_timeout):
+        phase_expect = self._login_expect()
+        patterns = self._expect_patterns(phase_expect)
+        expected = [False] * len(phase_expect)
+        started = time.time()
+        deadline = started + login_timeout
+        while True:
+            i = await self.expect_list(
+                patterns, timeout=self._login_wait_timeout(expected, deadline),
+                async_=True)
+            started = self._login_timing(self.LOGIN_PHASES[i], started)
+            if self._login_phase(i, expected, password, terminal_type):
+                break
+
+    async def logout(self):
+        '''Sends exit to the remote shell.
+        '''
+        self.sendline("exit")
+        await self.expect(EOF, async_=True)
+        self.close()
+
+    async def prompt(self, timeout=-1):
+        '''Match the next shell prompt.
+
+        :return: True if the shell prompt was matched, False if the timeout was
+                 reached.
+        '''
+        if timeout == -1:
+            timeout = self.timeout
+        i = await self.expect_list(
+            self._expect_patterns([self.PROMPT, TIMEOUT]),
+            timeout=timeout, async_=True)
+        if i == 1:
+            return False
+        return True
+
+    def batch(self, ignore_errors=True, timeout=None):
+        raise ExceptionPsftpLocal('batch is not supported by AsyncPsftp')
+
+    def pipeline(self, depth=16):
+        raise ExceptionPsftpLocal('pipeline is not supported by AsyncPsftp')
+
+    def sync(self, local_dir, remote_dir, direction='put', delete=False,
+             dry_run=False):
+        raise ExceptionPsftpLocal('sync is not supported by AsyncPsftp')
+
+    def iter_ls(self, path='', options='', entries=False):
+        raise ExceptionPsftpLocal('iter_ls is not supported by AsyncPsftp')
+
+    def walk(self, top='.', onerror=None):
+        raise ExceptionPsftpLocal('walk is not supported by AsyncPsftp')
+
+    def copy_tree(self, src, dst):
+        raise ExceptionPsftpLocal('copy_tree is not supported by AsyncPsftp')
+
+    def get_many(self, remote_paths, local_dir='', options=''):
+        raise ExceptionPsftpLocal('get_many is not supported by AsyncPsftp')
+
+    def put_many(self, local_paths, remote_dir='', options=''):
+        raise ExceptionPsftpLocal('put_many is not supported by AsyncPsftp')
+
+    def _journaled(self, op, source, target, options, run):
+        # run returns a coroutine, the outcome is only known once awaited.
+        if self.journal is not None:
+            raise ExceptionPsftpLocal('journal is not supported by AsyncPsftp')
+        return run()
+
+    def _stream_path(self, path):
+        # The remote working directory is only known to a coroutine.
+        path = self._unquote(path)
+        if not path.startswith('/'):
+            raise ExceptionPsftpLocal(
+                'AsyncPsftp opens absolute remote paths only')
+        return path
+
+    async def cd(self, path):
+        """Change remote directory to path.
+        """
+        self._invalidate_relative()
+        await self._exec('cd %s' % path, [psftp._exception_no_such_file])
+        self._chdir('cd', path)
+
+    async def lcd(self, path):
+        """Change local directory to path
+        """
+        if self.local_in_process:
+            return self._lcd_in_process(path)
+        await self._exec('lcd %s' % path, [
+            psftp._exception_permission_deined,
+            psftp._exception_not_directory,
+            psftp._exception_no_such_file])
+        self._chdir('lcd', path)
+
+    async def copy(self, src, dst):
+        '''Copy the remote file src to dst, see :meth:`psftp.copy`.
+        '''
+        self._invalidate(dst)
+        if self._server_copy is not False:
+            try:
+                await self._exec('cp %s %s' % (src, dst), [
+                    psftp._exception_copy_unsupported,
+                    psftp._exception_invalid_command,
+                    psftp._exception_permission_deined,
+                    psftp._exception_copy_no_such_file,
+                    psftp._exception_non_regular_copy,
+                    psftp._exception_copy_failure])
+                self._server_copy = True
+                return 'server'
+            except ExceptionPsftpInteraction as e:
+                if e not in (psftp._exception_copy_unsupported,
+                             psftp._exception_invalid_command):
+                    raise
+                self._server_copy = False
+        workdir = tempfile.mkdtemp(prefix='psftp-copy-')
+        try:
+            local = self._quote(os.path.join(
+                workdir, posixpath.basename(self._unquote(src))))
+            await self._transfer('get %s %s %s' % ('', src, local), None, [
+                psftp._exception_permission_deined,
+                psftp._exception_file_no_found,
+                psftp._exception_non_regular_file])
+            await self._transfer('put %s %s %s' % ('', local, dst), None, [
+                psftp._exception_permission_deined,
+                psftp._exception_non_regular_file])
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        return 'local'
+
+    async def df(self, path='', options=''):
+        """Display usage information for the filesystem holding the current
+        directory, see :meth:`psftp.df`.
+        """
+        base_options = 'hi'
+        valid_options = self._options(base_options, options)
+        cmd = 'df %s' % valid_options
+        await self._exec(cmd)
+        return self._df_output()
+
+    async def help(self):
+        """Display help text.
+        """
+        await self._exec('help')
+        return self._output(self.before, 'help\r\n')
+
+    async def ls(self, path='', options='', entries=False):
+        """Display a remote directory listing, see :meth:`psftp.ls`.
+        """
+        cmd = self._ls_command(path, options, entries)
+        key = (path, cmd, entries)
+        cached = self._cached_listing(key)
+        if cached is not None:
+            return cached
+        await self._exec(cmd, [psftp._exception_ls_not_found])
+        lines = self._ls_output(cmd, entries)
+        self._cache_listing(key, lines)
+        return lines
+
+    async def lmkdir(self, path):
+        """Create local directory specified by path.
+        """
+        if self.local_in_process:
+            return self._lmkdir_in_process(path)
+        await self._exec('lmkdir %s' % path, [
+            psftp._exception_permission_deined,
+            psftp._exception_file_exists])
+
+    async def lpwd(self):
+        """Get local working directory.
+        """
+        if self.local_in_process:
+            return self._local_cwd()
+        await self._exec('lpwd')
+        return self._output(self.before.strip(), 'Local working directory: ')
+
+    async def lls(self, path='', options='', entries=False):
+        """Display local directory listing, see :meth:`psftp.lls`.
+        """
+        if self.local_in_process:
+            return self._lls_in_process(path, options, entries)
+        cmd = 'lls %s %s' % (options, path)
+        await self._exec(cmd, [
+            psftp._exception_invalid_option,
+            psftp._exception_no_such_file])
+        output = self._output(self.before, cmd+'\r\n')
+        return [line.strip() for line in output.split()]
+
+    async def lumask(self, umask):
+        """Set local umask to umask.
+        """
+        if self.local_in_process:
+            return self._lumask_in_process(umask)
+        await self._exec('lumask %s' % str(umask),
+                         [psftp._exception_lumask_failed])
+        self._record_lumask(umask)
+
+    async def pwd(self):
+        """Get remote working directory.
+        """
+        await self._exec('pwd')
+        return self._output(self.before.strip(), 'Remote working directory: ')
+
+    async def version(self):
+        """Display the sftp protocol version.
+        """
+        await self._exec('version')
+        return self._output(self.before, 'version\r\n')
+
+    async def local_command(self, command):
+        """Execute command in local shell
+        """
+        cmd = '!'+command
+        await self._exec(cmd)
+        return self._output(self.before, cmd+'\r\n')
+
+    async def _exec(self, cmd, error_and_exceptions=[]):
+        await self._sync_local(cmd)
+        self._timing_send(cmd)
+        expect = [ee.expect() for ee in error_and_exceptions] + [self.PROMPT]
+        try:
+            i = await self.expect_list(self._expect_patterns(expect),
+                                       async_=True)
+        except (EOF, TIMEOUT) as e:
+            self._timing_done(e)
+            raise
+        if i != len(expect)-1:
+            self._timing_done(error_and_exceptions[i])
+            await self.prompt()
+            raise error_and_exceptions[i]
+        missed = self._match_exception(self.before, error_and_exceptions)
+        self._timing_done(missed)
+        if missed is not None:
+            raise missed
+
+    async def _transfer(self, cmd, progress, error_and_exceptions):
+        attempt = 0
+        while True:
+            try:
+                return await self._transfer_once(cmd, progress,
+                                                 error_and_exceptions)
+            except (EOF, TIMEOUT):
+                if attempt >= self.retries:
+                    raise
+            cmd = self._resume_command(cmd)
+            attempt = await self._reconnect(attempt)
+
+    async def _sync_local(self, cmd):
+        if self._local_pending and (
+                cmd.startswith('!')
+                or cmd.split(' ', 1)[0] in self.LOCAL_PATH_COMMANDS):
+            for cmd, errors in self._local_commands():
+                await self._exec(cmd, errors)
+
+    async def _transfer_once(self, cmd, progress, error_and_exceptions):
+        await self._sync_local(cmd)
+        if progress is None and not self._meter and not self.retries:
+            return await self._exec(cmd, error_and_exceptions)
+        toggle = not self._meter
+        self._meter_borrowed = False
+        if toggle:
+            await self.progress()
+        try:
+            self._timing_send(cmd)
+            expect = [ee.expect() for ee in error_and_exceptions] + [
+                self.PROMPT, PsftpProgress.METER]
+            patterns = self._expect_patterns(expect)
+            missed = None
+            while True:
+                i = await self.expect_list(patterns, async_=True)
+                if i >= len(expect)-2:
+                    missed = missed or self._match_exception(
+                        self.before, error_and_exceptions)
+                if i == len(expect)-1:
+                    self._progress_update(PsftpProgress.parse(self.match),
+                                          progress)
+                    continue
+                if i != len(expect)-2:
+                    self._timing_done(error_and_exceptions[i])
+                    await self.prompt()
+                    raise error_and_exceptions[i]
+                self._timing_done(missed)
+                if missed is not None:
+                    raise missed
+                break
+        except (EOF, TIMEOUT) as e:
+            self._timing_done(e)
+            self._meter_borrowed = toggle
+            toggle = False
+            raise
+        finally:
+            self._transfer_started = None
+            self._stalled_since = None
+            if toggle and self.isalive():
+                await self.progress()
+
+    async def _reconnect(self, attempt):
+        chdirs, lumask, meter = self._relogin_state()
+        while True:
+            if self.async_pw_transport is not None:
+                # The transport closes the dead child on the next loop
+                # iteration, it must not be around for the new one.
+                self.async_pw_transport[1].close()
+                self.async_pw_transport = None
+            await asyncio.sleep(self.retry_backoff * 2 ** attempt)
+            attempt += 1
+            self._forget_child()
+            try:
+                await self._relogin()
+                break
+            except (EOF, TIMEOUT, ExceptionPsftpLocal):
+                if attempt >= self.retries:
+                    raise
+        for name, path in chdirs:
+            await getattr(self, name)(path)
+        if lumask is not None:
+            await self.lumask('%03o' % lumask)
+        if self._meter != meter:
+            await self.progress()
+        self.reconnects += 1
+        return attempt
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""CPU time spent by psftp on the output of a large ``ls``.
+
+A small child process stands in for sftp: it prints a prompt, and answers
+every ``ls`` with a listing of the requested number of names. The listing
+is read with the old expect settings (100 byte reads, searching the whole
+buffer) and with the current defaults::
+
+    python benchmarks/expect_loop.py 500000
+"""
+
+import importlib
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(ROOT))
+psftp = importlib.import_module(os.path.basename(ROOT)).psftp
+
+
+FAKE_SFTP = r'''
+import sys
+n = int(sys.argv[1])
+out = sys.stdout
+out.write('sftp> ')
+out.flush()
+for line in iter(sys.stdin.readline, ''):
+    if line.strip() == 'exit':
+        break
+    if line.startswith('ls'):
+        for i in range(n):
+            out.write('file%08d.txt\n' % i)
+    out.write('sftp> ')
+    out.flush()
+'''
+
+
+def run(names, **kwargs):
+    s = psftp(encoding='utf-8', timeout=600, **kwargs)
+    s._spawn(sys.executable, ['-c', FAKE_SFTP, str(names)])
+    s.prompt()
+    start = time.time()
+    cpu = time.process_time()
+    lines = s.ls()
+    cpu = time.process_time() - cpu
+    elapsed = time.time() - start
+    s.sendline('exit')
+    s.close()
+    return len(lines), cpu, elapsed
+
+
+def main():
+    names = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    settings = [
+        ('maxread=100, searchwindowsize=None',
+         dict(maxread=100, searchwindowsize=None)),
+        ('defaults', dict()),
+    ]
+    for label, kwargs in settings:
+        count, cpu, elapsed = run(names, **kwargs)
+        print('%-36s %8d names  cpu %8.3fs  wall %8.3fs'
+              % (label, count, cpu, elapsed))
+
+
+if __name__ == '__main__':
+    main()
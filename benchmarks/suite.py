@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmarks of psftp against a server on this machine, written as JSON so
+that runs can be compared across changes.
+
+The server is a local sftp-server started through ``sftp -D``, which needs
+neither ssh nor sshd::
+
+    python benchmarks/suite.py --sftp-server /usr/lib/openssh/sftp-server \\
+        -o results.json
+
+or an sshd listening on localhost::
+
+    python benchmarks/suite.py --host localhost --user $USER -o results.json
+
+The cases are the login latency, the latency of pwd, cd and chmod, ls of
+directories with 1k, 100k and 1M entries, and the throughput of get and
+put on many small files and on one large file. The fixtures are created in
+a scratch directory, --remote-workdir gives its path as seen by a server
+with another root, a chrooted sshd for example.
+"""
+
+import argparse
+import importlib
+import json
+import os
+import platform
+import shlex
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(ROOT))
+psftp = importlib.import_module(os.path.basename(ROOT))
+
+
+OPTIONS = {
+    'StrictHostKeyChecking': 'no',
+    'UserKnownHostsFile': '/dev/null'}
+
+CASES = ['login', 'pwd', 'cd', 'chmod', 'ls', 'get_small', 'put_small',
+         'get_large', 'put_large']
+
+
+def summary(samples, cpu):
+    return {
+        'repeat': len(samples),
+        'min': min(samples),
+        'median': statistics.median(samples),
+        'mean': statistics.mean(samples),
+        'max': max(samples),
+        'cpu': cpu,
+    }
+
+
+def measure(fn, repeat):
+    samples = []
+    cpu = time.process_time()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return summary(samples, time.process_time() - cpu)
+
+
+def throughput(fn, files, size):
+    cpu = time.process_time()
+    start = time.perf_counter()
+    fn()
+    seconds = time.perf_counter() - start
+    return {
+        'files': files,
+        'bytes': files * size,
+        'seconds': seconds,
+        'files_per_second': files / seconds,
+        'bytes_per_second': files * size / seconds,
+        'cpu': time.process_time() - cpu,
+    }
+
+
+class Suite(object):
+
+    def __init__(self, args):
+        self.args = args
+        self.workdir = args.workdir or tempfile.mkdtemp(prefix='psftp-bench-')
+        self.remote = args.remote_workdir or self.workdir
+        self.results = {}
+
+    def session(self):
+        args = self.args
+        s = psftp.psftp(encoding='utf-8', timeout=args.timeout,
+                        options=OPTIONS, backend=args.backend)
+        if args.sftp_server:
+            s.connect(shlex.split(args.sftp_server))
+        else:
+            s.login(args.host, args.user, args.password, port=args.port)
+        return s
+
+    def local(self, *names):
+        return os.path.join(self.workdir, *names)
+
+    def remote_path(self, *names):
+        return '/'.join((self.remote,) + names)
+
+    def run(self, cases):
+        for case in cases:
+            getattr(self, 'case_' + case)()
+
+    def record(self, name, result):
+        self.results[name] = result
+        if 'median' in result:
+            line = 'median %9.3fms  max %9.3fms' % (
+                result['median'] * 1000, result['max'] * 1000)
+        else:
+            line = '%9.1f files/s  %9.1f MiB/s' % (
+                result['files_per_second'],
+                result['bytes_per_second'] / 1048576.0)
+        sys.stderr.write('%-12s %s  cpu %8.3fs\n' % (name, line,
+                                                     result['cpu']))
+
+    def case_login(self):
+        def login():
+            self.session().logout()
+        self.record('login', measure(login, self.args.logins))
+
+    def case_pwd(self):
+        s = self.session()
+        self.record('pwd', measure(s.pwd, self.args.repeat))
+        s.logout()
+
+    def case_cd(self):
+        s = self.session()
+        path = self.remote_path()
+        self.record('cd', measure(lambda: s.cd(path), self.args.repeat))
+        s.logout()
+
+    def case_chmod(self):
+        open(self.local('chmod.txt'), 'w').close()
+        s = self.session()
+        path = self.remote_path('chmod.txt')
+        self.record('chmod', measure(lambda: s.chmod(644, path),
+                                     self.args.repeat))
+        s.logout()
+
+    def case_ls(self):
+        for size in self.args.ls_sizes:
+            name = 'ls_%d' % size
+            directory = self.local(name)
+            if not os.path.isdir(directory):
+                os.mkdir(directory)
+                for i in range(size):
+                    open(os.path.join(directory, 'f%07d' % i), 'w').close()
+            s = self.session()
+            path = self.remote_path(name)
+            result = measure(lambda: s.ls(path), self.args.ls_repeat)
+            result['entries'] = size
+            self.record(name, result)
+            s.logout()
+
+    def small_files(self):
+        directory = self.local('small')
+        if not os.path.isdir(directory):
+            os.mkdir(directory)
+            block = os.urandom(self.args.small_size)
+            for i in range(self.args.small_count):
+                with open(os.path.join(directory, 's%05d' % i), 'wb') as f:
+                    f.write(block)
+        return sorted(os.listdir(directory))
+
+    def large_file(self):
+        path = self.local('large')
+        if not os.path.isfile(path):
+            block = os.urandom(1048576)
+            with open(path, 'wb') as f:
+                for _ in range(self.args.large_size // len(block)):
+                    f.write(block)
+                f.write(block[:self.args.large_size % len(block)])
+        return path
+
+    def case_get_small(self):
+        names = self.small_files()
+        target = self.local('get_small')
+        os.mkdir(target)
+        s = self.session()
+
+        def get():
+            for name in names:
+                s.get(self.remote_path('small', name),
+                      os.path.join(target, name))
+        self.record('get_small', throughput(get, len(names),
+                                            self.args.small_size))
+        s.logout()
+        shutil.rmtree(target)
+
+    def case_put_small(self):
+        names = self.small_files()
+        os.mkdir(self.local('put_small'))
+        s = self.session()
+
+        def put():
+            for name in names:
+                s.put(self.local('small', name),
+                      self.remote_path('put_small', name))
+        self.record('put_small', throughput(put, len(names),
+                                            self.args.small_size))
+        s.logout()
+        shutil.rmtree(self.local('put_small'))
+
+    def case_get_large(self):
+        self.large_file()
+        s = self.session()
+        target = self.local('get_large')
+        self.record('get_large', throughput(
+            lambda: s.get(self.remote_path('large'), target),
+            1, self.args.large_size))
+        s.logout()
+        os.remove(target)
+
+    def case_put_large(self):
+        source = self.large_file()
+        s = self.session()
+        self.record('put_large', throughput(
+            lambda: s.put(source, self.remote_path('put_large')),
+            1, self.args.large_size))
+        s.logout()
+        os.remove(self.local('put_large'))
+
+
+def sftp_version():
+    # ssh prints its version to stderr, sftp has no version flag.
+    try:
+        output = subprocess.run(['ssh', '-V'], stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT,
+                                universal_newlines=True).stdout
+    except OSError:
+        return None
+    return output.strip()
+
+
+def sizes(value):
+    return [int(v) for v in value.split(',') if v]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark psftp against a local server.')
+    server = parser.add_mutually_exclusive_group(required=True)
+    server.add_argument('--sftp-server', metavar='COMMAND',
+                        help='sftp-server command run with sftp -D')
+    server.add_argument('--host', help='host of a local sshd')
+    parser.add_argument('--port', type=int)
+    parser.add_argument('--user', default=os.environ.get('USER'))
+    parser.add_argument('--password', default='')
+    parser.add_argument('--backend', default='sftp',
+                        choices=['sftp', 'protocol'])
+    parser.add_argument('--cases', default=','.join(CASES),
+                        help='comma separated, default: %(default)s')
+    parser.add_argument('--repeat', type=int, default=200,
+                        help='runs of pwd, cd and chmod')
+    parser.add_argument('--logins', type=int, default=10)
+    parser.add_argument('--ls-sizes', type=sizes,
+                        default=[1000, 100000, 1000000])
+    parser.add_argument('--ls-repeat', type=int, default=3)
+    parser.add_argument('--small-count', type=int, default=1000)
+    parser.add_argument('--small-size', type=int, default=4096)
+    parser.add_argument('--large-size', type=int, default=256 * 1048576)
+    parser.add_argument('--timeout', type=int, default=600)
+    parser.add_argument('--workdir',
+                        help='scratch directory, kept and reused if given')
+    parser.add_argument('--remote-workdir',
+                        help='the scratch directory as seen by the server')
+    parser.add_argument('-o', '--output', help='JSON file, default stdout')
+    args = parser.parse_args()
+
+    cases = [c for c in args.cases.split(',') if c]
+    unknown = set(cases) - set(CASES)
+    if unknown:
+        parser.error('unknown cases: %s' % ', '.join(sorted(unknown)))
+
+    suite = Suite(args)
+    started = time.time()
+    try:
+        suite.run(cases)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(suite.workdir, ignore_errors=True)
+
+    report = {
+        'psftp': psftp.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'ssh': sftp_version(),
+        'server': 'sftp -D' if args.sftp_server else 'sshd',
+        'backend': args.backend,
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S%z',
+                                 time.localtime(started)),
+        'seconds': time.time() - started,
+        'settings': dict((k, v) for k, v in vars(args).items()
+                         if k not in ('password', 'output')),
+        'cases': suite.results,
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+from pexpect import ExceptionPexpect
+
+from .psftp import psftp, PsftpResult
+
+
+__all__ = ['fanout', 'PsftpHostResult']
+
+
+class PsftpHostResult(object):
+    '''The outcome of :func:`fanout` on one host.
+
+    :host: the login arguments of the host.
+    :exception: the exception of the login, None if it succeeded.
+    :results: one :class:`PsftpResult` per executed operation.
+    :login_seconds, seconds: time spent logging in, and on the whole host.
+    '''
+
+    __slots__ = ('host', 'exception', 'results', 'login_seconds', 'seconds')
+
+    def __init__(self, host):
+        self.host = host
+        self.exception = None
+        self.results = []
+        self.login_seconds = 0.0
+        self.seconds = 0.0
+
+    @property
+    def server(self):
+        return self.host['server']
+
+    @property
+    def ok(self):
+        return self.exception is None and all(r.ok for r in self.results)
+
+    def __repr__(self):
+        if self.exception is not None:
+            state = 'login failed: %r' % self.exception
+        else:
+            state = '%d/%d ok' % (len([r for r in self.results if r.ok]),
+                                  len(self.results))
+        return '<PsftpHostResult %s %s %.3fs>' % (
+            self.server, state, self.seconds)
+
+
+def fanout(
+        hosts,
+        operations,
+        username=None,
+        password='',
+        concurrency=16,
+        stop_on_error=True,
+        **kwargs):
+    """Log in to every host and run the same operations, up to concurrency
+    hosts at a time, so that the whole run takes about as long as the
+    slowest hosts. A host failing to log in or failing an operation does
+    not stop the others. Example::
+
+        results = psftp.fanout(
+            edge_hosts,
+            [('put', 'release.tgz', '/srv/releases/'),
+             ('rename', '/srv/releases/release.tgz', '/srv/current.tgz')],
+            username='deploy', options={"StrictHostKeyChecking": "no"})
+        for r in results:
+            if not r.ok:
+                print(r.server, r.exception, r.results)
+
+    :hosts: host names, or dicts of :meth:`psftp.login` arguments with the
+    host name as 'server', which take precedence over username and
+    password.
+    :operations: (command, args...) tuples naming :class:`psftp` methods,
+    or callables taking the logged in session.
+    :stop_on_error: skip the remaining operations of a host after one
+    failed.
+    :kwargs: passed on to :class:`psftp` for every session.
+
+    :return: list of :class:`PsftpHostResult` in the order of hosts.
+    """
+    logins = []
+    for host in hosts:
+        if not isinstance(host, dict):
+            host = dict(server=host)
+        logins.append(dict(dict(username=username, password=password),
+                           **host))
+    with ThreadPoolExecutor(max(1, min(concurrency, len(logins)))) as e:
+        return list(e.map(
+            lambda login: _run(login, operations, stop_on_error, kwargs),
+            logins))
+
+
+def _run(login, operations, stop_on_error, kwargs):
+    result = PsftpHostResult(login)
+    started = time.time()
+    s = psftp(**kwargs)
+    try:
+        s.login(**login)
+    except (ExceptionPexpect, OSError) as e:
+        result.exception = e
+        s.close()
+        result.login_seconds = result.seconds = time.time() - started
+        return result
+    result.login_seconds = time.time() - started
+    try:
+        for operation in operations:
+            r = _operation(s, operation)
+            result.results.append(r)
+            if not r.ok and (stop_on_error or not s.isalive()):
+                break
+    finally:
+        try:
+            s.logout()
+        except ExceptionPexpect:
+            s.close()
+        result.seconds = time.time() - started
+    return result
+
+
+def _operation(s, operation):
+    if callable(operation):
+        cmd = getattr(operation, '__name__', repr(operation))
+    else:
+        cmd = ' '.join(str(a) for a in operation)
+    try:
+        if callable(operation):
+            value = operation(s)
+        else:
+            value = getattr(s, operation[0])(*operation[1:])
+    except Exception as e:
+        return PsftpResult(cmd, None, e)
+    return PsftpResult(cmd, s.before, value=value)
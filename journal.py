@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sqlite3
+import threading
+import time
+
+
+__all__ = ['PsftpJournal']
+
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS journal (
+    job TEXT NOT NULL,
+    host TEXT NOT NULL,
+    op TEXT NOT NULL,
+    source TEXT NOT NULL,
+    target TEXT NOT NULL,
+    status TEXT NOT NULL,
+    size INTEGER,
+    mtime REAL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (job, host, op, source, target))
+'''
+
+
+class PsftpJournal(object):
+    """Records the get, put and rm commands of the sessions created with
+    ``journal=``, so that a job run again skips what it already did,
+    without asking the server. Example::
+
+        journal = psftp.PsftpJournal('transfers.db', job='release-42')
+        s = psftp.psftp(journal=journal)
+        s.login(hostname, username, password)
+        for path in paths:
+            s.put(path, 'inbox/')   # skipped when done by an earlier run
+
+    An entry is keyed by job, user@host:port, command, and the absolute
+    source and target paths, so the same relative path in another working
+    directory is another entry. A put is skipped while the local source
+    has the size and modification time it had when it was sent, a get
+    while the local copy still has the size and modification time it had
+    when it arrived.
+    Globs, recursive transfers and queued commands are not journaled.
+
+    The journal is a SQLite database in WAL mode, shared safely by the
+    threads and processes using it, every thread has its own connection.
+    """
+
+    def __init__(self, path, job='default', timeout=30):
+        self.path = path
+        self.job = job
+        self.timeout = timeout
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute(_SCHEMA)
+
+    def completed(self, key, local_path=None):
+        '''Whether the command of key is done, and local_path unchanged
+        since.
+        '''
+        row = self._connection().execute(
+            'SELECT status, size, mtime FROM journal WHERE job = ? AND '
+            'host = ? AND op = ? AND source = ? AND target = ?',
+            (self.job,) + tuple(key)).fetchone()
+        if row is None or row[0] != 'done':
+            return False
+        if local_path is None:
+            return True
+        try:
+            st = os.stat(local_path)
+        except OSError:
+            return False
+        return row[1] == st.st_size and row[2] == st.st_mtime
+
+    def record(self, key, status, local_path=None):
+        '''Store the status of the command of key, 'started', 'done' or
+        'failed', with the size and modification time of local_path.
+        '''
+        size = mtime = None
+        if local_path is not None and status == 'done':
+            try:
+                st = os.stat(local_path)
+                size, mtime = st.st_size, st.st_mtime
+            except OSError:
+                pass
+        with self._connection() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO journal VALUES '
+                '(?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (self.job,) + tuple(key) + (status, size, mtime,
+                                            time.time()))
+
+    def counts(self):
+        '''Number of entries of the job per status.
+        '''
+        return dict(self._connection().execute(
+            'SELECT status, count(*) FROM journal WHERE job = ? '
+            'GROUP BY status', (self.job,)).fetchall())
+
+    def forget(self, job=None):
+        '''Drop the entries of job, this journal's job if None.
+        '''
+        with self._connection() as conn:
+            conn.execute('DELETE FROM journal WHERE job = ?',
+                         (job or self.job,))
+
+    def compact(self, max_age=None):
+        '''Drop the entries of all jobs not updated for max_age seconds,
+        and give the space back to the file system.
+
+        :return: the number of entries dropped.
+        '''
+        conn = self._connection()
+        dropped = 0
+        if max_age is not None:
+            with conn:
+                dropped = conn.execute(
+                    'DELETE FROM journal WHERE updated < ?',
+                    (time.time() - max_age,)).rowcount
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        conn.execute('VACUUM')
+        return dropped
+
+    def close(self):
+        '''Close the connection of the calling thread.
+        '''
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
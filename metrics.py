@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import threading
+
+
+__all__ = ['PsftpMetrics']
+
+
+class _Histogram(object):
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def as_dict(self):
+        return dict(count=self.count, sum=self.sum,
+                    buckets=self.cumulative())
+
+
+class PsftpMetrics(object):
+    """Latency histograms of the commands of the psftp sessions created with
+    ``metrics=``, one metrics object may be shared by many sessions.
+    Example::
+
+        metrics = psftp.PsftpMetrics()
+        s = psftp.psftp(metrics=metrics)
+        s.login(hostname, username, password)
+        s.ls()
+        print(metrics.as_dict()['ls']['prompt'])
+        open('psftp.prom', 'w').write(metrics.prometheus())
+
+    For every command the phases are, in seconds:
+
+    :send: writing the command line to the sftp child.
+    :first_byte: from the command sent to the first byte of output after
+    its echo, mostly the round trip to the server.
+    :prompt: from the command sent to the prompt matched, which adds the
+    transfer and the pattern matching to first_byte.
+
+    and also the bytes of output scanned for the prompt and the outcome,
+    'ok' or the name of the error matched, 'no_such_file' for
+    ``psftp._exception_no_such_file`` for example. The login is the command
+    'login', its phases are 'spawn' and the ones of
+    :attr:`psftp.LOGIN_PHASES`.
+    """
+
+    SECONDS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1,
+               2.5, 5, 10, 30, 60, float('inf'))
+    BYTES = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576,
+             float('inf'))
+
+    def __init__(self, seconds_buckets=None, bytes_buckets=None):
+        self.seconds_buckets = self._buckets(seconds_buckets or self.SECONDS)
+        self.bytes_buckets = self._buckets(bytes_buckets or self.BYTES)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def observe(self, command, send=None, first_byte=None, prompt=None,
+                scanned=None, outcome='ok'):
+        '''Record one command, None leaves a phase out.
+        '''
+        with self._lock:
+            for phase, seconds in (('send', send), ('first_byte', first_byte),
+                                   ('prompt', prompt)):
+                if seconds is not None:
+                    self._histogram(self._seconds, (command, phase),
+                                    self.seconds_buckets).observe(seconds)
+            if scanned is not None:
+                self._histogram(self._bytes, command,
+                                self.bytes_buckets).observe(scanned)
+            key = (command, outcome)
+            self._outcomes[key] = self._outcomes.get(key, 0) + 1
+
+    def observe_phase(self, command, phase, seconds):
+        '''Record one phase of a command, a login phase for example.
+        '''
+        with self._lock:
+            self._histogram(self._seconds, (command, phase),
+                            self.seconds_buckets).observe(seconds)
+
+    def as_dict(self):
+        '''The histograms per command and phase, plus 'scanned_bytes' and
+        the counts of the 'outcomes'. Buckets are (upper bound, cumulative
+        count) pairs.
+        '''
+        result = {}
+        with self._lock:
+            for (command, phase), h in self._seconds.items():
+                result.setdefault(command, {})[phase] = h.as_dict()
+            for command, h in self._bytes.items():
+                result.setdefault(command, {})['scanned_bytes'] = h.as_dict()
+            for (command, outcome), count in self._outcomes.items():
+                result.setdefault(command, {}).setdefault(
+                    'outcomes', {})[outcome] = count
+        return result
+
+    def prometheus(self, prefix='psftp'):
+        '''The metrics in the Prometheus text exposition format.
+        '''
+        lines = []
+        with self._lock:
+            lines += self._prometheus_histograms(
+                '%s_command_seconds' % prefix,
+                'Time spent per psftp command and phase.',
+                [(dict(command=c, phase=p), h)
+                 for (c, p), h in sorted(self._seconds.items())])
+            lines += self._prometheus_histograms(
+                '%s_command_scanned_bytes' % prefix,
+                'Output scanned for the prompt per psftp command.',
+                [(dict(command=c), h)
+                 for c, h in sorted(self._bytes.items())])
+            name = '%s_commands_total' % prefix
+            lines.append('# HELP %s psftp commands per outcome.' % name)
+            lines.append('# TYPE %s counter' % name)
+            for (c, o), count in sorted(self._outcomes.items()):
+                lines.append('%s%s %d' % (
+                    name, self._labels(dict(command=c, outcome=o)), count))
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        '''Drop everything recorded.
+        '''
+        with self._lock:
+            self._seconds = {}
+            self._bytes = {}
+            self._outcomes = {}
+
+    def _histogram(self, histograms, key, buckets):
+        h = histograms.get(key)
+        if h is None:
+            h = histograms[key] = _Histogram(buckets)
+        return h
+
+    def _prometheus_histograms(self, name, help, histograms):
+        lines = ['# HELP %s %s' % (name, help),
+                 '# TYPE %s histogram' % name]
+        for labels, h in histograms:
+            for bound, count in h.cumulative():
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('%s_bucket%s %d' % (
+                    name, self._labels(dict(labels, le=le)), count))
+            lines.append('%s_sum%s %r' % (name, self._labels(labels), h.sum))
+            lines.append('%s_count%s %d' % (name, self._labels(labels),
+                                            h.count))
+        return lines
+
+    @classmethod
+    def _labels(cls, labels):
+        return '{%s}' % ','.join(
+            '%s="%s"' % (k, v.replace('\\', '\\\\').replace('"', '\\"')
+                         .replace('\n', '\\n'))
+            for k, v in sorted(labels.items(), key=lambda kv: kv[0] == 'le'))
+
+    @classmethod
+    def _buckets(cls, buckets):
+        buckets = tuple(sorted(buckets))
+        if buckets[-1] != float('inf'):
+            buckets += (float('inf'),)
+        return buckets
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import subprocess
+import tempfile
+
+from .psftp import ExceptionPsftpLocal
+
+
+__all__ = ['PsftpMaster', 'masters']
+
+
+# sun_path of a unix socket holds 108 bytes on linux and 104 on BSD, ssh
+# appends a random suffix to the path while binding.
+_MAX_CONTROL_PATH = 80
+
+
+def _default_control_dir():
+    return os.path.join(tempfile.gettempdir(), 'psftp-%d' % os.getuid())
+
+
+class PsftpMaster(object):
+    """An OpenSSH ControlMaster socket shared by the sessions logged in to
+    the same (username, server, port). The first login with
+    ``multiplex=True`` starts the master, later logins open a new channel on
+    its connection without key exchange or authentication. The master stays
+    up for control_persist seconds after the last session closed.
+
+    Example::
+
+        s = psftp.psftp(multiplex=True)
+        s.login(hostname, username, password)
+        master = s.master()
+        print(master.check())
+        s.logout()
+        master.exit()
+    """
+
+    def __init__(self, server, username, port=None, control_dir=None):
+        self.server = server
+        self.username = username
+        self.port = int(port) if port is not None else 22
+        self.control_dir = control_dir or _default_control_dir()
+        self.path = os.path.join(
+            self.control_dir,
+            '%s@%s:%d' % (self.username, self.server, self.port))
+        if len(self.path) > _MAX_CONTROL_PATH:
+            raise ExceptionPsftpLocal(
+                'control path too long, use a shorter control_dir: %s'
+                % self.path)
+
+    def __repr__(self):
+        return '<PsftpMaster %r>' % self.path
+
+    def options(self, control_persist=600):
+        '''ssh options that share the connection of this master, starting it
+        when it is not running.
+        '''
+        if not os.path.isdir(self.control_dir):
+            os.makedirs(self.control_dir, 0o700)
+        return {
+            'ControlMaster': 'auto',
+            'ControlPath': self.path,
+            'ControlPersist': control_persist}
+
+    def check(self):
+        '''Ask the master whether it is running.
+
+        :return: pid of the master, None if no master is running.
+        '''
+        if not os.path.exists(self.path):
+            return None
+        returncode, output = self._control('check')
+        if returncode != 0:
+            return None
+        match = re.search(r'pid=(\d+)', output)
+        return int(match.group(1)) if match else None
+
+    def exit(self):
+        '''Close the master connection and the sessions sharing it.
+
+        :return: True if a master was running.
+        '''
+        if not os.path.exists(self.path):
+            return False
+        returncode, _ = self._control('exit')
+        if os.path.exists(self.path):
+            # A socket left behind by a master that died.
+            os.remove(self.path)
+        return returncode == 0
+
+    def _control(self, command):
+        process = subprocess.Popen(
+            ['ssh', '-O', command, '-o', 'ControlPath=%s' % self.path,
+             '-p', str(self.port), '%s@%s' % (self.username, self.server)],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            universal_newlines=True)
+        output, _ = process.communicate()
+        return process.returncode, output
+
+
+def masters(control_dir=None):
+    '''List the control sockets in control_dir, the default one if None.
+    Use :meth:`PsftpMaster.check` to know which of them are still running.
+
+    :return: list of :class:`PsftpMaster`.
+    '''
+    control_dir = control_dir or _default_control_dir()
+    if not os.path.isdir(control_dir):
+        return []
+    found = []
+    for name in sorted(os.listdir(control_dir)):
+        match = re.match(r'^(.+)@(.+):(\d+)$', name)
+        if match is None:
+            continue
+        username, server, port = match.groups()
+        found.append(PsftpMaster(server, username, port, control_dir))
+    return found
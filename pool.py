@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import posixpath
+from pexpect import TIMEOUT, EOF, ExceptionPexpect
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from .psftp import psftp, PsftpResult, ExceptionPsftpLocal, \
+    ExceptionPsftpInteraction
+
+
+__all__ = ['PsftpPool']
+
+
+class PsftpPool(object):
+    """A fixed number of psftp sessions logged in to the same host. Each
+    session is one sftp child, so the pool runs as many commands at a time
+    as it has sessions.
+
+    Example that uploads files over four sessions::
+
+        import psftp
+        pool = psftp.PsftpPool(4, options={"StrictHostKeyChecking": "no"})
+        pool.login(hostname, username, password)
+        for result in pool.put_many(['a.txt', 'b.txt', 'c.txt'], 'upload'):
+            if not result.ok:
+                print(result.cmd, result.exception)
+        pool.logout()
+
+    The keyword arguments are passed on to :class:`psftp` for every session.
+    """
+
+    def __init__(self, size=4, **kwargs):
+        if size < 1:
+            raise ExceptionPsftpLocal('pool size must be positive')
+        self.size = size
+        self._kwargs = kwargs
+        self._login_args = None
+        self._sessions = []
+        self._idle = queue.Queue()
+
+    def login(self, server, username, password='', **kwargs):
+        '''Log in all sessions of the pool. The arguments are the same as
+        :meth:`psftp.login`.
+        '''
+        self._login_args = dict(kwargs, server=server, username=username,
+                                password=password)
+        count = self.size
+        if self._kwargs.get('multiplex'):
+            # The first login starts the ControlMaster, the others share it
+            # instead of racing to become the master.
+            self._login()
+            count -= 1
+        with ThreadPoolExecutor(self.size) as executor:
+            futures = [executor.submit(self._login)
+                       for _ in range(count)]
+            errors = [f.exception() for f in futures if f.exception()]
+        if errors:
+            self.logout()
+            raise errors[0]
+        return True
+
+    def logout(self):
+        '''Log out and close all sessions of the pool.
+        '''
+        sessions, self._sessions = self._sessions, []
+        # Callers waiting for a session are woken with the exception they
+        # raise, see session().
+        idle, self._idle = self._idle, queue.Queue()
+        idle.put(ExceptionPsftpLocal('not logged in'))
+        for s in sessions:
+            try:
+                s.logout()
+            except ExceptionPexpect:
+                s.close()
+
+    @contextmanager
+    def session(self):
+        '''Borrow an idle session, waiting for one if all are busy.
+
+        A session whose sftp child died while borrowed is replaced by a newly
+        logged in one. Once no session is left, the callers waiting and the
+        new ones get ExceptionPsftpLocal.
+        '''
+        if not self._sessions:
+            raise ExceptionPsftpLocal('not logged in')
+        idle = self._idle
+        s = idle.get()
+        if isinstance(s, ExceptionPsftpLocal):
+            # Pass the wake-up on to the next waiter.
+            idle.put(s)
+            raise s
+        try:
+            yield s
+        except (EOF, TIMEOUT):
+            s = self._replace(s)
+            raise
+        finally:
+            if s is not None and idle is self._idle:
+                idle.put(s)
+            elif s is not None:
+                # The pool logged out while the session was borrowed.
+                if s in self._sessions:
+                    self._sessions.remove(s)
+                s.close(force=True)
+
+    def get_many(self, remote_paths, local_path='', options=''):
+        """Download remote_paths spread over the sessions of the pool.
+
+        :remote_paths: remote paths, or (remote_path, local_path) tuples.
+        :local_path: default local path for items given as plain paths.
+        :options: passed on to :meth:`psftp.get`.
+
+        :return: list of :class:`PsftpResult` in the order of remote_paths.
+        """
+        return self._transfer('get', remote_paths, local_path, options)
+
+    def put_many(self, local_paths, remote_path='', options=''):
+        """Upload local_paths spread over the sessions of the pool.
+
+        :local_paths: local paths, or (local_path, remote_path) tuples.
+        :remote_path: default remote path for items given as plain paths.
+        :options: passed on to :meth:`psftp.put`.
+
+        :return: list of :class:`PsftpResult` in the order of local_paths.
+        """
+        return self._transfer('put', local_paths, remote_path, options)
+
+    def walk(self, top='.', onerror=None, prefetch=None):
+        '''Walk the remote tree under top like :meth:`psftp.walk`, listing
+        up to one directory per session at a time. The directories found so
+        far are listed ahead of the consumer, at most prefetch of them, four
+        per session by default. Subdirectories are queued once their parent
+        was yielded, so pruning dirs still works.
+        '''
+        prefetch = prefetch or 4 * self.size
+        waiting = deque([top])
+        pending = deque()
+        with ThreadPoolExecutor(self.size) as executor:
+            try:
+                while waiting or pending:
+                    while waiting and len(pending) < prefetch:
+                        path = waiting.popleft()
+                        pending.append((path, executor.submit(
+                            self._walk_listing, path)))
+                    path, future = pending.popleft()
+                    try:
+                        dirs, files = future.result()
+                    except ExceptionPsftpInteraction as e:
+                        if onerror is not None:
+                            onerror(e)
+                        continue
+                    yield path, dirs, files
+                    waiting.extend(posixpath.join(path, d.name)
+                                   for d in dirs)
+            finally:
+                for _, future in pending:
+                    future.cancel()
+
+    def _walk_listing(self, path):
+        with self.session() as s:
+            return s._walk_listing(path)
+
+    def _transfer(self, name, items, target, options):
+        items = [i if isinstance(i, tuple) else (i, target) for i in items]
+        with ThreadPoolExecutor(self.size) as executor:
+            return list(executor.map(
+                lambda item: self._run(name, item[0], item[1], options),
+                items))
+
+    def _run(self, name, source, target, options):
+        cmd = '%s %s %s' % (name, source, target)
+        try:
+            with self.session() as s:
+                getattr(s, name)(source, target, options)
+                return PsftpResult(cmd, s.before)
+        except ExceptionPexpect as e:
+            return PsftpResult(cmd, None, e)
+
+    def _login(self):
+        s = psftp(**self._kwargs)
+        s.login(**self._login_args)
+        self._sessions.append(s)
+        self._idle.put(s)
+        return s
+
+    def _replace(self, s):
+        # The pool shrinks when the replacement can not log in.
+        s.close(force=True)
+        if s not in self._sessions:
+            # Dropped by a logout meanwhile.
+            return None
+        self._sessions.remove(s)
+        n = psftp(**self._kwargs)
+        try:
+            n.login(**self._login_args)
+        except ExceptionPexpect:
+            if not self._sessions:
+                self._idle.put(ExceptionPsftpLocal('no session left'))
+            return None
+        self._sessions.append(n)
+        return n
@@ -2,10 +2,26 @@
 # -*- coding: utf-8 -*-
 
 from pexpect import spawn, TIMEOUT, EOF, ExceptionPexpect
+from collections import deque, OrderedDict
+import bisect
+import errno
+import glob
+import grp
+import io
 import os
+import posixpath
+import pwd
+import re
+import shlex
+import shutil
+import stat
+import tempfile
+import time
 
 
-__all__ = ['psftp', 'ExceptionPsftpLocal', 'ExceptionPsftpInteraction']
+__all__ = ['psftp', 'PsftpBatch', 'PsftpEntry', 'PsftpPipeline',
+           'PsftpProgress', 'PsftpResult', 'PsftpTransferStats',
+           'ExceptionPsftpLocal', 'ExceptionPsftpInteraction']
 
 
 # Exception classes used by this module.
@@ -79,11 +95,17 @@ class psftp(spawn):
         s.login (hostname, username, password)
     """
 
+    def __new__(cls, *args, **kwargs):
+        if cls is psftp and kwargs.get('backend') == 'protocol':
+            from .sftpv3 import PsftpV3
+            cls = PsftpV3
+        return super(psftp, cls).__new__(cls)
+
     def __init__(
             self,
             timeout=60,
-            maxread=100,
-            searchwindowsize=None,
+            maxread=65536,
+            searchwindowsize=8192,
             logfile=None,
             cwd=None,
             env=None,
@@ -91,7 +113,18 @@ class psftp(spawn):
             echo=True,
             options={},
             encoding=None,
-            codec_errors='strict'):
+            codec_errors='strict',
+            listing_ttl=0,
+            listing_cache_size=128,
+            backend='sftp',
+            multiplex=False,
+            control_persist=600,
+            control_dir=None,
+            retries=0,
+            retry_backoff=1.0,
+            journal=None,
+            metrics=None,
+            local_in_process=False):
         super(psftp, self).__init__(
             None,
             timeout=timeout,
@@ -106,6 +139,9 @@ class psftp(spawn):
             codec_errors=codec_errors)
         self.name = '<psftp>'
         self.PROMPT = r"sftp> "
+        # 'sftp' drives the sftp client, 'protocol' speaks the SFTP protocol
+        # to the server directly, see :class:`sftpv3.PsftpV3`.
+        self.backend = backend
 
         self.SSH_OPTS = ("-o'RSAAuthentication=no'"
                          + " -o 'PubkeyAuthentication=no'")
@@ -116,6 +152,80 @@ class psftp(spawn):
         # UserKnownHostsFile="/dev/null")
         self.options = options
 
+        # Directory listings are cached for listing_ttl seconds, 0 disables
+        # the cache. Commands changing the remote side drop the entries of
+        # the paths they touch.
+        self.listing_ttl = listing_ttl
+        self.listing_cache_size = listing_cache_size
+        self._listings = OrderedDict()
+
+        # Compiled expect pattern lists, keyed by the tuple of patterns.
+        # Together with a bounded searchwindowsize the prompt is looked for
+        # in the tail of the output only, instead of the whole buffer after
+        # every read. An error line further back than the window is found
+        # in the output once the prompt matched, see :meth:`_exec`.
+        self._patterns = {}
+
+        # Share one ssh connection between the logins to the same host, see
+        # :class:`multiplex.PsftpMaster`.
+        self.multiplex = multiplex
+        self.control_persist = control_persist
+        self.control_dir = control_dir
+
+        # Throughput of the transfers whose progress was followed, see
+        # :meth:`get` and :meth:`put`.
+        self.transfer_stats = PsftpTransferStats()
+        self._meter = False
+        self._meter_borrowed = False
+        self._transfer_started = None
+        self._stalled_since = None
+
+        # A transfer losing the sftp child logs in again and resumes up to
+        # retries times, waiting retry_backoff seconds doubled on every
+        # attempt. The cd and lcd commands since the login are replayed in
+        # the new session, with the last lumask and the progress meter.
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.reconnects = 0
+        self._chdirs = []
+
+        # Completed get, put and rm commands are recorded in the journal and
+        # skipped when run again, see :class:`journal.PsftpJournal`.
+        self.journal = journal
+        self._lpwd = None
+        self._rpwd = None
+
+        # Seconds without output during the login after which sftp is asked
+        # whether it reads commands, and the (phase, seconds) pairs of the
+        # last login, see :meth:`_login_phase`.
+        self.login_probe = 1.0
+        self.login_phases = []
+
+        # Timings of the commands and login phases are recorded in metrics,
+        # see :class:`metrics.PsftpMetrics`. None records nothing.
+        self.metrics = metrics
+        self._timing = None
+
+        # Second connection speaking the SFTP protocol, started by the
+        # first :meth:`open_remote`.
+        self._protocol = None
+
+        # Blocks of the files read with :meth:`open_remote`, see
+        # :class:`sftpv3.PsftpBlockCache`. Created by the first call unless
+        # set, it may be shared with other sessions to the same host.
+        self.block_cache = None
+
+        # Whether the server copies files itself, see :meth:`copy`. None
+        # until the first copy finds out.
+        self._server_copy = None
+
+        # lpwd, lcd, lls, lmkdir and lumask run in this process instead of
+        # the sftp child. The lcd and lumask the child has not seen yet are
+        # sent before the next command using local paths.
+        self.local_in_process = local_in_process
+        self._local_pending = OrderedDict()
+        self._lumask = None
+
     def login(
             self,
             server,
@@ -126,83 +236,353 @@ class psftp(spawn):
             port=None,
             ssh_key=None,
             quiet=True,
-            check_local_ip=True):
+            check_local_ip=True,
+            buffer_size=None,
+            num_requests=None,
+            compression=False,
+            bandwidth_limit=None,
+            cipher=None):
         '''This logs the user into the given server.
+
+        The login fails after login_timeout seconds without sftp ready for
+        commands. The time spent in every phase is left in login_phases.
+
+        The transfer settings are passed on to sftp, None keeps its default,
+        see also :func:`tuning.autotune`.
+
+        :buffer_size: bytes per read or write request, -B.
+        :num_requests: requests kept in flight, -R.
+        :compression: compress the ssh connection, -C.
+        :bandwidth_limit: Kbit/s the transfers are limited to, -l.
+        :cipher: ssh cipher, -c.
         '''
-        ssh_options = ''.join([" -o '%s=%s'" % (o, v) for
-                               (o, v) in self.options.items()])
-        if quiet:
-            ssh_options += ' -q'
-        if not check_local_ip:
-            ssh_options += " -o'NoHostAuthenticationForLocalhost=yes'"
-        if self.force_password:
-            ssh_options += ' ' + self.SSH_OPTS
-        if port is not None:
-            ssh_options += ' -P %s' % (str(port))
-        if ssh_key is not None and os.path.isfile(ssh_key):
-            ssh_options = ssh_options + ' -i %s' % (ssh_key)
+        self._login_spawn(server, username, password, port, ssh_key, quiet,
+                          check_local_ip, dict(
+                              buffer_size=buffer_size,
+                              num_requests=num_requests,
+                              compression=compression,
+                              bandwidth_limit=bandwidth_limit,
+                              cipher=cipher))
+        self._login_wait(password, terminal_type, login_timeout)
+        return True
 
-        cmd = "sftp %s %s@%s" % (ssh_options, username, server)
+    def connect(self, command, password='', login_timeout=10):
+        '''Start sftp on a local sftp server with ``sftp -D`` instead of
+        logging in over ssh. command is the list of program arguments of the
+        server, for example ``['/usr/lib/openssh/sftp-server']``.
+        '''
+        self._connect_spawn(command, password)
+        self._login_wait(password, 'ansi', login_timeout)
+
+        return True
+
+    def _connect_spawn(self, command, password):
+        self._login_args = dict(command=command, password=password)
+        self._meter = False
+        self._chdirs = []
+        self._lpwd = None
+        self._rpwd = None
+        self._server_copy = None
+        self._local_pending = OrderedDict()
+        self._lumask = None
+        self._spawn_timed(self._direct_command(command))
+
+    def _direct_command(self, command, batchfile=None):
+        '''Build the sftp command line used by :meth:`connect`.
+        '''
+        # sftp splits the -D argument itself, pexpect splits the outer line.
+        server = ' '.join(shlex.quote(c) for c in command)
+        options = ' -q'
+        if batchfile is not None:
+            options += ' -b %s' % (batchfile)
+        return 'sftp%s -D %s' % (options, shlex.quote(server))
+
+    def _login_spawn(
+            self,
+            server,
+            username,
+            password,
+            port,
+            ssh_key,
+            quiet,
+            check_local_ip,
+            tuning=None):
+        # Remembered so that batch runs can open their own sftp child.
+        self._login_args = dict(
+            server=server,
+            username=username,
+            password=password,
+            port=port,
+            ssh_key=ssh_key,
+            quiet=quiet,
+            check_local_ip=check_local_ip,
+            tuning=tuning or {})
+        cmd = self._command(server, username, port, ssh_key, quiet,
+                            check_local_ip, tuning=tuning)
+        # sftp -q starts with the progress meter off.
+        self._meter = not quiet
+        self._chdirs = []
+        self._lpwd = None
+        self._rpwd = None
+        self._server_copy = None
+        self._local_pending = OrderedDict()
+        self._lumask = None
+        self._spawn_timed(cmd)
+
+    def _spawn_timed(self, cmd):
+        started = time.time()
         super(psftp, self)._spawn(cmd)
+        if self.local_in_process:
+            # The child starts in the directory of this process.
+            self._lpwd = os.path.abspath(self.cwd or os.getcwd())
+        self.login_phases = []
+        self._login_timing('spawn', started)
+
+    def _login_wait(self, password, terminal_type, login_timeout):
+        '''Answer the login prompts until sftp reads commands, at most
+        login_timeout seconds.
+        '''
+        phase_expect = self._login_expect()
+        patterns = self._expect_patterns(phase_expect)
+        expected = [False] * len(phase_expect)
+        started = time.time()
+        deadline = started + login_timeout
+        while True:
+            i = self.expect_list(patterns,
+                                 timeout=self._login_wait_timeout(
+                                     expected, deadline))
+            started = self._login_timing(self.LOGIN_PHASES[i], started)
+            if self._login_phase(i, expected, password, terminal_type):
+                break
 
-        phase_expect = [
-            "(?i)are you sure you want to continue connecting",
+    def _login_expect(self):
+        return [
+            "(?i)(?:are you sure you want to continue connecting)"
+            "|(?:please type 'yes', 'no')",
             self.PROMPT,
             "(?i)(?:password)|(?:passphrase for key)",
             "(?i)permission denied",
             "(?i)terminal type",
             TIMEOUT,
             "(?i)connection closed by remote host",
-            EOF]
-        expected = [False] * len(phase_expect)
-        while True:
-            i = self.expect(phase_expect, timeout=login_timeout)
-            if i == 0:
-                # New certificate -- always accept it.
-                # This is what you get if SSH does not have the remote host's
-                # public key stored in the 'known_hosts' cache.
-                assert not expected[i]
-                expected[i] = True
-                self.sendline("yes")
-            elif i == 1:
-                # can occur if you have a public key pair set to authenticate.
-                break
-            elif i == 2:
-                assert not expected[i]
-                expected[i] = True
-                self.sendline(password)
-            elif i == 3:
-                # permission denied -- password was bad.
+            EOF,
+            # The answer to the sentinel, see :meth:`_login_phase`.
+            r"SFTP protocol version \d+\s+" + self.PROMPT]
+
+    # Names of the patterns of :meth:`_login_expect`, for login_phases and
+    # the metrics.
+    LOGIN_PHASES = ('host_key', 'prompt', 'password', 'permission_denied',
+                    'terminal_type', 'timeout', 'connection_closed', 'eof',
+                    'sentinel')
+
+    # Command sent to tell when sftp reads commands, its output can not be
+    # mistaken for its echo.
+    LOGIN_SENTINEL = 'version'
+
+    def _login_wait_timeout(self, expected, deadline):
+        # Quiet for login_probe seconds sends the sentinel, after which the
+        # rest of login_timeout is left for its answer.
+        timeout = max(0, deadline - time.time())
+        if not expected[8]:
+            timeout = min(timeout, self.login_probe)
+        return timeout
+
+    def _login_timing(self, phase, started):
+        # Records the time since started for the phase matched.
+        now = time.time()
+        self.login_phases.append((phase, now - started))
+        if self.metrics is not None:
+            self.metrics.observe_phase('login', phase, now - started)
+        return now
+
+    def _login_phase(self, i, expected, password, terminal_type):
+        """Handle the login phase matched by pattern i of
+        :meth:`_login_expect`.
+
+        :return: True once logged in.
+        """
+        if expected[8] and i in (0, 2, 4):
+            # The sentinel went ahead of a question, which discards it or
+            # takes it for the answer and asks again.
+            expected[8] = False
+            expected[i] = False
+        if i == 0:
+            # New certificate -- always accept it.
+            # This is what you get if SSH does not have the remote host's
+            # public key stored in the 'known_hosts' cache.
+            assert not expected[i]
+            expected[i] = True
+            self.sendline("yes")
+        elif i == 1:
+            # can occur if you have a public key pair set to authenticate.
+            # With the sentinel sent its answer follows the prompt.
+            return not expected[8]
+        elif i == 2:
+            if expected[i]:
+                # Asked again, quiet ssh does not say the password was bad.
                 self.close()
                 raise ExceptionPsftpLocal('permission denied')
-            elif i == 4:
-                assert not expected[i]
-                expected[i] = True
-                self.sendline(terminal_type)
-            elif i == 5:
-                # Timeout
-                # This is tricky. I presume that we are at the command-line
-                # prompt. It may be that the shell prompt was so weird that we
-                # couldn't match it. Or it may be that we couldn't log in for
-                # some other reason. I can't be sure, but it's safe to guess
-                # that we did login because if I presume wrong and we are not
-                # logged in then this should be caught later when I try to set
-                # the shell prompt.
-                break
-            elif i == 6:
-                # Connection closed by remote host
+            expected[i] = True
+            self.sendline(password)
+        elif i == 3:
+            # permission denied -- password was bad.
+            self.close()
+            raise ExceptionPsftpLocal('permission denied')
+        elif i == 4:
+            assert not expected[i]
+            expected[i] = True
+            self.sendline(terminal_type)
+        elif i == 5:
+            # Timeout
+            # Quiet for login_probe seconds: still connecting, or at a
+            # prompt that did not match. Instead of presuming we are logged
+            # in, send a sentinel command, sftp answers it once it reads
+            # commands. Typed ahead of a question it is discarded or
+            # taken for the answer, see above.
+            if expected[8]:
                 self.close()
-                raise ExceptionPsftpLocal('connection closed')
-            elif i == 7:
-                self.close()
-                raise ExceptionPsftpLocal(
-                    'Could not establish connection to host')
+                raise ExceptionPsftpLocal('login timed out')
+            expected[8] = True
+            self.sendline(self.LOGIN_SENTINEL)
+        elif i == 6:
+            # Connection closed by remote host
+            self.close()
+            raise ExceptionPsftpLocal('connection closed')
+        elif i == 7:
+            self.close()
+            raise ExceptionPsftpLocal(
+                'Could not establish connection to host')
+        elif i == 8:
+            # The sentinel answered, and its prompt is consumed.
+            return True
+        else:
+            # Unexpected
+            self.close()
+            raise ExceptionPsftpLocal('unexpected login response')
+        return False
+
+    def _command(
+            self,
+            server,
+            username,
+            port=None,
+            ssh_key=None,
+            quiet=True,
+            check_local_ip=True,
+            batchfile=None,
+            tuning=None):
+        '''Build the sftp command line used by :meth:`login`.
+        '''
+        tuning = tuning or {}
+        ssh_options = ''.join([" -o '%s=%s'" % (o, v) for
+                               (o, v) in self.options.items()])
+        ssh_options += ''.join([" -o '%s=%s'" % (o, v) for (o, v) in
+                                self._control_options(server, username,
+                                                      port).items()])
+        if quiet:
+            ssh_options += ' -q'
+        if not check_local_ip:
+            ssh_options += " -o'NoHostAuthenticationForLocalhost=yes'"
+        if self.force_password:
+            ssh_options += ' ' + self.SSH_OPTS
+        if port is not None:
+            ssh_options += ' -P %s' % (str(port))
+        if ssh_key is not None and os.path.isfile(ssh_key):
+            ssh_options = ssh_options + ' -i %s' % (ssh_key)
+        if tuning.get('buffer_size'):
+            ssh_options += ' -B %d' % tuning['buffer_size']
+        if tuning.get('num_requests'):
+            ssh_options += ' -R %d' % tuning['num_requests']
+        if tuning.get('compression'):
+            ssh_options += ' -C'
+        if tuning.get('bandwidth_limit'):
+            ssh_options += ' -l %d' % tuning['bandwidth_limit']
+        if tuning.get('cipher'):
+            ssh_options += " -c '%s'" % tuning['cipher']
+        if batchfile is not None:
+            # sftp -b forces BatchMode on ssh, but the first value given for
+            # an option wins, so password logins keep working.
+            ssh_options += " -o 'BatchMode=no' -b %s" % (batchfile)
+
+        return "sftp %s %s@%s" % (ssh_options, username, server)
+
+    def _ssh_command(self, server, username, port, ssh_key, quiet,
+                     check_local_ip, tuning=None):
+        '''Build the ssh command line that starts the sftp subsystem, used
+        by the protocol backend and :meth:`open_remote`.
+        '''
+        tuning = tuning or {}
+        command = ['ssh']
+        for o, v in self.options.items():
+            command += ['-o', '%s=%s' % (o, v)]
+        for o, v in self._control_options(server, username, port).items():
+            command += ['-o', '%s=%s' % (o, v)]
+        if quiet:
+            command.append('-q')
+        if not check_local_ip:
+            command += ['-o', 'NoHostAuthenticationForLocalhost=yes']
+        if self.force_password:
+            command += ['-o', 'PubkeyAuthentication=no']
+        if port is not None:
+            command += ['-p', str(port)]
+        if ssh_key is not None and os.path.isfile(ssh_key):
+            command += ['-i', ssh_key]
+        if tuning.get('compression'):
+            command.append('-C')
+        if tuning.get('cipher'):
+            command += ['-c', tuning['cipher']]
+        command += ['-s', '%s@%s' % (username, server), 'sftp']
+        return command
+
+    def master(self):
+        '''The ControlMaster of this session, for a session logged in with
+        multiplex enabled.
+
+        :return: :class:`multiplex.PsftpMaster`
+        '''
+        if not self.multiplex or 'command' in self._login_args:
+            raise ExceptionPsftpLocal('multiplex is not enabled')
+        from .multiplex import PsftpMaster
+        return PsftpMaster(self._login_args['server'],
+                           self._login_args['username'],
+                           self._login_args['port'],
+                           self.control_dir)
+
+    def close(self, force=True):
+        if self._protocol is not None:
+            self._protocol.close()
+            self._protocol = None
+        super(psftp, self).close(force)
+
+    def _protocol_client(self):
+        if self._protocol is None or not self._protocol.isalive():
+            from .sftpv3 import connect
+            args = self._login_args
+            if 'command' in args:
+                command = args['command']
             else:
-                # Unexpected
-                self.close()
-                raise ExceptionPsftpLocal('unexpected login response')
-
-        return True
+                command = self._ssh_command(
+                    args['server'], args['username'], args['port'],
+                    args['ssh_key'], args['quiet'], args['check_local_ip'],
+                    args['tuning'])
+            self._protocol = connect(command, args['password'],
+                                     timeout=self.timeout, env=self.env,
+                                     encoding=self.encoding or 'utf-8')
+        return self._protocol
+
+    def _stream_path(self, path):
+        # The second connection starts in the home directory.
+        path = self._unquote(path)
+        if posixpath.isabs(path):
+            return path
+        return posixpath.join(self.pwd(), path)
+
+    def _control_options(self, server, username, port):
+        if not self.multiplex:
+            return {}
+        from .multiplex import PsftpMaster
+        master = PsftpMaster(server, username, port, self.control_dir)
+        return master.options(self.control_persist)
 
     def logout(self):
         '''Sends exit to the remote shell.
@@ -229,34 +609,117 @@ class psftp(spawn):
 
         if timeout == -1:
             timeout = self.timeout
-        i = self.expect([self.PROMPT, TIMEOUT], timeout=timeout)
+        i = self.expect_list(self._expect_patterns([self.PROMPT, TIMEOUT]),
+                             timeout=timeout)
         if i == 1:
             return False
         return True
 
+    def batch(self, ignore_errors=True, timeout=None):
+        """Collect commands and run them as one sftp batch file instead of one
+        round-trip per command. See :class:`PsftpBatch`.
+
+        :ignore_errors: prefix every command with '-' so that a failing
+        command does not abort the rest of the batch.
+        :timeout: seconds to wait for the whole batch, None waits forever.
+        """
+        return PsftpBatch(self, ignore_errors, timeout)
+
     def cd(self, path):
         """Change remote directory to path.
         """
         cmd = 'cd %s' % path
+        self._invalidate_relative()
         self._exec(cmd, [psftp._exception_no_such_file])
+        self._chdir('cd', path)
 
     def chgrp(self, grp, path):
         """Change group of file path to grp. path may contain glob(3)
         characters and may match multiple files. grp must be a numeric GID.
         """
         cmd = 'chgrp %d %s' % (grp, path)
-        self._exec(cmd, [psftp._exception_permission_deined,
-                         psftp._exception_no_such_file])
+        self._invalidate(path)
+        return self._exec(cmd, [psftp._exception_permission_deined,
+                                psftp._exception_no_such_file])
 
     def chmod(self, mode, path):
         """Change permissions of file path to mode. path may contain glob(3)
         characters and may match multiple files.
         """
         cmd = 'chmod %s %s' % (str(mode), path)
-        self._exec(cmd, [
+        self._invalidate(path)
+        return self._exec(cmd, [
             psftp._exception_permission_deined,
             psftp._exception_no_such_file])
 
+    def copy(self, src, dst):
+        """Copy the remote file src to the remote file dst. When the server
+        supports the copy-data extension the data does not leave it, which
+        needs OpenSSH 9.0 or later on both ends. Otherwise
+        the file is downloaded to a temporary directory and uploaded again.
+        The first copy of the session finds out which way works.
+
+        :return: 'server' or 'local', the way the file was copied.
+        """
+        self._invalidate(dst)
+        if self._server_copy is not False:
+            try:
+                self._exec('cp %s %s' % (src, dst), [
+                    psftp._exception_copy_unsupported,
+                    psftp._exception_invalid_command,
+                    psftp._exception_permission_deined,
+                    psftp._exception_copy_no_such_file,
+                    psftp._exception_non_regular_copy,
+                    psftp._exception_copy_failure])
+                self._server_copy = True
+                return 'server'
+            except ExceptionPsftpInteraction as e:
+                if e not in (psftp._exception_copy_unsupported,
+                             psftp._exception_invalid_command):
+                    raise
+                self._server_copy = False
+        workdir = tempfile.mkdtemp(prefix='psftp-copy-')
+        try:
+            local = self._quote(os.path.join(
+                workdir, posixpath.basename(self._unquote(src))))
+            # The empty options slot of get and put, which the resume of a
+            # retried transfer fills.
+            self._transfer('get %s %s %s' % ('', src, local), None, [
+                psftp._exception_permission_deined,
+                psftp._exception_file_no_found,
+                psftp._exception_non_regular_file])
+            self._transfer('put %s %s %s' % ('', local, dst), None, [
+                psftp._exception_permission_deined,
+                psftp._exception_non_regular_file])
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        return 'local'
+
+    def copy_tree(self, src, dst):
+        """Copy the remote directory src to dst file by file with
+        :meth:`copy`, creating the directories on the way.
+
+        :src, dst: plain remote paths, not quoted.
+
+        :return: list of (source, target, way) tuples, one per file, way
+        being what :meth:`copy` returned.
+        """
+        copied = []
+        for dirpath, dirs, files in self.walk(src):
+            target = posixpath.normpath(posixpath.join(
+                dst, posixpath.relpath(dirpath, src)))
+            try:
+                self.mkdir(self._quote(target))
+            except ExceptionPsftpInteraction:
+                # Most likely there already, the copies tell otherwise.
+                pass
+            for f in files:
+                source = posixpath.join(dirpath, f.name)
+                path = posixpath.join(target, f.name)
+                copied.append((source, path, self.copy(self._quote(source),
+                                                       self._quote(path))))
+        return copied
+
     def df(self, path='', options=''):
         """Display usage information for the filesystem holding the current
         directory (of path if specified).
@@ -276,19 +739,14 @@ class psftp(spawn):
         valid_options = self._options(base_options, options)
         cmd = 'df %s' % valid_options
         self._exec(cmd)
-        output = self._output(self.before, '\r\n')
-        lines = output.split('\r\n')
-        if len(lines) < 2:
-            return (None, None)
-        title = lines[0].split()
-        value = lines[1].split()
-        return (title, value)
+        return self._df_output()
 
     def get(
             self,
             remote_path,
             local_path='',
-            options=''):
+            options='',
+            progress=None):
         """Retrieve the remote-path and store it on the local machine. If the
         local path name is not specified, it is given the same name it has on
         the remote machine. rempte-path may contain glob(3) characters and may
@@ -305,14 +763,35 @@ class psftp(spawn):
         -P,-p full file permissions and access times are copied too.
         -r directories will be copied recursively. Note that sftp
         does not follow symbolic links when performing recursive transfers.
+
+        :progress: called with a :class:`PsftpProgress` for every refresh of
+        the progress meter, which is turned on for the transfer.
         """
         base_options = 'afPpr'
         valid_options = self._options(base_options, options)
         cmd = 'get %s %s %s' % (valid_options, remote_path, local_path)
-        self._exec(cmd, [
-            psftp._exception_permission_deined,
-            psftp._exception_file_no_found,
-            psftp._exception_non_regular_file])
+        return self._journaled(
+            'get', remote_path, local_path, options,
+            lambda: self._transfer(cmd, progress, [
+                psftp._exception_permission_deined,
+                psftp._exception_file_no_found,
+                psftp._exception_non_regular_file]))
+
+    def get_many(self, remote_paths, local_dir='', options=''):
+        """Download remote_paths into local_dir with as few get commands as
+        possible. The files of one remote directory are fetched with glob
+        patterns that match exactly the requested names, a file that can not
+        be covered by one is fetched on its own. When a command of a group
+        fails, its files are fetched one by one to tell which failed.
+
+        :remote_paths: plain remote paths, not quoted, or
+        (remote_path, local_path) tuples which are fetched on their own.
+        :local_dir: the local directory receiving the files.
+        :options: passed on to :meth:`get`.
+
+        :return: list of :class:`PsftpResult` in the order of remote_paths.
+        """
+        return self._many('get', remote_paths, local_dir, options)
 
     def help(self):
         """Display help text.
@@ -320,16 +799,89 @@ class psftp(spawn):
         self._exec('help')
         return self._output(self.before, 'help\r\n')
 
+    def iter_remote(self, path, chunk_size=65536):
+        """Read the remote file path in chunks, without storing it locally.
+        See :meth:`open_remote`.
+
+        :return: iterator of bytes, each at most chunk_size long.
+        """
+        with self.open_remote(path) as f:
+            while True:
+                chunk = f.read1(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    def iter_ls(self, path='', options='', entries=False):
+        """Like :meth:`ls`, but yields the lines as the output of sftp
+        arrives instead of waiting for the whole listing, in constant
+        memory. Sorting needs every entry, so the listing is unsorted like
+        with -f and the sort options are ignored. Names are listed one per
+        line, so names with blanks stay whole. sftp itself reads the whole
+        directory before it prints, the protocol backend yields every batch
+        of names the server sends.
+
+        The rest of the listing is skipped when the consumer stops early::
+
+            for name in s.iter_ls('inbox'):
+                if name.endswith('.csv'):
+                    break
+
+        :return: iterator of lines, or of :class:`PsftpEntry`
+        """
+        options = re.sub('[rSt]', '', options) + 'f'
+        if 'l' not in options and 'n' not in options and not entries:
+            options += '1'
+        cmd = self._ls_command(path, options, entries)
+        self.sendline(cmd)
+        data = self.buffer
+        self.buffer = self.string_type()
+        echoed = False
+        error = None
+        done = False
+        try:
+            while True:
+                lines = data.split('\r\n')
+                data = lines.pop()
+                for line in lines:
+                    if not echoed:
+                        echoed = True
+                    elif re.search(psftp._exception_ls_not_found.expect(),
+                                   line):
+                        error = psftp._exception_ls_not_found
+                    elif entries:
+                        entry = PsftpEntry.parse(line)
+                        if entry is not None:
+                            yield entry
+                    elif line.strip():
+                        yield line.strip()
+                if echoed and re.match(self.PROMPT + '$', data):
+                    break
+                data += self.read_nonblocking(self.maxread, self.timeout)
+            done = True
+        finally:
+            if not done and self.isalive():
+                # Stopped early: sftp aborts the listing on an interrupt and
+                # prints the prompt, which keeps the session in step.
+                self.sendintr()
+                self.buffer = data
+                self.prompt()
+        if error is not None:
+            raise error
+
     def lcd(self, path):
         """Change local directory to path
         """
+        if self.local_in_process:
+            return self._lcd_in_process(path)
         cmd = 'lcd %s' % path
         self._exec(cmd, [
             psftp._exception_permission_deined,
             psftp._exception_not_directory,
             psftp._exception_no_such_file])
+        self._chdir('lcd', path)
 
-    def ls(self, path='', options=''):
+    def ls(self, path='', options='', entries=False):
         """Display a remote directory listing of either path or the current
         directory if path is not specified. path may contain glob(3) characters
         and may match multiple files.
@@ -350,22 +902,28 @@ class psftp(spawn):
         -S Sort the listing by file size.
         -t Sort the listing by last modification time.
 
-        :return: lines of output
+        :entries: parse a long listing into :class:`PsftpEntry` records.
+        -l is implied unless -n is given, -h is ignored.
+
+        :return: lines of output, or a list of :class:`PsftpEntry`
         """
-        base_options = '1afhlnrSt'
-        valid_options = self._options(base_options, options)
-        cmd = 'ls %s %s' % (valid_options, path)
+        cmd = self._ls_command(path, options, entries)
+        key = (path, cmd, entries)
+        cached = self._cached_listing(key)
+        if cached is not None:
+            return cached
         self._exec(cmd, [psftp._exception_ls_not_found])
-        output = self._output(self.before, cmd+'\r\n')
-        lines = output.split()
-        lines = [line.strip() for line in lines]
+        lines = self._ls_output(cmd, entries)
+        self._cache_listing(key, lines)
         return lines
 
     def lmkdir(self, path):
         """Create local directory specified by path.
         """
+        if self.local_in_process:
+            return self._lmkdir_in_process(path)
         cmd = 'lmkdir %s' % path
-        self._exec(cmd, [
+        return self._exec(cmd, [
             psftp._exception_permission_deined,
             psftp._exception_file_exists])
 
@@ -378,7 +936,8 @@ class psftp(spawn):
         base_options = 's'
         valid_options = self._options(base_options, options)
         cmd = 'ln %s %s %s' % (valid_options, oldpath, newpath)
-        self._exec(cmd, [
+        self._invalidate(newpath)
+        return self._exec(cmd, [
             psftp._exception_permission_deined,
             psftp._exception_could_not_link,
             psftp._exception_no_such_file])
@@ -386,19 +945,29 @@ class psftp(spawn):
     def lpwd(self):
         """Get local working directory.
         """
+        if self.local_in_process:
+            return self._local_cwd()
         self._exec('lpwd')
         pwd = self.before.strip()
         prefix = 'Local working directory: '
         return self._output(pwd, prefix)
 
-    def lls(self, path='', options=''):
+    def lls(self, path='', options='', entries=False):
         """Display local directory listing of either path or current directory
         if path is not specified. options may contain any flags supported by
         the local system's ls(1) command. path may contain glob(3) characters
         and may match multiple files.
 
-        :returns: lines of output
+        With local_in_process the directory is read in this process and
+        options may contain 'aAdrtS1l' only, see :meth:`_lls_in_process`.
+
+        :entries: with local_in_process, return :class:`PsftpEntry` objects
+        instead of names.
+
+        :returns: lines of output, the names with local_in_process
         """
+        if self.local_in_process:
+            return self._lls_in_process(path, options, entries)
         cmd = 'lls %s %s' % (options, path)
         self._exec(cmd, [
             psftp._exception_invalid_option,
@@ -411,27 +980,83 @@ class psftp(spawn):
     def lumask(self, umask):
         """Set localumask to umask
         """
+        if self.local_in_process:
+            return self._lumask_in_process(umask)
         cmd = 'lumask %s' % str(umask)
-        self._exec(cmd, [psftp._exception_lumask_failed])
+        result = self._exec(cmd, [psftp._exception_lumask_failed])
+        self._record_lumask(umask)
+        return result
 
     def mkdir(self, path):
         """Create remote directory specified by path.
         """
         cmd = 'mkdir %s' % path
-        self._exec(cmd, [
+        self._invalidate(path)
+        return self._exec(cmd, [
             psftp._exception_create_directory_failure,
             psftp._exception_permission_deined])
 
+    def open_remote(self, path, buffer_size=32768, num_requests=16):
+        """Open the remote file path for reading, streaming it instead of
+        downloading it to a local file first. The sftp client can not do
+        that, so the file is read over a second connection speaking the SFTP
+        protocol, which is started by the first call and kept until
+        :meth:`close`.
+
+        The file is seekable and only the blocks read are fetched, so the
+        tail of a log or the footer of a large file costs a few requests.
+        The blocks are kept in block_cache, 32 MiB by default, for the next
+        opens of path until the file changes. Example::
+
+            with s.open_remote('data.parquet') as f:
+                f.seek(-8, io.SEEK_END)
+                footer_length = struct.unpack('<I', f.read(4))[0]
+
+        :buffer_size: bytes per READ request, the block size.
+        :num_requests: READ requests kept in flight ahead of the position
+        while reading sequentially.
+
+        :return: a read-only binary file object, wrap it in
+        io.TextIOWrapper to read text.
+        """
+        from .sftpv3 import RemoteFile, PsftpBlockCache, \
+            ExceptionPsftpStatus, SSH_FX_NO_SUCH_FILE, \
+            SSH_FX_PERMISSION_DENIED
+        path = self._stream_path(path)
+        client = self._protocol_client()
+        if self.block_cache is None:
+            self.block_cache = PsftpBlockCache()
+        try:
+            raw = RemoteFile(client, path, buffer_size, num_requests,
+                             self.block_cache)
+        except ExceptionPsftpStatus as e:
+            if e.code == SSH_FX_NO_SUCH_FILE:
+                raise psftp._exception_file_no_found
+            if e.code == SSH_FX_PERMISSION_DENIED:
+                raise psftp._exception_permission_deined
+            raise
+        return io.BufferedReader(raw, buffer_size)
+
+    def pipeline(self, depth=16):
+        """Collect commands and send them back-to-back on this session instead
+        of waiting for the prompt after each one. See :class:`PsftpPipeline`.
+
+        :depth: the maximum number of commands sent ahead of their prompt.
+        """
+        return PsftpPipeline(self, depth)
+
     def progress(self):
         """Toggle display of progress meter.
         """
-        self._exec('progress')
+        self._meter = not self._meter
+        return self._exec('progress')
 
     def put(
             self,
             local_path,
             remote_path='',
-            options=''):
+            options='',
+            progress=None):
         """Upload local-path and store it on the remote machine. If the remote
         path name is not specified, it is given the same name it has on the
         local machine. local-path may contain glob(3) characters and may match
@@ -449,13 +1074,33 @@ class psftp(spawn):
         -P,-p full file permissions and access times are copied too.
         -r directories will be copied recursively. Note that sftp
         does not follow symbolic links when performing recursive transfers.
+
+        :progress: called with a :class:`PsftpProgress` for every refresh of
+        the progress meter, which is turned on for the transfer.
         """
-        base_options = 'hi'
+        base_options = 'afPpr'
         valid_options = self._options(base_options, options)
         cmd = 'put %s %s %s' % (valid_options, local_path, remote_path)
-        self._exec(cmd, [
-            psftp._exception_permission_deined,
-            psftp._exception_non_regular_file])
+        self._invalidate(
+            remote_path or os.path.basename(os.path.normpath(local_path)))
+        return self._journaled(
+            'put', local_path, remote_path, options,
+            lambda: self._transfer(cmd, progress, [
+                psftp._exception_permission_deined,
+                psftp._exception_non_regular_file]))
+
+    def put_many(self, local_paths, remote_dir='', options=''):
+        """Upload local_paths into remote_dir with as few put commands as
+        possible, see :meth:`get_many`.
+
+        :local_paths: plain local paths, or (local_path, remote_path) tuples
+        which are uploaded on their own.
+        :remote_dir: the remote directory receiving the files.
+        :options: passed on to :meth:`put`.
+
+        :return: list of :class:`PsftpResult` in the order of local_paths.
+        """
+        return self._many('put', local_paths, remote_dir, options)
 
     def pwd(self):
         """Get remote working directory.
@@ -469,46 +1114,58 @@ class psftp(spawn):
         """Rename remote file from oldpath to newpath
         """
         cmd = 'rename %s %s' % (oldpath, newpath)
-        self._exec(cmd, [psftp._exception_no_such_file])
+        self._invalidate(oldpath)
+        self._invalidate(newpath)
+        return self._exec(cmd, [psftp._exception_no_such_file])
 
     def reget(
             self,
             remote_path,
             local_path='',
-            options=''):
+            options='',
+            progress=None):
         """Resume download of remote-path.
         Equivalent to get with the -a flag set.
 
-        :options: every char is one of 'Ppr'.
+        :options: every char is one of 'fPpr'.
+        -f fsync(2) will be called after the file transfer has completed
+        to flush the file to disk.
         -P,-p full file permissions and access times are copied too.
         -r directories will be copied recursively. Note that sftp
         does not follow symbolic links when performing recursive transfers.
+        :progress: see :meth:`get`.
         """
-        base_options = 'hi'
+        base_options = 'fPpr'
         valid_options = self._options(base_options, options)
         cmd = 'reget %s %s %s' % (valid_options, remote_path, local_path)
-        self._exec(cmd, [
+        return self._transfer(cmd, progress, [
             psftp._exception_permission_deined,
             psftp._exception_file_no_found,
             psftp._exception_non_regular_file])
 
     def reput(
             self,
-            remote_path,
-            local_path='',
-            options=''):
+            local_path,
+            remote_path='',
+            options='',
+            progress=None):
         """Resume upload of local_path.
         Equivalent to put with the -a flag set.
 
-        :options: every char is one of '1afhlnrSt'.
+        :options: every char is one of 'fPpr'.
+        -f a request will be send to the server to call fsync(2) after the
+        file has been transferred.
         -P,-p full file permissions and access times are copied too.
         -r directories will be copied recursively. Note that sftp
         does not follow symbolic links when performing recursive transfers.
+        :progress: see :meth:`put`.
         """
-        base_options = 'hi'
+        base_options = 'fPpr'
         valid_options = self._options(base_options, options)
-        cmd = 'put %s %s %s' % (valid_options, local_path, remote_path)
-        self._exec(cmd, [
+        cmd = 'reput %s %s %s' % (valid_options, local_path, remote_path)
+        self._invalidate(
+            remote_path or os.path.basename(os.path.normpath(local_path)))
+        return self._transfer(cmd, progress, [
             psftp._exception_permission_deined,
             psftp._exception_non_regular_file])
 
@@ -516,15 +1173,19 @@ class psftp(spawn):
         """Delete remote file specified by path
         """
         cmd = 'rm %s' % path
-        self._exec(cmd, [
-            psftp._exception_no_such_file,
-            psftp._exception_delete_failure])
+        self._invalidate(path)
+        return self._journaled(
+            'rm', path, '', '',
+            lambda: self._exec(cmd, [
+                psftp._exception_no_such_file,
+                psftp._exception_delete_failure]))
 
     def rmdir(self, path):
         """Remote remote directory specified by path.
         """
         cmd = 'rmdir %s' % path
-        self._exec(cmd, [
+        self._invalidate(path)
+        return self._exec(cmd, [
             psftp._exception_no_such_file,
             psftp._exception_remove_directory_failed])
 
@@ -532,17 +1193,71 @@ class psftp(spawn):
         """Create a symbolic link from oldpath to newpath.
         """
         cmd = 'symlink %s %s' % (oldpath, newpath)
-        self._exec(cmd, [
+        self._invalidate(newpath)
+        return self._exec(cmd, [
             psftp._exception_permission_deined,
             psftp._exception_could_not_link,
             psftp._exception_no_such_file])
 
+    def sync(
+            self,
+            local_dir,
+            remote_dir,
+            direction='put',
+            delete=False,
+            dry_run=False):
+        """Mirror local_dir to remote_dir (direction 'put') or remote_dir to
+        local_dir (direction 'get'), transferring only the files which are
+        new or differ in size or modification time. Transferred files keep
+        their modification time, so an unchanged file is skipped next time.
+        Symbolic links and special files are skipped.
+
+        :delete: remove files and directories which only exist in the
+        destination.
+        :dry_run: only report what would be done.
+
+        :return: list of (action, path) tuples, action is one of 'get',
+        'put', 'mkdir', 'rm' or 'rmdir', path is the destination path.
+        """
+        if direction not in ('put', 'get'):
+            raise ExceptionPsftpLocal('direction must be put or get')
+        report = []
+        if direction == 'put':
+            self._sync_put(local_dir, remote_dir, delete, dry_run, report)
+        else:
+            self._sync_get(local_dir, remote_dir, delete, dry_run, report)
+        return report
+
     def version(self):
         """Display the sftp protocol version.
         """
         self._exec('version')
         return self._output(self.before, 'version\r\n')
 
+    def walk(self, top='.', onerror=None):
+        """Walk the remote tree under top breadth-first like os.walk,
+        yielding a (dirpath, dirs, files) tuple for every directory. dirs
+        and files are lists of :class:`PsftpEntry` named by their base name,
+        dirs are the subdirectories and files everything else, symbolic
+        links are not followed. Removing entries from dirs prunes the walk.
+        See :meth:`PsftpPool.walk` for listing directories concurrently.
+
+        :top: a plain remote path, not quoted.
+        :onerror: called with the exception of a directory that can not be
+        listed, which is skipped. By default such errors are ignored.
+        """
+        waiting = deque([top])
+        while waiting:
+            path = waiting.popleft()
+            try:
+                dirs, files = self._walk_listing(path)
+            except ExceptionPsftpInteraction as e:
+                if onerror is not None:
+                    onerror(e)
+                continue
+            yield path, dirs, files
+            waiting.extend(posixpath.join(path, d.name) for d in dirs)
+
     def local_command(self, command):
         """Execute command in local shell
         """
@@ -551,11 +1266,739 @@ class psftp(spawn):
         return self._output(self.before, cmd+'\r\n')
 
     def _exec(self, cmd, error_and_exceptions=[]):
-        self.sendline(cmd)
+        self._sync_local(cmd)
+        self._timing_send(cmd)
         expect = [ee.expect() for ee in error_and_exceptions] + [self.PROMPT]
-        i = self.expect(expect)
+        try:
+            i = self.expect_list(self._expect_patterns(expect))
+        except (EOF, TIMEOUT) as e:
+            self._timing_done(e)
+            raise
         if i != len(expect)-1:
+            self._timing_done(error_and_exceptions[i])
+            # Consume the prompt following the error, so that the next
+            # command does not match it.
+            self.prompt()
             raise error_and_exceptions[i]
+        missed = self._match_exception(self.before, error_and_exceptions)
+        self._timing_done(missed)
+        if missed is not None:
+            raise missed
+
+    def _transfer(self, cmd, progress, error_and_exceptions):
+        attempt = 0
+        while True:
+            try:
+                return self._transfer_once(cmd, progress,
+                                           error_and_exceptions)
+            except (EOF, TIMEOUT):
+                if attempt >= self.retries:
+                    raise
+            cmd = self._resume_command(cmd)
+            attempt = self._reconnect(attempt)
+
+    def _transfer_once(self, cmd, progress, error_and_exceptions):
+        # Like _exec, also reading the progress meter while the transfer
+        # runs. The meter is only turned on for transfers with a callback,
+        # or with retries, so that a timeout means the link is silent.
+        self._sync_local(cmd)
+        if progress is None and not self._meter and not self.retries:
+            return self._exec(cmd, error_and_exceptions)
+        toggle = not self._meter
+        self._meter_borrowed = False
+        if toggle:
+            self.progress()
+        try:
+            self._timing_send(cmd)
+            expect = [ee.expect() for ee in error_and_exceptions] + [
+                self.PROMPT, PsftpProgress.METER]
+            patterns = self._expect_patterns(expect)
+            missed = None
+            while True:
+                i = self.expect_list(patterns)
+                if i >= len(expect)-2:
+                    missed = missed or self._match_exception(
+                        self.before, error_and_exceptions)
+                if i == len(expect)-1:
+                    self._progress_update(PsftpProgress.parse(self.match),
+                                          progress)
+                    continue
+                if i != len(expect)-2:
+                    self._timing_done(error_and_exceptions[i])
+                    self.prompt()
+                    raise error_and_exceptions[i]
+                self._timing_done(missed)
+                if missed is not None:
+                    raise missed
+                break
+        except (EOF, TIMEOUT) as e:
+            # The session is out of step, leave the meter as it is. A
+            # reconnect turns it back off.
+            self._timing_done(e)
+            self._meter_borrowed = toggle
+            toggle = False
+            raise
+        finally:
+            self._transfer_started = None
+            self._stalled_since = None
+            if toggle and self.isalive():
+                self.progress()
+
+    def _timing_send(self, cmd):
+        if self.metrics is None:
+            return self.sendline(cmd)
+        timing = _PsftpTiming(cmd)
+        self.sendline(cmd)
+        timing.sent = time.time()
+        self._timing = timing
+
+    def _timing_done(self, fired):
+        # fired is the error matched, None for the prompt.
+        timing = self._timing
+        if timing is None:
+            return
+        self._timing = None
+        now = time.time()
+        scanned = len(self.before or '') + len(
+            self.after if isinstance(self.after, (str, bytes)) else '')
+        self.metrics.observe(
+            timing.command,
+            send=timing.sent - timing.started,
+            first_byte=(timing.first_byte - timing.sent
+                        if timing.first_byte is not None else None),
+            prompt=now - timing.sent if fired is None else None,
+            scanned=scanned,
+            outcome=self._timing_outcome(fired))
+
+    @classmethod
+    def _timing_outcome(cls, fired):
+        if fired is None:
+            return 'ok'
+        for name, value in vars(psftp).items():
+            if value is fired and name.startswith('_exception_'):
+                return name[len('_exception_'):]
+        return type(fired).__name__
+
+    def _log(self, s, direction):
+        # Every read of the child passes here, with pexpect's asyncio
+        # support too.
+        if self._timing is not None and direction == 'read':
+            self._timing.received(len(s))
+        super(psftp, self)._log(s, direction)
+
+    def _resume_command(self, cmd):
+        # get -a and put -a are reget and reput.
+        name, rest = cmd.split(' ', 1)
+        if name not in ('get', 'put'):
+            return cmd
+        if rest.startswith('-'):
+            rest = rest[1:]
+        return '%s -a%s' % (name, rest)
+
+    def _reconnect(self, attempt):
+        '''Log in again with the parameters of the last login and replay
+        the cd and lcd commands, the lumask and the progress meter, retrying
+        while attempts are left.
+
+        :return: the number of attempts used.
+        '''
+        chdirs, lumask, meter = self._relogin_state()
+        while True:
+            time.sleep(self.retry_backoff * 2 ** attempt)
+            attempt += 1
+            self._forget_child()
+            try:
+                self._relogin()
+                break
+            except (EOF, TIMEOUT, ExceptionPsftpLocal):
+                if attempt >= self.retries:
+                    raise
+        for name, path in chdirs:
+            getattr(self, name)(path)
+        if lumask is not None:
+            self.lumask('%03o' % lumask)
+        if self._meter != meter:
+            self.progress()
+        self.reconnects += 1
+        return attempt
+
+    def _relogin_state(self):
+        # What a new login forgets: the cd and lcd commands, the lumask, and
+        # the progress meter as the user left it, without the one turned on
+        # for the failed transfer.
+        meter = self._meter != self._meter_borrowed
+        self._meter_borrowed = False
+        return self._chdirs, self._lumask, meter
+
+    def _record_lumask(self, umask):
+        # Replayed by a reconnect and by batch runs.
+        try:
+            self._lumask = int(str(umask), 8)
+        except ValueError:
+            pass
+
+    def _forget_child(self):
+        # pexpect spawns a child once per object, a new login needs the
+        # dead child and its output gone.
+        self.close()
+        self.pid = None
+        self.buffer = self.string_type()
+
+    def _relogin(self):
+        args = self._login_args
+        if 'command' in args:
+            return self.connect(args['command'], args['password'])
+        return self.login(
+            args['server'], args['username'], args['password'],
+            port=args['port'], ssh_key=args['ssh_key'], quiet=args['quiet'],
+            check_local_ip=args['check_local_ip'], **args['tuning'])
+
+    def _chdir(self, name, path):
+        if name == 'lcd':
+            self._lpwd = None
+        else:
+            self._rpwd = None
+        # An absolute path makes the earlier changes of the same directory
+        # irrelevant for the replay.
+        if self._unquote(path).startswith('/'):
+            self._chdirs = [c for c in self._chdirs if c[0] != name]
+        self._chdirs.append((name, path))
+
+    def _journaled(self, op, source, target, options, run):
+        # Only single files have an entry, a glob or a recursive transfer
+        # does not tell which files it moved.
+        journal = self.journal
+        if (journal is None or 'r' in options
+                or re.search(r'[*?\[]', self._unquote(source))):
+            return run()
+        local_path = None
+        if op == 'put':
+            local_path = self._local_path(source)
+        elif op == 'get':
+            local_path = self._local_path(
+                target or posixpath.basename(self._unquote(source)))
+            if os.path.isdir(local_path):
+                local_path = os.path.join(
+                    local_path, posixpath.basename(self._unquote(source)))
+        # Relative paths name other files after a cd or lcd, the entry is
+        # keyed on the absolute ones.
+        if op == 'put':
+            key = (self._journal_host(), op, local_path,
+                   self._remote_path(target))
+        elif op == 'get':
+            key = (self._journal_host(), op, self._remote_path(source),
+                   local_path)
+        else:
+            key = (self._journal_host(), op, self._remote_path(source),
+                   target)
+        if journal.completed(key, local_path):
+            return None
+        journal.record(key, 'started')
+        try:
+            result = run()
+        except Exception:
+            journal.record(key, 'failed')
+            raise
+        journal.record(key, 'done', local_path)
+        return result
+
+    def _journal_host(self):
+        args = getattr(self, '_login_args', {})
+        if 'server' not in args:
+            return 'sftp -D %s' % ' '.join(args.get('command', []))
+        return '%s@%s:%s' % (args['username'], args['server'],
+                             args['port'] or 22)
+
+    def _remote_path(self, path):
+        return posixpath.normpath(posixpath.join(
+            self._remote_cwd(), self._unquote(path)))
+
+    def _remote_cwd(self):
+        # Asked once per cd.
+        if self._rpwd is None:
+            self._rpwd = self.pwd()
+        return self._rpwd
+
+    def _local_path(self, path):
+        path = os.path.expanduser(self._unquote(path))
+        return os.path.normpath(os.path.join(self._local_cwd(), path))
+
+    def _local_cwd(self):
+        # Asked once per lcd, known without asking when the local commands
+        # run in process, unless a pipeline changed it.
+        if self._lpwd is None:
+            local_in_process = self.local_in_process
+            self.local_in_process = False
+            try:
+                self._lpwd = self.lpwd()
+            finally:
+                self.local_in_process = local_in_process
+        return self._lpwd
+
+    # Commands taking local paths, the sftp child has to be in the local
+    # directory of the session when they run.
+    LOCAL_PATH_COMMANDS = ('get', 'put', 'reget', 'reput')
+
+    def _sync_local(self, cmd):
+        # Send the lcd and lumask done in process before a command using
+        # local paths.
+        if self._local_pending and (
+                cmd.startswith('!')
+                or cmd.split(' ', 1)[0] in self.LOCAL_PATH_COMMANDS):
+            self._sync_local_now()
+
+    def _sync_local_now(self):
+        for cmd, errors in self._local_commands():
+            self._exec(cmd, errors)
+
+    def _local_commands(self):
+        pending = self._local_pending
+        self._local_pending = OrderedDict()
+        return [('%s %s' % (name, arg), [
+            psftp._exception_permission_deined,
+            psftp._exception_not_directory,
+            psftp._exception_no_such_file] if name == 'lcd' else [
+            psftp._exception_lumask_failed])
+            for name, arg in pending.items()]
+
+    def _lcd_in_process(self, path):
+        target = os.path.normpath(os.path.join(
+            self._local_cwd(), os.path.expanduser(self._unquote(path))))
+        if not os.path.exists(target):
+            raise psftp._exception_no_such_file
+        if not os.path.isdir(target):
+            raise psftp._exception_not_directory
+        if not os.access(target, os.X_OK):
+            raise psftp._exception_permission_deined
+        self._chdir('lcd', self._quote(target))
+        self._lpwd = target
+        self._local_pending['lcd'] = self._quote(target)
+
+    def _lmkdir_in_process(self, path):
+        target = os.path.join(self._local_cwd(),
+                              os.path.expanduser(self._unquote(path)))
+        try:
+            os.mkdir(target)
+            if self._lumask is not None:
+                os.chmod(target, 0o777 & ~self._lumask)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                raise psftp._exception_file_exists
+            if e.errno == errno.EACCES:
+                raise psftp._exception_permission_deined
+            raise ExceptionPsftpLocal(str(e))
+
+    def _lumask_in_process(self, umask):
+        try:
+            value = int(str(umask), 8)
+        except ValueError:
+            raise psftp._exception_lumask_failed
+        if not 0 <= value <= 0o777:
+            raise psftp._exception_lumask_failed
+        self._lumask = value
+        self._local_pending['lumask'] = '%03o' % value
+
+    def _lls_in_process(self, path, options, entries):
+        '''List local files like lls. options: 'a' and 'A' list the dot
+        files, 'a' with . and .., 'd' lists directories themselves instead
+        of their content, 't' sorts by modification time and 'S' by size,
+        newest and largest first, 'r' reverses the order. '1' and 'l' are
+        accepted and change nothing.
+        '''
+        if any(c not in '-aAdrtS1l' for c in options.replace(' ', '')):
+            raise psftp._exception_invalid_option
+        cwd = self._local_cwd()
+        pattern = os.path.expanduser(self._unquote(path))
+        full = os.path.join(cwd, pattern)
+        if glob.has_magic(pattern):
+            matches = sorted(glob.glob(full))
+        else:
+            matches = [full] if os.path.lexists(full) else []
+        if not matches:
+            raise psftp._exception_no_such_file
+        several = len(matches) > 1 or glob.has_magic(pattern)
+        listed = []
+        for match in matches:
+            shown = match if os.path.isabs(pattern) else os.path.relpath(
+                match, cwd)
+            if 'd' in options or not os.path.isdir(match):
+                listed.append((shown, match))
+                continue
+            prefix = shown if several else ''
+            if 'a' in options:
+                listed += [(os.path.join(prefix, n), os.path.join(match, n))
+                           for n in ('.', '..')]
+            listed += [(os.path.join(prefix, e.name), e.path)
+                       for e in _scandir(match)
+                       if 'a' in options or 'A' in options
+                       or not e.name.startswith('.')]
+        stats = {}
+        if entries or 't' in options or 'S' in options:
+            stats = dict((p, os.lstat(p)) for _, p in listed)
+        listed.sort()
+        if 't' in options:
+            listed.sort(key=lambda n: stats[n[1]].st_mtime, reverse=True)
+        elif 'S' in options:
+            listed.sort(key=lambda n: stats[n[1]].st_size, reverse=True)
+        if 'r' in options:
+            listed.reverse()
+        if not entries:
+            return [name for name, _ in listed]
+        return [self._local_entry(name, p, stats[p]) for name, p in listed]
+
+    def _local_entry(self, name, path, st):
+        try:
+            owner = pwd.getpwuid(st.st_uid).pw_name
+        except KeyError:
+            owner = str(st.st_uid)
+        try:
+            group = grp.getgrgid(st.st_gid).gr_name
+        except KeyError:
+            group = str(st.st_gid)
+        target = os.readlink(path) if stat.S_ISLNK(st.st_mode) else None
+        return PsftpEntry(name, st.st_mode, st.st_nlink, owner, group,
+                          st.st_size, int(st.st_mtime), target)
+
+    def _progress_update(self, update, progress):
+        now = time.time()
+        if self._transfer_started is None:
+            self._transfer_started = now
+        if not update.stalled:
+            self._stalled_since = None
+        elif self._stalled_since is None:
+            self._stalled_since = now
+        elif self.retries and now - self._stalled_since > self.timeout:
+            # The meter keeps refreshing while nothing moves.
+            raise TIMEOUT('transfer stalled for %d seconds'
+                          % (now - self._stalled_since))
+        if update.stalled:
+            self.transfer_stats.stalls += 1
+        if update.done:
+            self.transfer_stats.transfers += 1
+            self.transfer_stats.bytes += update.bytes
+            self.transfer_stats.seconds += now - self._transfer_started
+            self._transfer_started = None
+        if progress is not None:
+            progress(update)
+
+    def _many(self, name, paths, target, options):
+        if name == 'get':
+            split, join = posixpath.split, posixpath.join
+        else:
+            split, join = os.path.split, os.path.join
+        results = [None] * len(paths)
+        target = self._escape(target)
+        groups = OrderedDict()
+        for index, path in enumerate(paths):
+            if isinstance(path, tuple):
+                results[index] = self._many_one(name, path[0],
+                                                self._escape(path[1]),
+                                                options)
+                continue
+            directory, base = split(path)
+            groups.setdefault(directory, {}).setdefault(base, []).append(
+                index)
+        for directory, wanted in groups.items():
+            listed = self._many_listing(name, directory)
+            files = sorted(base for base in wanted
+                           if listed.get(base) and '/' not in base)
+            for base in wanted:
+                if base not in files:
+                    result = self._many_one(name, join(directory, base),
+                                            target, options)
+                    for index in wanted[base]:
+                        results[index] = result
+            for pattern, bases in self._many_patterns(files,
+                                                      sorted(listed)):
+                source = self._escape(join(directory, '')) + pattern
+                try:
+                    getattr(self, name)(source, target, options)
+                except ExceptionPsftpInteraction:
+                    group = [(base, self._many_one(
+                        name, join(directory, base), target, options))
+                        for base in bases]
+                else:
+                    result = PsftpResult(
+                        '%s %s %s' % (name, source, target), self.before)
+                    group = [(base, result) for base in bases]
+                for base, result in group:
+                    for index in wanted[base]:
+                        results[index] = result
+        return results
+
+    def _many_one(self, name, source, target, options):
+        cmd = '%s %s %s' % (name, source, target)
+        try:
+            getattr(self, name)(self._escape(source), target, options)
+        except ExceptionPsftpInteraction as e:
+            return PsftpResult(cmd, None, e)
+        return PsftpResult(cmd, self.before)
+
+    def _many_listing(self, name, directory):
+        # Names of the source directory, mapped to whether they are regular
+        # files that a glob can fetch.
+        try:
+            if name == 'get':
+                return dict((base, e.is_file()) for base, e in
+                            self._sync_listing(directory or '.').items())
+            if not os.path.isabs(directory):
+                directory = os.path.join(self.lpwd(), directory)
+            return dict((e.name, e.is_file(follow_symlinks=False))
+                        for e in _scandir(directory))
+        except (ExceptionPsftpInteraction, OSError):
+            return {}
+
+    def _many_patterns(self, wanted, listed):
+        # Cover the sorted names by patterns made of their common prefix,
+        # '*' and their common suffix, possibly with a class for the first
+        # differing character. Names are split by that character until such
+        # a pattern matches exactly the wanted ones among the listed names.
+        # listed is sorted, only its slice sharing the prefix is passed on,
+        # so every level scans its own candidates only.
+        if len(wanted) == 1:
+            return [(self._escape(wanted[0]), wanted)]
+        wanted_set = set(wanted)
+        prefix = os.path.commonprefix(wanted)
+        listed = self._many_candidates(listed, prefix)
+        rest = [base[len(prefix):] for base in wanted]
+        suffix = os.path.commonprefix([r[::-1] for r in rest])[::-1]
+        if self._many_match(listed, prefix, '', suffix) == wanted_set:
+            return [(self._escape(prefix) + '*' + self._escape(suffix),
+                     wanted)]
+        chars = ''.join(sorted(set(r[:1] for r in rest)))
+        if (all(rest) and not re.search(r'[\s\\"\'*?\[\]!^-]', chars)
+                and (prefix or '.' not in chars)):
+            suffix = os.path.commonprefix([r[:0:-1] for r in rest])[::-1]
+            if self._many_match(listed, prefix, chars, suffix) == wanted_set:
+                return [(self._escape(prefix) + '[%s]*' % chars
+                         + self._escape(suffix), wanted)]
+        groups = OrderedDict()
+        for base, r in zip(wanted, rest):
+            groups.setdefault(r[:1], []).append(base)
+        patterns = []
+        for group in groups.values():
+            patterns.extend(self._many_patterns(group, listed))
+        return patterns
+
+    def _many_candidates(self, listed, prefix):
+        # The slice of the sorted names starting with prefix.
+        if not prefix:
+            return listed
+        lo = bisect.bisect_left(listed, prefix)
+        hi = bisect.bisect_left(
+            listed, prefix[:-1] + chr(ord(prefix[-1]) + 1), lo)
+        return listed[lo:hi]
+
+    def _many_match(self, listed, prefix, chars, suffix):
+        # The listed names glob(3) matches with the pattern built by
+        # _many_patterns, a leading '.' has to be matched literally.
+        size = len(prefix) + len(suffix) + (1 if chars else 0)
+        return set(
+            base for base in listed
+            if base.startswith(prefix) and base.endswith(suffix)
+            and len(base) >= size
+            and (not chars or base[len(prefix)] in chars)
+            and (prefix.startswith('.') or not base.startswith('.')))
+
+    def _sync_put(self, local_dir, remote_dir, delete, dry_run, report,
+                  listed=True):
+        remote = {}
+        if listed:
+            try:
+                remote = self._sync_listing(remote_dir)
+            except ExceptionPsftpInteraction:
+                listed = False
+        if not listed:
+            report.append(('mkdir', remote_dir))
+            if not dry_run:
+                self.mkdir(self._quote(remote_dir))
+        for entry in sorted(_scandir(local_dir), key=lambda e: e.name):
+            remote_path = posixpath.join(remote_dir, entry.name)
+            r = remote.pop(entry.name, None)
+            if entry.is_dir(follow_symlinks=False):
+                if r is not None and not r.is_dir():
+                    self._sync_remove_remote(remote_path, r, dry_run, report)
+                    r = None
+                self._sync_put(entry.path, remote_path, delete, dry_run,
+                               report, r is not None)
+            elif entry.is_file(follow_symlinks=False):
+                st = entry.stat(follow_symlinks=False)
+                if r is not None and r.is_dir():
+                    self._sync_remove_remote(remote_path, r, dry_run, report)
+                    r = None
+                if r is None or self._sync_changed(st, r):
+                    report.append(('put', remote_path))
+                    if not dry_run:
+                        self.put(self._quote(entry.path),
+                                 self._quote(remote_path), 'p')
+        if delete:
+            for name in sorted(remote):
+                self._sync_remove_remote(posixpath.join(remote_dir, name),
+                                         remote[name], dry_run, report)
+
+    def _sync_get(self, local_dir, remote_dir, delete, dry_run, report):
+        local = {}
+        if os.path.isdir(local_dir):
+            local = dict((e.name, e) for e in _scandir(local_dir))
+        else:
+            report.append(('mkdir', local_dir))
+            if not dry_run:
+                os.makedirs(local_dir)
+        remote = self._sync_listing(remote_dir)
+        for name in sorted(remote):
+            r = remote[name]
+            local_path = os.path.join(local_dir, name)
+            entry = local.pop(name, None)
+            if r.is_dir():
+                if entry is not None and not entry.is_dir(
+                        follow_symlinks=False):
+                    self._sync_remove_local(local_path, dry_run, report)
+                self._sync_get(local_path, posixpath.join(remote_dir, name),
+                               delete, dry_run, report)
+            elif r.is_file():
+                if entry is not None and entry.is_dir(follow_symlinks=False):
+                    self._sync_remove_local(local_path, dry_run, report)
+                    entry = None
+                if (entry is None or self._sync_changed(
+                        entry.stat(follow_symlinks=False), r)):
+                    report.append(('get', local_path))
+                    if not dry_run:
+                        self.get(self._quote(posixpath.join(remote_dir, name)),
+                                 self._quote(local_path), 'p')
+        if delete:
+            for name in sorted(local):
+                self._sync_remove_local(os.path.join(local_dir, name),
+                                        dry_run, report)
+
+    def _sync_listing(self, remote_dir):
+        # Names are listed with the path of the directory in front.
+        entries = self.ls(self._quote(remote_dir), 'na', entries=True)
+        entries = [(posixpath.basename(e.name), e) for e in entries]
+        return dict((name, e) for name, e in entries
+                    if name not in ('.', '..'))
+
+    def _walk_listing(self, path):
+        dirs, files = [], []
+        for name, e in sorted(self._sync_listing(path).items()):
+            entry = PsftpEntry(name, e.mode, e.nlink, e.owner, e.group,
+                               e.size, e.mtime, e.target)
+            (dirs if entry.is_dir() else files).append(entry)
+        return dirs, files
+
+    def _sync_changed(self, st, entry):
+        # Listings show minutes, or only the day for files older than six
+        # months.
+        resolution = 60
+        if time.time() - entry.mtime > 180 * 86400:
+            resolution = 86400
+        return (st.st_size != entry.size
+                or not 0 <= int(st.st_mtime) - entry.mtime < resolution)
+
+    def _sync_remove_remote(self, remote_path, entry, dry_run, report):
+        if entry.is_dir():
+            for name, child in self._sync_listing(remote_path).items():
+                self._sync_remove_remote(posixpath.join(remote_path, name),
+                                         child, dry_run, report)
+            report.append(('rmdir', remote_path))
+            if not dry_run:
+                self.rmdir(self._quote(remote_path))
+        else:
+            report.append(('rm', remote_path))
+            if not dry_run:
+                self.rm(self._quote(remote_path))
+
+    def _sync_remove_local(self, local_path, dry_run, report):
+        if os.path.isdir(local_path) and not os.path.islink(local_path):
+            for name in os.listdir(local_path):
+                self._sync_remove_local(os.path.join(local_path, name),
+                                        dry_run, report)
+            report.append(('rmdir', local_path))
+            if not dry_run:
+                os.rmdir(local_path)
+        else:
+            report.append(('rm', local_path))
+            if not dry_run:
+                os.remove(local_path)
+
+    def _df_output(self):
+        output = self._output(self.before, '\r\n')
+        lines = output.split('\r\n')
+        if len(lines) < 2:
+            return (None, None)
+        title = lines[0].split()
+        value = lines[1].split()
+        return (title, value)
+
+    def _ls_command(self, path, options, entries):
+        base_options = '1afhlnrSt'
+        if entries:
+            options = options.replace('h', '')
+            if 'n' not in options:
+                options += 'l'
+        valid_options = self._options(base_options, options)
+        return 'ls %s %s' % (valid_options, path)
+
+    def _ls_output(self, cmd, entries):
+        output = self._output(self.before, cmd+'\r\n')
+        if entries:
+            lines = [PsftpEntry.parse(line) for line in output.splitlines()]
+            return [line for line in lines if line is not None]
+        lines = output.split()
+        return [line.strip() for line in lines]
+
+    def _cached_listing(self, key):
+        if not self.listing_ttl or key not in self._listings:
+            return None
+        expires, lines = self._listings.pop(key)
+        if expires < time.time():
+            return None
+        self._listings[key] = (expires, lines)
+        return list(lines)
+
+    def _cache_listing(self, key, lines):
+        if not self.listing_ttl:
+            return
+        self._listings.pop(key, None)
+        self._listings[key] = (time.time() + self.listing_ttl, list(lines))
+        while len(self._listings) > self.listing_cache_size:
+            self._listings.popitem(last=False)
+
+    def _invalidate(self, path):
+        """Drop the cached listings which may show path: the path itself, its
+        parent and everything below it. Relative and absolute paths can't be
+        compared, neither can globs, so those listings are dropped too.
+        """
+        if not self._listings:
+            return
+        path = posixpath.normpath(self._unquote(path) or '.')
+        parent = posixpath.dirname(path) or '.'
+        glob = re.search(r'[*?[]', path) is not None
+        for key in list(self._listings):
+            listed = posixpath.normpath(self._unquote(key[0]) or '.')
+            if (glob or re.search(r'[*?[]', listed)
+                    or listed.startswith('/') != path.startswith('/')
+                    or listed in (path, parent)
+                    or listed.startswith(path.rstrip('/') + '/')):
+                del self._listings[key]
+
+    def _invalidate_relative(self):
+        for key in list(self._listings):
+            if not self._unquote(key[0]).startswith('/'):
+                del self._listings[key]
+
+    def _match_exception(self, output, error_and_exceptions):
+        for ee in error_and_exceptions:
+            if re.search(ee.expect(), output):
+                return ee
+        return None
+
+    def _expect_patterns(self, patterns):
+        key = tuple(patterns)
+        compiled = self._patterns.get(key)
+        if compiled is None:
+            compiled = self.compile_pattern_list(patterns)
+            self._patterns[key] = compiled
+        return compiled
 
     def _output(self, raw, prefix):
         raw.strip()
@@ -568,6 +2011,18 @@ class psftp(spawn):
         valid_options = ''.join(c for c in options if c in base_options)
         return '-' + valid_options if valid_options else ''
 
+    def _quote(self, path):
+        return '"%s"' % path.replace('\\', '\\\\').replace('"', '\\"')
+
+    def _escape(self, path):
+        # Backslashes keep glob characters and blanks literal outside quotes.
+        return re.sub(r'([\\\s"\'*?\[\]])', r'\\\1', path)
+
+    def _unquote(self, path):
+        if len(path) < 2 or path[0] != '"' or path[-1] != '"':
+            return path
+        return re.sub(r'\\(.)', r'\1', path[1:-1])
+
     @classmethod
     def _interaction_exception(cls, error):
         return ExceptionPsftpInteraction(
@@ -621,8 +2076,540 @@ class psftp(spawn):
         'ls: invalid option',
         'ls: invalid option'
     )
+    _exception_copy_unsupported = ExceptionPsftpInteraction(
+        'Server does not support copy-data extension',
+        'Server does not support copy-data extension'
+    )
+    _exception_invalid_command = ExceptionPsftpInteraction(
+        'Invalid command.',
+        r'Invalid command\.'
+    )
+    # The sftp clients with cp word their errors like this.
+    _exception_copy_no_such_file = ExceptionPsftpInteraction(
+        'No such file or directory',
+        'stat remote: No such file or directory'
+    )
+    _exception_non_regular_copy = ExceptionPsftpInteraction(
+        'Cannot copy non-regular file',
+        'Cannot copy non-regular file'
+    )
+    _exception_copy_failure = ExceptionPsftpInteraction(
+        "Couldn't copy file",
+        "(?:Couldn't copy file)|(?:remote open\\(.*\\): Failure)"
+    )
     _exception_lumask_failed = ExceptionPsftpInteraction(
         'You must supply a numeric argument to the lumask command.',
         'You must supply a numeric argument to the lumask command.'
     )
 
+
+def _scandir(path):
+    with os.scandir(path) as entries:
+        return list(entries)
+
+
+class PsftpResult(object):
+    '''Outcome of one command run as part of a batch or a pipeline.
+
+    :cmd: the sftp command line.
+    :before: the output of the command, None if it was never executed.
+    :exception: the exception detected for the command, or None.
+    :value: what the method returned, for the operations of
+    :func:`fanout.fanout`.
+    '''
+    __slots__ = ('cmd', 'before', 'exception', 'value')
+
+    def __init__(self, cmd, before=None, exception=None, value=None):
+        self.cmd = cmd
+        self.before = before
+        self.exception = exception
+        self.value = value
+
+    @property
+    def ok(self):
+        return self.exception is None
+
+    def __repr__(self):
+        return '<PsftpResult %r ok=%s>' % (self.cmd, self.ok)
+
+
+class PsftpEntry(object):
+    '''One entry of a long directory listing.
+
+    :name: the file name as listed, a path when a glob was listed.
+    :mode: the st_mode bits parsed from the permission string.
+    :nlink, owner, group, size: as listed, owner and group are strings and
+    nlink is None when the server does not report it.
+    :mtime: modification time in seconds since the epoch. The listing has a
+    resolution of one minute, or one day for files older than six months.
+    :target: the target of a symbolic link, otherwise None.
+    '''
+    __slots__ = ('name', 'mode', 'nlink', 'owner', 'group', 'size', 'mtime',
+                 'target')
+
+    _TYPES = {'-': stat.S_IFREG, 'd': stat.S_IFDIR, 'l': stat.S_IFLNK,
+              'c': stat.S_IFCHR, 'b': stat.S_IFBLK, 'p': stat.S_IFIFO,
+              's': stat.S_IFSOCK}
+    _MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep',
+               'Oct', 'Nov', 'Dec')
+
+    def __init__(self, name, mode, nlink, owner, group, size, mtime,
+                 target=None):
+        self.name = name
+        self.mode = mode
+        self.nlink = nlink
+        self.owner = owner
+        self.group = group
+        self.size = size
+        self.mtime = mtime
+        self.target = target
+
+    def is_dir(self):
+        return stat.S_ISDIR(self.mode)
+
+    def is_file(self):
+        return stat.S_ISREG(self.mode)
+
+    def is_link(self):
+        return stat.S_ISLNK(self.mode)
+
+    def __repr__(self):
+        return '<PsftpEntry %r mode=%o size=%d>' % (
+            self.name, self.mode, self.size)
+
+    @classmethod
+    def parse(cls, line):
+        """Parse one line of ``ls -l`` or ``ls -n`` output.
+
+        :return: a PsftpEntry, or None if line is not a listing line.
+        """
+        fields = line.strip().split(None, 8)
+        if (len(fields) != 9 or len(fields[0]) < 10
+                or fields[0][0] not in cls._TYPES):
+            return None
+        perms, nlink, owner, group, size = fields[:5]
+        try:
+            mode = cls._parse_mode(perms)
+            mtime = cls._parse_mtime(fields[5:8])
+            size = int(size)
+        except ValueError:
+            return None
+        # Clients print '?' when the server does not report the link count.
+        nlink = int(nlink) if nlink.isdigit() else None
+        name, target = fields[8], None
+        if stat.S_ISLNK(mode) and ' -> ' in name:
+            name, target = name.split(' -> ', 1)
+        return cls(name, mode, nlink, owner, group, size, mtime, target)
+
+    @classmethod
+    def _parse_mode(cls, perms):
+        mode = cls._TYPES[perms[0]]
+        for i, c in enumerate(perms[1:10]):
+            if c not in '-rwxsStT':
+                raise ValueError(perms)
+            if c in 'rwxst':
+                mode |= 0o400 >> i
+        if perms[3] in 'sS':
+            mode |= stat.S_ISUID
+        if perms[6] in 'sS':
+            mode |= stat.S_ISGID
+        if perms[9] in 'tT':
+            mode |= stat.S_ISVTX
+        return mode
+
+    @classmethod
+    def _parse_mtime(cls, fields):
+        # Either "Oct 17 03:46" or "17 Oct 03:46", with a year instead of
+        # the time for files older than six months.
+        if fields[0] in cls._MONTHS:
+            month, day, last = fields
+        else:
+            day, month, last = fields
+        month = cls._MONTHS.index(month) + 1
+        day = int(day)
+        now = time.localtime()
+        if ':' in last:
+            hour, minute = [int(v) for v in last.split(':')]
+            mtime = time.mktime(
+                (now.tm_year, month, day, hour, minute, 0, 0, 0, -1))
+            if mtime > time.time() + 86400:
+                mtime = time.mktime(
+                    (now.tm_year - 1, month, day, hour, minute, 0, 0, 0, -1))
+        else:
+            mtime = time.mktime((int(last), month, day, 0, 0, 0, 0, 0, -1))
+        return int(mtime)
+
+
+class PsftpProgress(object):
+    '''One update of the progress of a file transfer.
+
+    :name: the file name shown by the progress meter, it may be truncated.
+    :percent: percent of the file transferred.
+    :bytes: bytes transferred, accurate to the unit the meter prints.
+    :rate: transfer rate in bytes per second.
+    :eta: estimated seconds left, None when unknown.
+    :stalled: True when nothing was transferred for a few seconds.
+    :done: True for the last update of the file.
+    '''
+    __slots__ = ('name', 'percent', 'bytes', 'rate', 'eta', 'stalled', 'done')
+
+    # One refresh of the sftp progress meter. Updates start with a carriage
+    # return and end with the ETA, the last one ends with a newline.
+    METER = (r'\r(?P<name>[^\r\n]*?) +(?P<percent>\d+)% +'
+             r'(?P<size>\d+)(?P<size_unit>[KMGTP]B| ) *'
+             r'(?P<rate>\d+(?:\.\d+)?)(?P<rate_unit>[KMGTP]?)B?/s +'
+             r'(?:(?P<stalled>- stalled -)|(?P<eta>[\d:-]+)(?: ETA| *\r\n))')
+
+    _UNITS = ' KMGTP'
+
+    def __init__(self, name, percent, bytes, rate, eta=None, stalled=False,
+                 done=False):
+        self.name = name
+        self.percent = percent
+        self.bytes = bytes
+        self.rate = rate
+        self.eta = eta
+        self.stalled = stalled
+        self.done = done
+
+    def __repr__(self):
+        return '<PsftpProgress %r %d%% %d bytes>' % (
+            self.name, self.percent, self.bytes)
+
+    @classmethod
+    def parse(cls, match):
+        """Build a PsftpProgress from a match of :attr:`METER`.
+        """
+        size = int(match.group('size')) * cls._scale(match.group('size_unit'))
+        rate = float(match.group('rate')) * cls._scale(
+            match.group('rate_unit'))
+        stalled = match.group('stalled') is not None
+        done = not stalled and not match.group(0).endswith('ETA')
+        eta = None
+        if done:
+            eta = 0
+        elif not stalled and '-' not in match.group('eta'):
+            eta = 0
+            for part in match.group('eta').split(':'):
+                eta = eta * 60 + int(part)
+        return cls(match.group('name').strip(), int(match.group('percent')),
+                   size, rate, eta, stalled, done)
+
+    @classmethod
+    def _scale(cls, unit):
+        unit = unit.strip()[:1]
+        return 1024 ** cls._UNITS.index(unit) if unit else 1
+
+
+class PsftpTransferStats(object):
+    '''Throughput of the transfers of one session, counted from the progress
+    updates.
+
+    :transfers: number of files transferred.
+    :bytes: bytes transferred.
+    :seconds: time spent transferring them.
+    :stalls: progress updates that reported a stalled transfer.
+    '''
+    __slots__ = ('transfers', 'bytes', 'seconds', 'stalls')
+
+    def __init__(self):
+        self.transfers = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.stalls = 0
+
+    @property
+    def rate(self):
+        '''Average transfer rate in bytes per second.
+        '''
+        return self.bytes / self.seconds if self.seconds else 0.0
+
+    def __repr__(self):
+        return '<PsftpTransferStats %d transfers %d bytes %.0f B/s>' % (
+            self.transfers, self.bytes, self.rate)
+
+
+class _PsftpTiming(object):
+    '''Timestamps of the command being executed, see :meth:`psftp._exec`.
+    '''
+    __slots__ = ('command', 'started', 'sent', 'first_byte', 'echo')
+
+    def __init__(self, cmd):
+        self.command = '!' if cmd.startswith('!') else cmd.split(' ', 1)[0]
+        self.started = time.time()
+        self.sent = None
+        self.first_byte = None
+        # The echo of the command line comes from the local terminal.
+        self.echo = len(cmd) + 2
+
+    def received(self, size):
+        if self.first_byte is None:
+            self.echo -= size
+            if self.echo < 0:
+                self.first_byte = time.time()
+
+
+class _PsftpQueue(object):
+    '''Records the commands issued through the psftp command methods instead
+    of executing them, subclasses execute them in run().
+    '''
+    COMMANDS = ('cd', 'chgrp', 'chmod', 'get', 'lcd', 'lmkdir', 'ln',
+                'lumask', 'mkdir', 'put', 'rename', 'reget', 'reput', 'rm',
+                'rmdir', 'symlink')
+
+    # The local commands are queued like the others.
+    local_in_process = False
+
+    def __init__(self, sftp):
+        self.sftp = sftp
+        self.commands = []
+        self.results = []
+
+    def __getattr__(self, name):
+        if name not in self.COMMANDS:
+            raise AttributeError(name)
+        method = psftp.__dict__[name]
+
+        def queue(*args, **kwargs):
+            method(self, *args, **kwargs)
+        return queue
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.run()
+
+    def __len__(self):
+        return len(self.commands)
+
+    def _exec(self, cmd, error_and_exceptions=[]):
+        self.commands.append((cmd, error_and_exceptions))
+
+    def _transfer(self, cmd, progress, error_and_exceptions):
+        if progress is not None:
+            raise ExceptionPsftpLocal(
+                'progress callbacks can not be queued')
+        self._exec(cmd, error_and_exceptions)
+
+    def _invalidate(self, path):
+        self.sftp._invalidate(path)
+
+    def _invalidate_relative(self):
+        self.sftp._invalidate_relative()
+
+    def _chdir(self, name, path):
+        pass
+
+    def _record_lumask(self, umask):
+        pass
+
+    def _journaled(self, op, source, target, options, run):
+        # The outcome of a queued command is not known yet.
+        return run()
+
+    _options = psftp.__dict__['_options']
+
+
+class PsftpBatch(_PsftpQueue):
+    '''Runs the queued commands as one ``sftp -b`` batch file. The batch
+    is executed by a separate sftp child, logged in with the parameters of
+    the owning session and started in its remote and local working
+    directories. Only commands without output can be queued.
+
+    Every command gets a :class:`PsftpResult` in :attr:`results`, with the
+    exception detected by the same patterns :meth:`psftp._exec` uses. When
+    errors are not ignored, the first failing command aborts the batch and
+    the commands after it are reported as not executed.
+
+    Example::
+
+        with s.batch() as b:
+            b.chmod(644, 'a.txt')
+            b.rm('b.txt')
+        for result in b.results:
+            if not result.ok:
+                print(result.cmd, result.exception)
+    '''
+
+    def __init__(self, sftp, ignore_errors=True, timeout=None):
+        super(PsftpBatch, self).__init__(sftp)
+        self.ignore_errors = ignore_errors
+        self.timeout = timeout
+
+    def run(self):
+        """Execute the queued commands.
+
+        :return: list of :class:`PsftpResult`, one per queued command.
+        """
+        login_args = getattr(self.sftp, '_login_args', None)
+        if login_args is None:
+            raise ExceptionPsftpLocal('not logged in')
+        setup = ['cd %s' % self.sftp._quote(self.sftp.pwd()),
+                 'lcd %s' % self.sftp._quote(self.sftp.lpwd())]
+        if self.sftp._lumask is not None:
+            setup.append('lumask %03o' % self.sftp._lumask)
+        prefix = '-' if self.ignore_errors else ''
+
+        fd, batchfile = tempfile.mkstemp(prefix='psftp-', suffix='.batch')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                for cmd in setup:
+                    f.write(cmd + '\n')
+                for cmd, _ in self.commands:
+                    f.write(prefix + cmd + '\n')
+            output, status = self._spawn_batch(login_args, batchfile)
+        finally:
+            os.remove(batchfile)
+
+        # sftp echoes every command of a batch file behind the prompt.
+        echoed = re.split(r'(?m)^sftp> ', output)[1:]
+        self.results = []
+        for i, (cmd, error_and_exceptions) in enumerate(self.commands):
+            index = i + len(setup)
+            if index >= len(echoed):
+                self.results.append(PsftpResult(
+                    cmd, None, ExceptionPsftpLocal('command not executed')))
+                continue
+            before = echoed[index]
+            before = before[before.find('\n')+1:]
+            exception = self.sftp._match_exception(
+                before, error_and_exceptions)
+            self.results.append(PsftpResult(cmd, before, exception))
+
+        executed = [r for r in self.results if r.before is not None]
+        if (status and not self.ignore_errors and executed
+                and executed[-1].ok):
+            executed[-1].exception = ExceptionPsftpLocal('command failed')
+        return self.results
+
+    def _spawn_batch(self, login_args, batchfile):
+        if 'command' in login_args:
+            cmd = self.sftp._direct_command(login_args['command'], batchfile)
+        else:
+            cmd = self.sftp._command(
+                login_args['server'],
+                login_args['username'],
+                login_args['port'],
+                login_args['ssh_key'],
+                login_args['quiet'],
+                login_args['check_local_ip'],
+                batchfile=batchfile,
+                tuning=login_args['tuning'])
+        child = spawn(
+            cmd,
+            timeout=self.timeout,
+            maxread=self.sftp.maxread,
+            searchwindowsize=self.sftp.searchwindowsize,
+            encoding=self.sftp.encoding,
+            codec_errors=self.sftp.codec_errors)
+
+        # Authentication prompts can only show up before the first command
+        # is echoed, afterwards the output belongs to the commands.
+        phase_expect = [
+            "(?i)are you sure you want to continue connecting",
+            "(?i)(?:password)|(?:passphrase for key)",
+            r"(?m)^sftp> ",
+            EOF]
+        output = ''
+        password_sent = False
+        while True:
+            i = child.expect(phase_expect)
+            if i == 0:
+                child.sendline("yes")
+            elif i == 1:
+                if password_sent:
+                    child.close()
+                    raise ExceptionPsftpLocal('permission denied')
+                password_sent = True
+                child.sendline(login_args['password'])
+            elif i == 2:
+                output = child.after
+                child.expect(EOF)
+                output += child.before
+                break
+            else:
+                output = child.before
+                break
+        child.close()
+        return output, child.exitstatus
+
+
+class PsftpPipeline(_PsftpQueue):
+    '''Sends the queued commands on the owning session without waiting for
+    the prompt in between, keeping at most depth commands in flight. The
+    output is split at the prompts, so every command gets its own
+    :class:`PsftpResult` with the exception detected by the same patterns
+    :meth:`psftp._exec` uses. Only commands without output can be queued.
+
+    Iterating over the pipeline yields the results as they arrive. Leaving
+    a with block runs the commands that were not run yet.
+
+    Example::
+
+        p = s.pipeline()
+        for path in paths:
+            p.chmod(644, path)
+        for result in p:
+            if not result.ok:
+                print(result.cmd, result.exception)
+    '''
+
+    def __init__(self, sftp, depth=16):
+        super(PsftpPipeline, self).__init__(sftp)
+        if depth < 1:
+            raise ExceptionPsftpLocal('pipeline depth must be positive')
+        self.depth = depth
+        self._next = 0
+
+    def __iter__(self):
+        # The pty input buffer is small, so the commands are sent as the
+        # prompts come back instead of all at once.
+        pending = deque()
+        self.sftp._sync_local_now()
+        try:
+            while True:
+                while (len(pending) < self.depth
+                       and self._next < len(self.commands)):
+                    cmd, error_and_exceptions = self.commands[self._next]
+                    self._next += 1
+                    self.sftp.sendline(cmd)
+                    pending.append((cmd, error_and_exceptions))
+                if not pending:
+                    break
+                yield self._receive(pending.popleft())
+        finally:
+            # Keep the session in step with its prompts when the consumer
+            # stops early.
+            while pending:
+                self._receive(pending.popleft())
+
+    def _chdir(self, name, path):
+        # The commands run on the owning session.
+        self.sftp._chdir(name, path)
+
+    def _record_lumask(self, umask):
+        self.sftp._record_lumask(umask)
+
+    def _receive(self, command):
+        cmd, error_and_exceptions = command
+        # Several prompts may arrive in one read, the window would skip all
+        # but the last ones.
+        self.sftp.expect_list(self.sftp._expect_patterns([self.sftp.PROMPT]),
+                              searchwindowsize=None)
+        before = self.sftp.before
+        before = before[before.find('\n')+1:]
+        exception = self.sftp._match_exception(before, error_and_exceptions)
+        result = PsftpResult(cmd, before, exception)
+        self.results.append(result)
+        return result
+
+    def run(self):
+        """Execute the queued commands that were not run yet.
+
+        :return: list of :class:`PsftpResult`, one per executed command.
+        """
+        for _ in self:
+            pass
+        return self.results
@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from collections import deque, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import threading
+import time
+
+from pexpect import TIMEOUT, EOF, ExceptionPexpect
+
+from .psftp import psftp, ExceptionPsftpLocal
+
+
+__all__ = ['PsftpScheduler', 'PsftpSchedulerStats']
+
+
+# Priority classes, highest first.
+METADATA = 'metadata'
+TRANSFER = 'transfer'
+CLASSES = (METADATA, TRANSFER)
+
+COMMANDS = {
+    'chgrp': METADATA,
+    'chmod': METADATA,
+    'df': METADATA,
+    'ln': METADATA,
+    'ls': METADATA,
+    'mkdir': METADATA,
+    'pwd': METADATA,
+    'rename': METADATA,
+    'rm': METADATA,
+    'rmdir': METADATA,
+    'symlink': METADATA,
+    'copy': TRANSFER,
+    'copy_tree': TRANSFER,
+    'get': TRANSFER,
+    'get_many': TRANSFER,
+    'put': TRANSFER,
+    'put_many': TRANSFER,
+    'reget': TRANSFER,
+    'reput': TRANSFER,
+    'sync': TRANSFER,
+}
+
+
+class PsftpSchedulerStats(object):
+    '''Queue depth and waiting time of one priority class of a
+    :class:`PsftpScheduler`. Times are in seconds.
+    '''
+
+    __slots__ = ('submitted', 'completed', 'failed', 'depth', 'max_depth',
+                 'wait', 'max_wait', 'busy')
+
+    def __init__(self):
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.depth = 0
+        self.max_depth = 0
+        self.wait = 0.0
+        self.max_wait = 0.0
+        self.busy = 0.0
+
+    @property
+    def mean_wait(self):
+        started = self.completed + self.failed
+        return self.wait / started if started else 0.0
+
+    def __repr__(self):
+        return ('<PsftpSchedulerStats %d queued, %d done, %d failed, '
+                'wait %.3fs mean %.3fs max>'
+                % (self.depth, self.completed, self.failed, self.mean_wait,
+                   self.max_wait))
+
+
+class PsftpScheduler(object):
+    """Runs commands over a fixed number of psftp sessions logged in to
+    the same host, so that quick metadata commands do not wait behind bulk
+    transfers. fast_lane sessions only run metadata commands (ls, rename,
+    rm, ...), the others run transfers and take metadata commands first
+    when both are queued.
+
+    Within a class the callers are served in turn, one command each, so a
+    caller queueing thousands of files does not hold back the others. The
+    caller defaults to the submitting thread.
+
+    Example::
+
+        sched = psftp.PsftpScheduler(4, fast_lane=1)
+        sched.login(hostname, username, password)
+        uploads = [sched.submit('put', path, 'inbox/') for path in paths]
+        print(sched.run('ls', 'inbox'))
+        for future in uploads:
+            future.result()
+        print(sched.stats['metadata'].max_wait)
+        sched.logout()
+
+    The sessions do not share a working directory, so commands should use
+    absolute paths or paths relative to the login directory. A session
+    whose sftp child died is replaced by a newly logged in one, and once no
+    session is left for a class its queued and new commands fail with
+    ExceptionPsftpLocal. The keyword arguments are passed on to
+    :class:`psftp` for every session.
+    """
+
+    def __init__(self, size=4, fast_lane=1, **kwargs):
+        if size < 2 or not 0 < fast_lane < size:
+            raise ExceptionPsftpLocal(
+                'the scheduler needs a fast lane and a transfer session')
+        self.size = size
+        self.fast_lane = fast_lane
+        self.stats = OrderedDict((c, PsftpSchedulerStats()) for c in CLASSES)
+        self._kwargs = kwargs
+        self._login_args = None
+        self._sessions = []
+        self._workers = []
+        # Per class, the jobs of every caller in submission order.
+        self._queues = dict((c, OrderedDict()) for c in CLASSES)
+        # Per class, the number of sessions serving it.
+        self._serving = dict((c, 0) for c in CLASSES)
+        self._cond = threading.Condition()
+        self._closed = False
+
+    def login(self, server, username, password='', **kwargs):
+        '''Log in all sessions and start serving commands. The arguments
+        are the same as :meth:`psftp.login`.
+        '''
+        self._login_args = dict(kwargs, server=server, username=username,
+                                password=password)
+        sessions = []
+        if self._kwargs.get('multiplex'):
+            # The first login starts the ControlMaster, see PsftpPool.
+            sessions.append(self._login())
+        with ThreadPoolExecutor(self.size) as executor:
+            futures = [executor.submit(self._login)
+                       for _ in range(self.size - len(sessions))]
+            errors = [f.exception() for f in futures if f.exception()]
+            sessions += [f.result() for f in futures if not f.exception()]
+        if errors:
+            for s in sessions:
+                s.close()
+            raise errors[0]
+        self._closed = False
+        self._sessions = sessions
+        for i, s in enumerate(sessions):
+            classes = (METADATA,) if i < self.fast_lane else CLASSES
+            for c in classes:
+                self._serving[c] += 1
+            worker = threading.Thread(target=self._serve, args=(s, classes))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+        return True
+
+    def logout(self):
+        '''Stop serving, cancel the queued commands, wait for the running
+        ones and log out all sessions.
+        '''
+        with self._cond:
+            self._closed = True
+            for c, queue in self._queues.items():
+                for jobs in queue.values():
+                    for job in jobs:
+                        job[0].cancel()
+                        self.stats[c].depth -= 1
+                queue.clear()
+            self._cond.notify_all()
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+        self._sessions = []
+        self._serving = dict((c, 0) for c in CLASSES)
+
+    def submit(self, command, *args, **kwargs):
+        '''Queue a psftp command.
+
+        :command: name of a :class:`psftp` method, see :data:`COMMANDS`.
+        :caller: keyword argument, the key commands are served fairly
+        between, the current thread if None.
+        :priority: keyword argument, 'metadata' or 'transfer' to override
+        the class of the command.
+
+        :return: concurrent.futures.Future of the result of the command.
+        '''
+        caller = kwargs.pop('caller', None)
+        if caller is None:
+            caller = threading.current_thread().ident
+        priority = kwargs.pop('priority', None) or COMMANDS.get(command)
+        if priority not in CLASSES:
+            raise ExceptionPsftpLocal('command can not be scheduled: %s'
+                                      % command)
+        future = Future()
+        with self._cond:
+            if self._closed or not self._sessions:
+                raise ExceptionPsftpLocal('not logged in')
+            if not self._serving[priority]:
+                raise ExceptionPsftpLocal('no session left for %s commands'
+                                          % priority)
+            queue = self._queues[priority]
+            queue.setdefault(caller, deque()).append(
+                (future, command, args, kwargs, time.time()))
+            stats = self.stats[priority]
+            stats.submitted += 1
+            stats.depth += 1
+            stats.max_depth = max(stats.max_depth, stats.depth)
+            self._cond.notify_all()
+        return future
+
+    def run(self, command, *args, **kwargs):
+        '''Queue a psftp command and wait for its result, see
+        :meth:`submit`.
+        '''
+        return self.submit(command, *args, **kwargs).result()
+
+    def _login(self):
+        s = psftp(**self._kwargs)
+        s.login(**self._login_args)
+        return s
+
+    def _next_job(self, classes):
+        for c in classes:
+            queue = self._queues[c]
+            if not queue:
+                continue
+            # The caller served goes to the back of the line.
+            caller, jobs = queue.popitem(last=False)
+            job = jobs.popleft()
+            if jobs:
+                queue[caller] = jobs
+            return c, job
+        return None, None
+
+    def _serve(self, s, classes):
+        while True:
+            with self._cond:
+                c, job = self._next_job(classes)
+                while job is None and not self._closed:
+                    self._cond.wait()
+                    c, job = self._next_job(classes)
+                if job is None:
+                    break
+                stats = self.stats[c]
+                stats.depth -= 1
+            future, command, args, kwargs, queued = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            started = time.time()
+            try:
+                result = getattr(s, command)(*args, **kwargs)
+            except Exception as e:
+                future.set_exception(e)
+                ok = False
+                if isinstance(e, (EOF, TIMEOUT)):
+                    s = self._replace(s)
+            else:
+                future.set_result(result)
+                ok = True
+            with self._cond:
+                wait = started - queued
+                stats.wait += wait
+                stats.max_wait = max(stats.max_wait, wait)
+                stats.busy += time.time() - started
+                if ok:
+                    stats.completed += 1
+                else:
+                    stats.failed += 1
+            if s is None:
+                self._retire(classes)
+                return
+        try:
+            s.logout()
+        except (EOF, TIMEOUT):
+            s.close()
+
+    def _retire(self, classes):
+        # The queued commands of a class nobody serves any more would wait
+        # forever.
+        with self._cond:
+            for c in classes:
+                self._serving[c] -= 1
+                if self._serving[c]:
+                    continue
+                error = ExceptionPsftpLocal('no session left for %s commands'
+                                            % c)
+                for jobs in self._queues[c].values():
+                    for job in jobs:
+                        if job[0].set_running_or_notify_cancel():
+                            job[0].set_exception(error)
+                        self.stats[c].depth -= 1
+                self._queues[c].clear()
+
+    def _replace(self, s):
+        # The lane shrinks when the replacement can not log in.
+        s.close(force=True)
+        try:
+            n = self._login()
+        except ExceptionPexpect:
+            n = None
+        with self._cond:
+            self._sessions.remove(s)
+            if n is not None:
+                self._sessions.append(n)
+        return n
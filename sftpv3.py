@@ -0,0 +1,1603 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""A client for version 3 of the SFTP protocol, talking to an sftp server
+over the stdin and stdout of a child process (``ssh -s ... sftp`` or a local
+sftp-server), and :class:`PsftpV3`, the psftp backend built on it.
+"""
+
+from pexpect import TIMEOUT, EOF
+from collections import OrderedDict
+import errno
+import fnmatch
+import glob
+import io
+import os
+import posixpath
+import select
+import shlex
+import stat
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+
+from .psftp import psftp, PsftpEntry, PsftpProgress
+from .psftp import ExceptionPsftpLocal, ExceptionPsftpInteraction
+
+
+__all__ = ['SFTPv3Client', 'SFTPAttributes', 'RemoteFile', 'PsftpBlockCache',
+           'PsftpV3', 'ExceptionPsftpStatus']
+
+
+SSH_FXP_INIT = 1
+SSH_FXP_VERSION = 2
+SSH_FXP_OPEN = 3
+SSH_FXP_CLOSE = 4
+SSH_FXP_READ = 5
+SSH_FXP_WRITE = 6
+SSH_FXP_LSTAT = 7
+SSH_FXP_FSTAT = 8
+SSH_FXP_SETSTAT = 9
+SSH_FXP_FSETSTAT = 10
+SSH_FXP_OPENDIR = 11
+SSH_FXP_READDIR = 12
+SSH_FXP_REMOVE = 13
+SSH_FXP_MKDIR = 14
+SSH_FXP_RMDIR = 15
+SSH_FXP_REALPATH = 16
+SSH_FXP_STAT = 17
+SSH_FXP_RENAME = 18
+SSH_FXP_READLINK = 19
+SSH_FXP_SYMLINK = 20
+SSH_FXP_STATUS = 101
+SSH_FXP_HANDLE = 102
+SSH_FXP_DATA = 103
+SSH_FXP_NAME = 104
+SSH_FXP_ATTRS = 105
+SSH_FXP_EXTENDED = 200
+SSH_FXP_EXTENDED_REPLY = 201
+
+SSH_FXF_READ = 0x01
+SSH_FXF_WRITE = 0x02
+SSH_FXF_APPEND = 0x04
+SSH_FXF_CREAT = 0x08
+SSH_FXF_TRUNC = 0x10
+SSH_FXF_EXCL = 0x20
+
+SSH_FILEXFER_ATTR_SIZE = 0x01
+SSH_FILEXFER_ATTR_UIDGID = 0x02
+SSH_FILEXFER_ATTR_PERMISSIONS = 0x04
+SSH_FILEXFER_ATTR_ACMODTIME = 0x08
+SSH_FILEXFER_ATTR_EXTENDED = 0x80000000
+
+SSH_FX_OK = 0
+SSH_FX_EOF = 1
+SSH_FX_NO_SUCH_FILE = 2
+SSH_FX_PERMISSION_DENIED = 3
+SSH_FX_FAILURE = 4
+SSH_FX_BAD_MESSAGE = 5
+SSH_FX_NO_CONNECTION = 6
+SSH_FX_CONNECTION_LOST = 7
+SSH_FX_OP_UNSUPPORTED = 8
+
+
+class ExceptionPsftpStatus(ExceptionPsftpInteraction):
+    '''Raised for status replies of the server reporting an error.
+    '''
+    def __init__(self, code, message):
+        super(ExceptionPsftpStatus, self).__init__(message, None)
+        self.code = code
+
+
+class SFTPAttributes(object):
+    '''File attributes as sent by the server, None when not sent.
+    '''
+    __slots__ = ('size', 'uid', 'gid', 'mode', 'atime', 'mtime')
+
+    def __init__(self, size=None, uid=None, gid=None, mode=None, atime=None,
+                 mtime=None):
+        self.size = size
+        self.uid = uid
+        self.gid = gid
+        self.mode = mode
+        self.atime = atime
+        self.mtime = mtime
+
+    def is_dir(self):
+        return self.mode is not None and stat.S_ISDIR(self.mode)
+
+    def is_file(self):
+        return self.mode is not None and stat.S_ISREG(self.mode)
+
+    def is_link(self):
+        return self.mode is not None and stat.S_ISLNK(self.mode)
+
+    def pack(self):
+        flags = 0
+        data = b''
+        if self.size is not None:
+            flags |= SSH_FILEXFER_ATTR_SIZE
+            data += struct.pack('>Q', self.size)
+        if self.uid is not None and self.gid is not None:
+            flags |= SSH_FILEXFER_ATTR_UIDGID
+            data += struct.pack('>II', self.uid, self.gid)
+        if self.mode is not None:
+            flags |= SSH_FILEXFER_ATTR_PERMISSIONS
+            data += struct.pack('>I', self.mode)
+        if self.atime is not None and self.mtime is not None:
+            flags |= SSH_FILEXFER_ATTR_ACMODTIME
+            data += struct.pack('>II', int(self.atime), int(self.mtime))
+        return struct.pack('>I', flags) + data
+
+    def __repr__(self):
+        return '<SFTPAttributes size=%s mode=%s mtime=%s>' % (
+            self.size, None if self.mode is None else oct(self.mode),
+            self.mtime)
+
+
+class _Reader(object):
+
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def uint32(self):
+        value, = struct.unpack_from('>I', self.data, self.offset)
+        self.offset += 4
+        return value
+
+    def uint64(self):
+        value, = struct.unpack_from('>Q', self.data, self.offset)
+        self.offset += 8
+        return value
+
+    def string(self):
+        length = self.uint32()
+        value = self.data[self.offset:self.offset+length]
+        self.offset += length
+        return bytes(value)
+
+    def attrs(self):
+        flags = self.uint32()
+        a = SFTPAttributes()
+        if flags & SSH_FILEXFER_ATTR_SIZE:
+            a.size = self.uint64()
+        if flags & SSH_FILEXFER_ATTR_UIDGID:
+            a.uid = self.uint32()
+            a.gid = self.uint32()
+        if flags & SSH_FILEXFER_ATTR_PERMISSIONS:
+            a.mode = self.uint32()
+        if flags & SSH_FILEXFER_ATTR_ACMODTIME:
+            a.atime = self.uint32()
+            a.mtime = self.uint32()
+        if flags & SSH_FILEXFER_ATTR_EXTENDED:
+            for _ in range(self.uint32()):
+                self.string()
+                self.string()
+        return a
+
+    def rest(self):
+        return bytes(self.data[self.offset:])
+
+
+class SFTPv3Client(object):
+    """Speaks version 3 of the SFTP protocol to the server started by
+    command, a list of program arguments. Every method sends one request
+    and waits for its reply, except :meth:`download` and :meth:`upload`,
+    which keep up to num_requests READ or WRITE requests in flight.
+
+    Errors reported by the server raise :class:`ExceptionPsftpStatus`, a
+    server that goes away raises EOF and one that does not answer within
+    timeout seconds raises TIMEOUT.
+
+    Example that copies a file from a local sftp-server::
+
+        c = SFTPv3Client(['/usr/lib/openssh/sftp-server'])
+        with open('copy', 'wb') as f:
+            c.download('/etc/hostname', f)
+        c.close()
+    """
+
+    def __init__(self, command, timeout=60, env=None, login_timeout=None,
+                 encoding='utf-8'):
+        self.timeout = timeout
+        self.encoding = encoding
+        self._errors = tempfile.TemporaryFile()
+        try:
+            self._process = subprocess.Popen(
+                command,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=self._errors,
+                env=env,
+                bufsize=0,
+                close_fds=True,
+                start_new_session=True)
+        except OSError as e:
+            raise ExceptionPsftpLocal(str(e))
+        self._buffer = bytearray()
+        self._next_id = 0
+        # Replies to requests that are still waited for by someone else,
+        # like the reads ahead of a RemoteFile.
+        self._replies = {}
+
+        try:
+            self._write(struct.pack('>IBI', 5, SSH_FXP_INIT, 3))
+            t, r = self._recv_packet(login_timeout or timeout)
+        except EOF:
+            errors = self.errors().lower()
+            self.close()
+            if 'permission denied' in errors:
+                raise ExceptionPsftpLocal('permission denied')
+            if 'connection closed' in errors:
+                raise ExceptionPsftpLocal('connection closed')
+            raise ExceptionPsftpLocal(
+                'Could not establish connection to host')
+        except TIMEOUT:
+            self.close()
+            raise ExceptionPsftpLocal(
+                'Could not establish connection to host')
+        if t != SSH_FXP_VERSION:
+            self.close()
+            raise ExceptionPsftpLocal('unexpected login response')
+        self.version = r.uint32()
+        self.extensions = {}
+        while r.offset < len(r.data):
+            name = r.string().decode('ascii', 'replace')
+            self.extensions[name] = r.string()
+
+    def close(self):
+        '''Stop the server process.
+        '''
+        if self._process.poll() is None:
+            try:
+                self._process.stdin.close()
+                self._process.wait(timeout=1)
+            except Exception:
+                self._process.kill()
+                self._process.wait()
+        self._process.stdout.close()
+        self._errors.close()
+
+    def isalive(self):
+        return self._process.poll() is None
+
+    def errors(self):
+        '''The text the server process wrote to stderr so far.
+        '''
+        self._errors.seek(0)
+        return self._errors.read().decode(self.encoding, 'replace')
+
+    def open(self, path, flags, attrs=None):
+        return self._handle(SSH_FXP_OPEN, self._path(path),
+                            struct.pack('>I', flags),
+                            (attrs or SFTPAttributes()).pack())
+
+    def close_handle(self, handle):
+        self._status(SSH_FXP_CLOSE, _string(handle))
+
+    def read(self, handle, offset, length):
+        """:return: the data read, b'' at the end of the file.
+        """
+        t, r = self._request(SSH_FXP_READ, _string(handle),
+                             struct.pack('>QI', offset, length))
+        if t == SSH_FXP_DATA:
+            return r.string()
+        code, message = self._parse_status(t, r)
+        if code == SSH_FX_EOF:
+            return b''
+        raise ExceptionPsftpStatus(code, message)
+
+    def write(self, handle, offset, data):
+        self._status(SSH_FXP_WRITE, _string(handle),
+                     struct.pack('>Q', offset), _string(data))
+
+    def stat(self, path):
+        return self._attrs(SSH_FXP_STAT, self._path(path))
+
+    def lstat(self, path):
+        return self._attrs(SSH_FXP_LSTAT, self._path(path))
+
+    def fstat(self, handle):
+        return self._attrs(SSH_FXP_FSTAT, _string(handle))
+
+    def setstat(self, path, attrs):
+        self._status(SSH_FXP_SETSTAT, self._path(path), attrs.pack())
+
+    def fsetstat(self, handle, attrs):
+        self._status(SSH_FXP_FSETSTAT, _string(handle), attrs.pack())
+
+    def listdir(self, path):
+        """:return: list of (filename, longname, SFTPAttributes) tuples.
+        """
+        handle = self.opendir(path)
+        entries = []
+        try:
+            while True:
+                names = self.readdir(handle)
+                if not names:
+                    break
+                entries.extend(names)
+        finally:
+            self.close_handle(handle)
+        return entries
+
+    def opendir(self, path):
+        return self._handle(SSH_FXP_OPENDIR, self._path(path))
+
+    def readdir(self, handle):
+        """:return: the next batch of (filename, longname, SFTPAttributes)
+        tuples of the directory, an empty list at its end.
+        """
+        t, r = self._request(SSH_FXP_READDIR, _string(handle))
+        if t != SSH_FXP_NAME:
+            code, message = self._parse_status(t, r)
+            if code == SSH_FX_EOF:
+                return []
+            raise ExceptionPsftpStatus(code, message)
+        return self._parse_names(r)
+
+    def remove(self, path):
+        self._status(SSH_FXP_REMOVE, self._path(path))
+
+    def mkdir(self, path, attrs=None):
+        self._status(SSH_FXP_MKDIR, self._path(path),
+                     (attrs or SFTPAttributes()).pack())
+
+    def rmdir(self, path):
+        self._status(SSH_FXP_RMDIR, self._path(path))
+
+    def realpath(self, path):
+        t, r = self._request(SSH_FXP_REALPATH, self._path(path))
+        if t != SSH_FXP_NAME:
+            raise ExceptionPsftpStatus(*self._parse_status(t, r))
+        return self._parse_names(r)[0][0]
+
+    def rename(self, oldpath, newpath):
+        self._status(SSH_FXP_RENAME, self._path(oldpath),
+                     self._path(newpath))
+
+    def readlink(self, path):
+        t, r = self._request(SSH_FXP_READLINK, self._path(path))
+        if t != SSH_FXP_NAME:
+            raise ExceptionPsftpStatus(*self._parse_status(t, r))
+        return self._parse_names(r)[0][0]
+
+    def symlink(self, target, path):
+        # OpenSSH swapped the arguments of the draft, every other server
+        # followed it.
+        self._status(SSH_FXP_SYMLINK, self._path(target), self._path(path))
+
+    def extended(self, name, *fields):
+        """Send an extended request, see :attr:`extensions` for those the
+        server announced.
+
+        :return: the reply data, None for a plain status reply.
+        """
+        t, r = self._request(SSH_FXP_EXTENDED, _string(name.encode('ascii')),
+                             *fields)
+        if t == SSH_FXP_EXTENDED_REPLY:
+            return r.rest()
+        code, message = self._parse_status(t, r)
+        if code != SSH_FX_OK:
+            raise ExceptionPsftpStatus(code, message)
+        return None
+
+    def hardlink(self, oldpath, newpath):
+        self._require('hardlink@openssh.com')
+        self.extended('hardlink@openssh.com', self._path(oldpath),
+                      self._path(newpath))
+
+    def statvfs(self, path):
+        """:return: dict with the fields of statvfs(3).
+        """
+        self._require('statvfs@openssh.com')
+        r = _Reader(self.extended('statvfs@openssh.com', self._path(path)))
+        names = ('bsize', 'frsize', 'blocks', 'bfree', 'bavail', 'files',
+                 'ffree', 'favail', 'fsid', 'flag', 'namemax')
+        return dict((name, r.uint64()) for name in names)
+
+    def fsync(self, handle):
+        self._require('fsync@openssh.com')
+        self.extended('fsync@openssh.com', _string(handle))
+
+    def copy(self, oldpath, newpath):
+        '''Copy the regular file oldpath to newpath on the server with the
+        copy-data extension, the data is not sent over the connection.
+        '''
+        self._require('copy-data')
+        source = self.open(oldpath, SSH_FXF_READ)
+        try:
+            attrs = self.fstat(source)
+            if attrs.mode is not None and not attrs.is_file():
+                raise ExceptionPsftpStatus(
+                    SSH_FX_FAILURE, 'Cannot copy non-regular file')
+            target = self.open(
+                newpath, SSH_FXF_WRITE | SSH_FXF_CREAT | SSH_FXF_TRUNC,
+                SFTPAttributes(mode=attrs.mode and stat.S_IMODE(attrs.mode)))
+            try:
+                # A length of 0 copies up to the end of the file.
+                self.extended('copy-data', _string(source),
+                              struct.pack('>QQ', 0, 0), _string(target),
+                              struct.pack('>Q', 0))
+            finally:
+                self.close_handle(target)
+        finally:
+            self.close_handle(source)
+
+    def download(self, path, f, offset=0, buffer_size=32768,
+                 num_requests=64, callback=None):
+        """Copy the remote file path into the file object f, starting at
+        offset in both files, with up to num_requests READ requests of
+        buffer_size bytes in flight. callback is called with the number of
+        bytes copied so far after every block.
+
+        :return: the number of bytes copied.
+        """
+        handle = self.open(path, SSH_FXF_READ)
+        try:
+            return self._download(handle, f, offset, buffer_size,
+                                  num_requests, callback)
+        finally:
+            self.close_handle(handle)
+
+    def upload(self, f, path, offset=0, buffer_size=32768, num_requests=64,
+               attrs=None, callback=None):
+        """Copy the file object f into the remote file path, starting at
+        offset in both files, with up to num_requests WRITE requests of
+        buffer_size bytes in flight. The remote file is truncated unless
+        offset is given. callback is called with the number of bytes
+        acknowledged so far after every block.
+
+        :return: the number of bytes copied.
+        """
+        flags = SSH_FXF_WRITE | SSH_FXF_CREAT
+        if not offset:
+            flags |= SSH_FXF_TRUNC
+        handle = self.open(path, flags, attrs)
+        try:
+            return self._upload(f, handle, offset, buffer_size, num_requests,
+                                callback)
+        finally:
+            self.close_handle(handle)
+
+    def _download(self, handle, f, offset, buffer_size, num_requests,
+                  callback=None):
+        pending = {}
+        copied = 0
+        eof = False
+        while True:
+            while not eof and len(pending) < num_requests:
+                i = self._send(SSH_FXP_READ, _string(handle),
+                               struct.pack('>QI', offset, buffer_size))
+                pending[i] = (offset, buffer_size)
+                offset += buffer_size
+            if not pending:
+                return copied
+            t, i, r = self._recv_for(pending)
+            start, length = pending.pop(i)
+            if t == SSH_FXP_DATA:
+                data = r.string()
+                f.seek(start)
+                f.write(data)
+                copied += len(data)
+                if callback is not None:
+                    callback(copied)
+                if 0 < len(data) < length and not eof:
+                    # Short read, ask for the rest of the block again.
+                    j = self._send(SSH_FXP_READ, _string(handle),
+                                   struct.pack('>QI', start + len(data),
+                                               length - len(data)))
+                    pending[j] = (start + len(data), length - len(data))
+                continue
+            code, message = self._parse_status(t, r)
+            if code != SSH_FX_EOF:
+                # Let the other replies arrive before giving up.
+                while pending:
+                    pending.pop(self._recv_for(pending)[1])
+                raise ExceptionPsftpStatus(code, message)
+            eof = True
+
+    def _upload(self, f, handle, offset, buffer_size, num_requests,
+                callback=None):
+        pending = {}
+        copied = 0
+        acked = 0
+        eof = False
+        error = None
+        while True:
+            while not eof and error is None and len(pending) < num_requests:
+                data = f.read(buffer_size)
+                if not data:
+                    eof = True
+                    break
+                i = self._send(SSH_FXP_WRITE, _string(handle),
+                               struct.pack('>Q', offset), _string(data))
+                pending[i] = len(data)
+                offset += len(data)
+                copied += len(data)
+            if not pending:
+                break
+            t, i, r = self._recv_for(pending)
+            acked += pending.pop(i)
+            code, message = self._parse_status(t, r)
+            if code != SSH_FX_OK and error is None:
+                error = ExceptionPsftpStatus(code, message)
+            if callback is not None and error is None:
+                callback(acked)
+        if error is not None:
+            raise error
+        return copied
+
+    def _require(self, extension):
+        if extension not in self.extensions:
+            raise ExceptionPsftpStatus(
+                SSH_FX_OP_UNSUPPORTED,
+                'Server does not support the %s extension' % extension)
+
+    def _path(self, path):
+        if not isinstance(path, bytes):
+            path = path.encode(self.encoding, 'surrogateescape')
+        return _string(path)
+
+    def _text(self, data):
+        return data.decode(self.encoding, 'surrogateescape')
+
+    def _parse_names(self, r):
+        names = []
+        for _ in range(r.uint32()):
+            filename = self._text(r.string())
+            longname = self._text(r.string())
+            names.append((filename, longname, r.attrs()))
+        return names
+
+    def _parse_status(self, t, r):
+        if t != SSH_FXP_STATUS:
+            raise ExceptionPsftpLocal('unexpected response %d' % t)
+        code = r.uint32()
+        message = ''
+        if r.offset < len(r.data):
+            message = self._text(r.string())
+        return code, message
+
+    def _status(self, t, *fields):
+        code, message = self._parse_status(*self._request(t, *fields))
+        if code != SSH_FX_OK:
+            raise ExceptionPsftpStatus(code, message)
+
+    def _handle(self, t, *fields):
+        t, r = self._request(t, *fields)
+        if t != SSH_FXP_HANDLE:
+            raise ExceptionPsftpStatus(*self._parse_status(t, r))
+        return r.string()
+
+    def _attrs(self, t, *fields):
+        t, r = self._request(t, *fields)
+        if t != SSH_FXP_ATTRS:
+            raise ExceptionPsftpStatus(*self._parse_status(t, r))
+        return r.attrs()
+
+    def _request(self, t, *fields):
+        i = self._send(t, *fields)
+        rt, _, r = self._recv_for((i,))
+        return rt, r
+
+    def _send(self, t, *fields):
+        i = self._next_id
+        self._next_id = (self._next_id + 1) & 0xffffffff
+        payload = b''.join(fields)
+        self._write(struct.pack('>IBI', len(payload) + 5, t, i) + payload)
+        return i
+
+    def _recv(self):
+        t, r = self._recv_packet(self.timeout)
+        return t, r.uint32(), r
+
+    def _recv_for(self, ids):
+        # The next reply to one of the requests ids, keeping the replies to
+        # the other requests in flight.
+        if self._replies:
+            for i in ids:
+                if i in self._replies:
+                    t, r = self._replies.pop(i)
+                    return t, i, r
+        while True:
+            t, i, r = self._recv()
+            if i in ids:
+                return t, i, r
+            self._replies[i] = (t, r)
+
+    def _recv_packet(self, timeout):
+        length, = struct.unpack('>I', self._read(4, timeout))
+        data = self._read(length, timeout)
+        return data[0], _Reader(memoryview(data)[1:])
+
+    def _read(self, n, timeout):
+        fd = self._process.stdout.fileno()
+        while len(self._buffer) < n:
+            if timeout is not None:
+                ready, _, _ = select.select([fd], [], [], timeout)
+                if not ready:
+                    raise TIMEOUT('Timeout exceeded.')
+            data = os.read(fd, max(65536, n - len(self._buffer)))
+            if not data:
+                raise EOF('End Of File (EOF).')
+            self._buffer.extend(data)
+        data = bytes(self._buffer[:n])
+        del self._buffer[:n]
+        return data
+
+    def _write(self, data):
+        try:
+            self._process.stdin.write(data)
+        except (IOError, OSError):
+            raise EOF('End Of File (EOF).')
+
+
+class PsftpBlockCache(object):
+    """Blocks of remote files read by :class:`RemoteFile`, shared by the
+    files opened with the same cache and bounded to max_bytes, the least
+    recently used blocks are dropped first. The blocks of a path are
+    dropped when it is opened again with another size or modification
+    time. max_bytes should hold the reads ahead of the files open at the
+    same time.
+
+    :hits, misses: blocks found in the cache, and fetched.
+    """
+
+    def __init__(self, max_bytes=32 << 20):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._blocks = OrderedDict()
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def validate(self, path, size, mtime):
+        '''Drop the blocks of path unless they were read from a file of
+        this size and modification time.
+        '''
+        with self._lock:
+            if self._versions.get(path) != (size, mtime):
+                self._drop(path)
+                self._versions[path] = (size, mtime)
+
+    def invalidate(self, path=None):
+        '''Drop the blocks of path, of every path if None.
+        '''
+        with self._lock:
+            if path is None:
+                self._blocks.clear()
+                self._versions.clear()
+                self.bytes = 0
+            else:
+                self._drop(path)
+                self._versions.pop(path, None)
+
+    def get(self, key):
+        with self._lock:
+            data = self._blocks.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._blocks.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        with self._lock:
+            old = self._blocks.pop(key, None)
+            if old is not None:
+                self.bytes -= len(old)
+            self._blocks[key] = data
+            self.bytes += len(data)
+            while self.bytes > self.max_bytes and self._blocks:
+                self.bytes -= len(self._blocks.popitem(last=False)[1])
+
+    def __contains__(self, key):
+        return key in self._blocks
+
+    def __repr__(self):
+        return '<PsftpBlockCache %d blocks %d bytes %d hits %d misses>' % (
+            len(self._blocks), self.bytes, self.hits, self.misses)
+
+    def _drop(self, path):
+        for key in [k for k in self._blocks if k[0] == path]:
+            self.bytes -= len(self._blocks.pop(key))
+
+
+class RemoteFile(io.RawIOBase):
+    """A remote file opened for reading, seekable. It is fetched in blocks
+    of buffer_size bytes, which are kept in cache, a
+    :class:`PsftpBlockCache` shared with the other files opened on the same
+    path. Reading on from the block last read keeps up to num_requests READ
+    requests in flight for the following blocks, so the file streams at
+    the speed of a download; after a seek only the blocks read are
+    fetched.
+
+    Other requests can be sent on the same client while the file is open.
+    Use :meth:`psftp.open_remote` to get it wrapped in a buffered reader.
+    """
+
+    def __init__(self, client, path, buffer_size=32768, num_requests=16,
+                 cache=None):
+        super(RemoteFile, self).__init__()
+        self.client = client
+        self.name = path
+        self.buffer_size = buffer_size
+        self.num_requests = num_requests
+        self._handle = client.open(path, SSH_FXF_READ)
+        attrs = client.fstat(self._handle)
+        # None when the server does not tell, the file then ends where the
+        # server says so.
+        self.size = attrs.size
+        if cache is None:
+            cache = PsftpBlockCache(buffer_size * (num_requests + 1))
+        cache.validate(path, attrs.size, attrs.mtime)
+        self.cache = cache
+        self._position = 0
+        self._last = -1
+        # READ requests in flight, by block and by request id.
+        self._pending = {}
+        self._blocks = {}
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            if self.size is None:
+                self.size = self.client.fstat(self._handle).size
+            offset += self.size
+        elif whence != io.SEEK_SET:
+            raise ValueError('invalid whence (%r)' % whence)
+        if offset < 0:
+            raise ValueError('negative seek position %d' % offset)
+        self._position = offset
+        return offset
+
+    def tell(self):
+        return self._position
+
+    def readinto(self, b):
+        if self.size is not None and self._position >= self.size:
+            return 0
+        index, skip = divmod(self._position, self.buffer_size)
+        block = self._block(index)
+        n = min(len(b), len(block) - skip)
+        if n <= 0:
+            return 0
+        b[:n] = memoryview(block)[skip:skip + n]
+        self._position += n
+        return n
+
+    def close(self):
+        if not self.closed and self.client.isalive():
+            try:
+                # Collect the reads ahead, the client shares the stream.
+                while self._pending:
+                    self._receive()
+                self.client.close_handle(self._handle)
+            finally:
+                super(RemoteFile, self).close()
+        else:
+            super(RemoteFile, self).close()
+
+    def _block(self, index):
+        if index - self._last in (0, 1):
+            self._read_ahead(index)
+        self._last = index
+        key = (self.name, self.buffer_size, index)
+        block = self.cache.get(key)
+        if block is not None:
+            return block
+        if index not in self._pending:
+            self._request(index)
+        while True:
+            received, block = self._receive()
+            if received == index:
+                return block
+
+    def _read_ahead(self, index):
+        for i in range(index + 1, index + 1 + self.num_requests):
+            if len(self._pending) >= self.num_requests:
+                break
+            if self.size is not None and i * self.buffer_size >= self.size:
+                break
+            if (i not in self._pending
+                    and (self.name, self.buffer_size, i) not in self.cache):
+                self._request(i)
+
+    def _request(self, index):
+        i = self.client._send(SSH_FXP_READ, _string(self._handle),
+                              struct.pack('>QI', index * self.buffer_size,
+                                          self.buffer_size))
+        self._pending[index] = i
+        self._blocks[i] = index
+
+    def _receive(self):
+        # The next reply to the reads in flight, kept in the cache.
+        t, i, r = self.client._recv_for(self._blocks)
+        index = self._blocks.pop(i)
+        del self._pending[index]
+        data = b''
+        if t == SSH_FXP_DATA:
+            data = r.string()
+            offset = index * self.buffer_size
+            length = self.buffer_size
+            if self.size is not None:
+                length = min(length, self.size - offset)
+            while 0 < len(data) < length:
+                # Short read, ask for the rest of the block.
+                more = self.client.read(self._handle, offset + len(data),
+                                        length - len(data))
+                if not more:
+                    break
+                data += more
+        else:
+            code, message = self.client._parse_status(t, r)
+            if code != SSH_FX_EOF:
+                raise ExceptionPsftpStatus(code, message)
+        self.cache.put((self.name, self.buffer_size, index), data)
+        return index, data
+
+
+def _string(data):
+    return struct.pack('>I', len(data)) + data
+
+
+# Answers ssh prompts: host keys are always accepted, like psftp.login
+# does, anything else gets the password. The password is read from its own
+# file, removed on the first read, so that it is neither in the environment
+# of ssh and its children nor on a command line.
+_ASKPASS = '''#!/bin/sh
+case "$1" in
+*"(yes/no"*) echo yes ;;
+*) cat %(secret)s 2>/dev/null; rm -f %(secret)s ;;
+esac
+'''
+
+
+def connect(command, password='', timeout=60, env=None, login_timeout=None,
+            encoding='utf-8'):
+    '''Start an :class:`SFTPv3Client` for command, answering the password
+    prompts of ssh with password.
+    '''
+    env = dict(env or os.environ)
+    files = []
+    if password:
+        # mkstemp creates the files readable by their owner only.
+        fd, secret = tempfile.mkstemp(prefix='psftp-secret-')
+        files.append(secret)
+        with os.fdopen(fd, 'w') as f:
+            f.write(password + '\n')
+        fd, askpass = tempfile.mkstemp(prefix='psftp-askpass-')
+        files.append(askpass)
+        with os.fdopen(fd, 'w') as f:
+            f.write(_ASKPASS % dict(secret=shlex.quote(secret)))
+        os.chmod(askpass, 0o700)
+        env.update(SSH_ASKPASS=askpass, SSH_ASKPASS_REQUIRE='force')
+        env.setdefault('DISPLAY', ':0')
+    try:
+        return SFTPv3Client(command, timeout=timeout, env=env,
+                            login_timeout=login_timeout, encoding=encoding)
+    finally:
+        for path in files:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class PsftpV3(psftp):
+    """The psftp backend that speaks the SFTP protocol directly instead of
+    driving the sftp client, so nothing is parsed from human-readable
+    output and transfers keep num_requests requests in flight. It is
+    chosen with the backend flag and has the methods of :class:`psftp`::
+
+        s = psftp.psftp(backend='protocol')
+        s.login(hostname, username, password)
+        s.put('./hello.txt')
+
+    Passwords are handed to ssh through SSH_ASKPASS, which needs OpenSSH
+    8.4 or later. Paths may be quoted like in sftp, globs are expanded in
+    the last path component only. :meth:`batch` and :meth:`pipeline` are
+    not available, every call already is a single request.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(PsftpV3, self).__init__(*args, **kwargs)
+        self.client = None
+        self.buffer_size = 32768
+        self.num_requests = 64
+        self._rcwd = None
+        self._lcwd = os.path.abspath(self.cwd or os.getcwd())
+        self._umask = None
+        self._progress = True
+
+    def login(
+            self,
+            server,
+            username,
+            password='',
+            terminal_type='ansi',
+            login_timeout=10,
+            port=None,
+            ssh_key=None,
+            quiet=True,
+            check_local_ip=True,
+            buffer_size=32768,
+            num_requests=64,
+            compression=False,
+            bandwidth_limit=None,
+            cipher=None):
+        '''This logs the user into the given server and starts its sftp
+        subsystem.
+
+        :buffer_size: bytes per READ or WRITE request.
+        :num_requests: READ or WRITE requests kept in flight.
+        :compression: compress the ssh connection.
+        :bandwidth_limit: not supported by this backend.
+        :cipher: ssh cipher.
+        '''
+        if bandwidth_limit:
+            raise ExceptionPsftpLocal(
+                'bandwidth_limit is not supported by this backend')
+        tuning = dict(
+            buffer_size=buffer_size,
+            num_requests=num_requests,
+            compression=compression,
+            cipher=cipher)
+        self._login_args = dict(
+            server=server,
+            username=username,
+            password=password,
+            port=port,
+            ssh_key=ssh_key,
+            quiet=quiet,
+            check_local_ip=check_local_ip,
+            tuning=tuning)
+        self.buffer_size = buffer_size or 32768
+        self.num_requests = num_requests or 64
+        command = self._ssh_command(server, username, port, ssh_key, quiet,
+                                    check_local_ip, tuning)
+        return self.connect(command, password, login_timeout)
+
+    def connect(self, command, password='', login_timeout=10):
+        '''Start the sftp server with command, a list of program arguments,
+        for example a local sftp-server.
+        '''
+        self.client = connect(command, password, timeout=self.timeout,
+                              env=self.env, login_timeout=login_timeout,
+                              encoding=self.encoding or 'utf-8')
+        self._rcwd = self.client.realpath('.')
+        self.before = ''
+        return True
+
+    def logout(self):
+        '''Stops the sftp server.
+        '''
+        self.close()
+
+    def close(self, force=True):
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+
+    def isalive(self):
+        return self.client is not None and self.client.isalive()
+
+    def prompt(self, timeout=-1):
+        return self.isalive()
+
+    def batch(self, ignore_errors=True, timeout=None):
+        raise ExceptionPsftpLocal('batch is not supported by this backend')
+
+    def pipeline(self, depth=16):
+        raise ExceptionPsftpLocal('pipeline is not supported by this backend')
+
+    def cd(self, path):
+        """Change remote directory to path.
+        """
+        path = self._remote(path)
+        attrs = self._call(self.client.stat, path,
+                           no_such_file=psftp._exception_no_such_file)
+        if not attrs.is_dir():
+            raise psftp._exception_not_directory
+        self._invalidate_relative()
+        self._rcwd = self.client.realpath(path)
+
+    def chgrp(self, grp, path):
+        """Change group of file path to grp. grp must be a numeric GID.
+        """
+        for p in self._remote_glob(path, psftp._exception_no_such_file):
+            self._invalidate(p)
+            attrs = self._call(self.client.stat, p,
+                               no_such_file=psftp._exception_no_such_file)
+            self._call(self.client.setstat, p,
+                       SFTPAttributes(uid=attrs.uid, gid=int(grp)))
+
+    def chmod(self, mode, path):
+        """Change permissions of file path to mode.
+        """
+        for p in self._remote_glob(path, psftp._exception_no_such_file):
+            self._invalidate(p)
+            self._call(self.client.setstat, p,
+                       SFTPAttributes(mode=int(str(mode), 8)),
+                       no_such_file=psftp._exception_no_such_file)
+
+    def df(self, path='', options=''):
+        """Display usage information for the filesystem holding the current
+        directory (of path if specified).
+
+        :options: 'i' displays inode information instead of capacity.
+
+        :return: tuple, the first value is the item list
+        the second is the value list
+        """
+        st = self._call(self.client.statvfs, self._remote(path or '.'))
+        if 'i' in options:
+            title = ['Inodes', 'Used', 'Avail', '(root)', '%Capacity']
+            total, free, avail = st['files'], st['ffree'], st['favail']
+            unit = 1
+        else:
+            title = ['Size', 'Used', 'Avail', '(root)', '%Capacity']
+            total, free, avail = st['blocks'], st['bfree'], st['bavail']
+            unit = st['frsize'] / 1024.0
+        used = total - free
+        capacity = 100 * used // total if total else 0
+        value = ['%d' % (v * unit) for v in (total, used, avail, free)]
+        return (title, value + ['%d%%' % capacity])
+
+    def get(
+            self,
+            remote_path,
+            local_path='',
+            options='',
+            progress=None):
+        """Retrieve the remote-path and store it on the local machine.
+
+        :options: every char is one of 'afPpr', see :meth:`psftp.get`.
+        :progress: see :meth:`psftp.get`.
+        """
+        return self._journaled(
+            'get', remote_path, local_path, options,
+            lambda: self._get(remote_path, local_path, options, progress))
+
+    def _get(self, remote_path, local_path, options, progress):
+        sources = self._remote_glob(remote_path,
+                                    psftp._exception_file_no_found)
+        target = self._local(self._unquote(local_path)) if local_path else None
+        for source in sources:
+            attrs = self._call(self.client.stat, source,
+                               no_such_file=psftp._exception_file_no_found)
+            local = self._local_target(target, posixpath.basename(source),
+                                       len(sources) > 1)
+            if attrs.is_dir():
+                if 'r' not in options:
+                    raise psftp._exception_non_regular_file
+                self._get_tree(source, local, options, progress)
+            elif attrs.is_file():
+                self._get_file(source, local, attrs, options, progress)
+            else:
+                raise psftp._exception_non_regular_file
+        self.before = ''
+
+    def copy(self, src, dst):
+        """Copy the remote file src to dst, see :meth:`psftp.copy`.
+        """
+        src = self._remote(src)
+        attrs = self._call(self.client.stat, src,
+                           no_such_file=psftp._exception_no_such_file)
+        if attrs.mode is not None and not attrs.is_file():
+            raise psftp._exception_non_regular_copy
+        dst = self._remote(dst)
+        self._invalidate(dst)
+        if 'copy-data' in self.client.extensions:
+            self._call(self.client.copy, src, dst,
+                       failure=psftp._exception_copy_failure)
+            return 'server'
+        with tempfile.TemporaryFile() as f:
+            self._call(self.client.download, src, f, 0, self.buffer_size,
+                       self.num_requests)
+            f.seek(0)
+            self._call(self.client.upload, f, dst, 0, self.buffer_size,
+                       self.num_requests, SFTPAttributes(
+                           mode=attrs.mode and stat.S_IMODE(attrs.mode)))
+        return 'local'
+
+    def help(self):
+        """Display help text.
+        """
+        return ('Available commands: cd chgrp chmod df get lcd lls lmkdir '
+                'ln lpwd ls lumask mkdir progress put pwd rename reget reput '
+                'rm rmdir symlink version !command\r\n')
+
+    def iter_ls(self, path='', options='', entries=False):
+        """Like :meth:`ls`, yields the lines unsorted as every READDIR reply
+        arrives, see :meth:`psftp.iter_ls`.
+        """
+        for p in self._remote_glob(path, psftp._exception_ls_not_found):
+            attrs = self._call(self.client.lstat, p,
+                               no_such_file=psftp._exception_ls_not_found)
+            if not attrs.is_dir():
+                listed = [[(p, '', attrs)]]
+            else:
+                listed = self._iter_dir(
+                    p, self._unquote(path) if path else '', options)
+            for batch in listed:
+                for name, longname, a in batch:
+                    if entries:
+                        yield self._entry(name, longname, a)
+                    elif 'l' in options or 'n' in options:
+                        yield self._longname(name, longname, a)
+                    else:
+                        yield name
+
+    def _iter_dir(self, path, prefix, options=''):
+        handle = self._call(self.client.opendir, path,
+                            no_such_file=psftp._exception_ls_not_found)
+        try:
+            while True:
+                names = self._call(self.client.readdir, handle)
+                if not names:
+                    break
+                yield [(posixpath.join(prefix, name), longname, a)
+                       for name, longname, a in names
+                       if not name.startswith('.') or 'a' in options]
+        finally:
+            self.client.close_handle(handle)
+
+    def lcd(self, path):
+        """Change local directory to path
+        """
+        path = self._local(self._unquote(path))
+        if not os.path.exists(path):
+            raise psftp._exception_no_such_file
+        if not os.path.isdir(path):
+            raise psftp._exception_not_directory
+        if not os.access(path, os.X_OK):
+            raise psftp._exception_permission_deined
+        self._lcwd = path
+
+    def ls(self, path='', options='', entries=False):
+        """Display a remote directory listing of either path or the current
+        directory if path is not specified.
+
+        :options: every char is one of '1afhlnrSt', see :meth:`psftp.ls`.
+        :entries: return :class:`PsftpEntry` records.
+
+        :return: lines of output, or a list of :class:`PsftpEntry`
+        """
+        key = (path, options, entries)
+        cached = self._cached_listing(key)
+        if cached is not None:
+            return cached
+        listed = []
+        for p in self._remote_glob(path, psftp._exception_ls_not_found):
+            attrs = self._call(self.client.lstat, p,
+                               no_such_file=psftp._exception_ls_not_found)
+            if not attrs.is_dir():
+                listed.append((p, '', attrs))
+                continue
+            prefix = self._unquote(path) if path else ''
+            for name, longname, a in self._call(self.client.listdir, p):
+                if name.startswith('.') and 'a' not in options:
+                    continue
+                listed.append((posixpath.join(prefix, name), longname, a))
+        if 'f' not in options:
+            listed.sort(key=lambda e: e[0])
+            if 'S' in options:
+                listed.sort(key=lambda e: -(e[2].size or 0))
+            elif 't' in options:
+                listed.sort(key=lambda e: -(e[2].mtime or 0))
+        if 'r' in options:
+            listed.reverse()
+        if entries:
+            lines = [self._entry(*e) for e in listed]
+        elif 'l' in options or 'n' in options:
+            lines = ' '.join(self._longname(*e) for e in listed).split()
+        else:
+            lines = [e[0] for e in listed]
+        self._cache_listing(key, lines)
+        return lines
+
+    def lmkdir(self, path):
+        """Create local directory specified by path.
+        """
+        try:
+            os.mkdir(self._local(self._unquote(path)))
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                raise psftp._exception_file_exists
+            if e.errno == errno.EACCES:
+                raise psftp._exception_permission_deined
+            raise ExceptionPsftpLocal(str(e))
+
+    def ln(self, oldpath, newpath, options=''):
+        """Create a link from oldpath to newpath in remote server.
+
+        :options: 's' creates a symbolic link, otherwise it's a hard link.
+        """
+        if 's' in options:
+            return self.symlink(oldpath, newpath)
+        newpath = self._remote(newpath)
+        self._invalidate(newpath)
+        self._call(self.client.hardlink, self._remote(oldpath), newpath,
+                   no_such_file=psftp._exception_no_such_file,
+                   failure=psftp._exception_could_not_link)
+
+    def lpwd(self):
+        """Get local working directory.
+        """
+        return self._lcwd
+
+    def lls(self, path='', options='', entries=False):
+        """Display local directory listing of either path or current directory
+        if path is not specified, using the local ls(1) command.
+
+        :entries: read the directory in this process instead and return
+        :class:`PsftpEntry` objects, see :meth:`psftp._lls_in_process`.
+
+        :returns: lines of output, or a list of :class:`PsftpEntry`
+        """
+        if entries:
+            return self._lls_in_process(path, options, entries)
+        output = self.local_command('ls %s %s' % (options, path))
+        if 'invalid option' in output:
+            raise psftp._exception_invalid_option
+        if 'No such file' in output:
+            raise psftp._exception_no_such_file
+        return [line.strip() for line in output.split()]
+
+    def lumask(self, umask):
+        """Set localumask to umask
+        """
+        try:
+            self._umask = int(str(umask), 8)
+        except ValueError:
+            raise psftp._exception_lumask_failed
+
+    def mkdir(self, path):
+        """Create remote directory specified by path.
+        """
+        path = self._remote(path)
+        self._invalidate(path)
+        self._call(self.client.mkdir, path,
+                   failure=psftp._exception_create_directory_failure)
+
+    def progress(self):
+        """Toggle display of progress meter, kept for compatibility.
+        """
+        self._progress = not self._progress
+
+    def put(
+            self,
+            local_path,
+            remote_path='',
+            options='',
+            progress=None):
+        """Upload local-path and store it on the remote machine.
+
+        :options: every char is one of 'afPpr', see :meth:`psftp.put`.
+        :progress: see :meth:`psftp.put`.
+        """
+        return self._journaled(
+            'put', local_path, remote_path, options,
+            lambda: self._put(local_path, remote_path, options, progress))
+
+    def _put(self, local_path, remote_path, options, progress):
+        sources = glob.glob(self._local(self._unquote(local_path)))
+        if not sources:
+            raise psftp._exception_no_such_file
+        target = self._remote(remote_path) if remote_path else None
+        for source in sources:
+            remote = self._remote_target(target, os.path.basename(source),
+                                         len(sources) > 1)
+            self._invalidate(remote)
+            if os.path.isdir(source):
+                if 'r' not in options:
+                    raise psftp._exception_non_regular_file
+                self._put_tree(source, remote, options, progress)
+            elif os.path.isfile(source):
+                self._put_file(source, remote, options, progress)
+            else:
+                raise psftp._exception_non_regular_file
+        self.before = ''
+
+    def pwd(self):
+        """Get remote working directory.
+        """
+        return self._rcwd
+
+    def rename(self, oldpath, newpath):
+        """Rename remote file from oldpath to newpath
+        """
+        oldpath, newpath = self._remote(oldpath), self._remote(newpath)
+        self._invalidate(oldpath)
+        self._invalidate(newpath)
+        self._call(self.client.rename, oldpath, newpath,
+                   no_such_file=psftp._exception_no_such_file)
+
+    def reget(
+            self,
+            remote_path,
+            local_path='',
+            options='',
+            progress=None):
+        """Resume download of remote-path.
+        Equivalent to get with the -a flag set.
+        """
+        self.get(remote_path, local_path, options + 'a', progress)
+
+    def reput(
+            self,
+            local_path,
+            remote_path='',
+            options='',
+            progress=None):
+        """Resume upload of local_path.
+        Equivalent to put with the -a flag set.
+        """
+        self.put(local_path, remote_path, options + 'a', progress)
+
+    def rm(self, path):
+        """Delete remote file specified by path
+        """
+        return self._journaled('rm', path, '', '', lambda: self._rm(path))
+
+    def _rm(self, path):
+        for p in self._remote_glob(path, psftp._exception_no_such_file):
+            self._invalidate(p)
+            self._call(self.client.remove, p,
+                       no_such_file=psftp._exception_no_such_file,
+                       failure=psftp._exception_delete_failure)
+
+    def rmdir(self, path):
+        """Remote remote directory specified by path.
+        """
+        path = self._remote(path)
+        self._invalidate(path)
+        self._call(self.client.rmdir, path,
+                   no_such_file=psftp._exception_no_such_file,
+                   failure=psftp._exception_remove_directory_failed)
+
+    def symlink(self, oldpath, newpath):
+        """Create a symbolic link from oldpath to newpath.
+        """
+        newpath = self._remote(newpath)
+        self._invalidate(newpath)
+        self._call(self.client.symlink, self._unquote(oldpath), newpath,
+                   no_such_file=psftp._exception_no_such_file,
+                   failure=psftp._exception_could_not_link)
+
+    def version(self):
+        """Display the sftp protocol version.
+        """
+        return 'SFTP protocol version %d\r\n' % self.client.version
+
+    def local_command(self, command):
+        """Execute command in local shell
+        """
+        process = subprocess.Popen(
+            command, shell=True, cwd=self._lcwd, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        return output.decode(self.encoding or 'utf-8', 'replace')
+
+    def _call(self, method, *args, **errors):
+        # Map the status of the server to the exceptions the sftp client
+        # backend raises for the same command.
+        try:
+            return method(*args)
+        except ExceptionPsftpStatus as e:
+            if e.code == SSH_FX_NO_SUCH_FILE and 'no_such_file' in errors:
+                raise errors['no_such_file']
+            if e.code == SSH_FX_PERMISSION_DENIED:
+                raise psftp._exception_permission_deined
+            if e.code == SSH_FX_FAILURE and 'failure' in errors:
+                raise errors['failure']
+            raise
+
+    def _many(self, name, paths, target, options):
+        # Every file is a request of its own already.
+        return [self._many_one(name, p[0], p[1], options)
+                if isinstance(p, tuple)
+                else self._many_one(name, p, target, options)
+                for p in paths]
+
+    def _escape(self, path):
+        return self._quote(path) if path else path
+
+    def _protocol_client(self):
+        return self.client
+
+    def _local_cwd(self):
+        return self._lcwd
+
+    def _remote_cwd(self):
+        return self._rcwd
+
+    def _stream_path(self, path):
+        return self._remote(path)
+
+    def _remote(self, path):
+        path = self._unquote(path)
+        if not path:
+            return self._rcwd
+        return posixpath.normpath(posixpath.join(self._rcwd, path))
+
+    def _local(self, path):
+        return os.path.normpath(os.path.join(self._lcwd,
+                                             os.path.expanduser(path)))
+
+    def _remote_glob(self, path, no_such_file):
+        path = self._remote(path)
+        directory, pattern = posixpath.split(path)
+        if not any(c in pattern for c in '*?['):
+            return [path]
+        names = [name for name, _, _ in self._call(
+            self.client.listdir, directory, no_such_file=no_such_file)]
+        matches = sorted(posixpath.join(directory, name) for name in names
+                         if fnmatch.fnmatchcase(name, pattern)
+                         and (pattern.startswith('.')
+                              or not name.startswith('.')))
+        if not matches:
+            raise no_such_file
+        return matches
+
+    def _local_target(self, target, name, many):
+        if target is None:
+            return os.path.join(self._lcwd, name)
+        if many or os.path.isdir(target):
+            return os.path.join(target, name)
+        return target
+
+    def _remote_target(self, target, name, many):
+        if target is None:
+            return posixpath.join(self._rcwd, name)
+        if many:
+            return posixpath.join(target, name)
+        try:
+            if self.client.stat(target).is_dir():
+                return posixpath.join(target, name)
+        except ExceptionPsftpStatus:
+            pass
+        return target
+
+    def _get_file(self, remote, local, attrs, options, progress):
+        offset = 0
+        if 'a' in options and os.path.exists(local):
+            offset = os.path.getsize(local)
+            if attrs.size is not None and offset >= attrs.size:
+                return
+        mode = 'r+b' if offset else 'wb'
+        umask = self._umask
+        if umask is not None:
+            umask = os.umask(umask)
+        try:
+            with open(local, mode) as f:
+                update = self._progress_meter(posixpath.basename(remote),
+                                              attrs.size or 0, offset,
+                                              progress)
+                copied = self._call(
+                    self.client.download, remote, f, offset,
+                    self.buffer_size, self.num_requests, update,
+                    no_such_file=psftp._exception_file_no_found)
+                update(copied, True)
+                if 'f' in options:
+                    f.flush()
+                    os.fsync(f.fileno())
+        finally:
+            if umask is not None:
+                os.umask(umask)
+        if ('p' in options or 'P' in options) and attrs.mtime is not None:
+            os.utime(local, (attrs.atime, attrs.mtime))
+            if attrs.mode is not None:
+                os.chmod(local, stat.S_IMODE(attrs.mode))
+
+    def _get_tree(self, remote, local, options, progress):
+        if not os.path.isdir(local):
+            os.mkdir(local)
+        for name, _, attrs in self._call(self.client.listdir, remote):
+            if name in ('.', '..'):
+                continue
+            source = posixpath.join(remote, name)
+            target = os.path.join(local, name)
+            if attrs.is_dir():
+                self._get_tree(source, target, options, progress)
+            elif attrs.is_file():
+                self._get_file(source, target, attrs, options, progress)
+
+    def _put_file(self, local, remote, options, progress):
+        st = os.stat(local)
+        offset = 0
+        if 'a' in options:
+            try:
+                offset = self.client.stat(remote).size or 0
+            except ExceptionPsftpStatus:
+                offset = 0
+            if offset >= st.st_size:
+                return
+        attrs = None
+        if 'p' in options or 'P' in options:
+            attrs = SFTPAttributes(mode=stat.S_IMODE(st.st_mode))
+        with open(local, 'rb') as f:
+            f.seek(offset)
+            update = self._progress_meter(os.path.basename(local),
+                                          st.st_size, offset, progress)
+            copied = self._call(self.client.upload, f, remote, offset,
+                                self.buffer_size, self.num_requests, attrs,
+                                update)
+            update(copied, True)
+        if 'p' in options or 'P' in options:
+            self._call(self.client.setstat, remote, SFTPAttributes(
+                atime=st.st_atime, mtime=st.st_mtime))
+
+    def _put_tree(self, local, remote, options, progress):
+        try:
+            self.client.mkdir(remote)
+        except ExceptionPsftpStatus:
+            if not self.client.stat(remote).is_dir():
+                raise psftp._exception_create_directory_failure
+        for name in sorted(os.listdir(local)):
+            source = os.path.join(local, name)
+            target = posixpath.join(remote, name)
+            if os.path.isdir(source) and not os.path.islink(source):
+                self._put_tree(source, target, options, progress)
+            elif os.path.isfile(source):
+                self._put_file(source, target, options, progress)
+
+    def _progress_meter(self, name, size, offset, progress):
+        # Report the transfer the way the sftp progress meter refreshes: at
+        # the start, about once a second and at the end.
+        started = time.time()
+        refreshed = [None]
+
+        def update(copied, done=False):
+            now = time.time()
+            if (not done and refreshed[0] is not None
+                    and now - refreshed[0] < 1):
+                return
+            refreshed[0] = now
+            elapsed = now - started
+            rate = copied / elapsed if elapsed > 0 else 0.0
+            position = offset + copied
+            if done or not size:
+                percent, eta = 100, 0
+            else:
+                percent = 100 * position // size
+                eta = int((size - position) / rate) if rate else None
+            self._progress_update(
+                PsftpProgress(name, percent, position, rate, eta,
+                              done=done), progress)
+        # A transfer that failed leaves its start time behind.
+        self._transfer_started = None
+        update(0)
+        return update
+
+    def _entry(self, name, longname, attrs):
+        entry = PsftpEntry.parse(longname) if longname else None
+        if entry is not None:
+            owner, group, nlink = entry.owner, entry.group, entry.nlink
+        else:
+            owner, group, nlink = str(attrs.uid), str(attrs.gid), None
+        return PsftpEntry(name, attrs.mode or 0, nlink, owner, group,
+                          attrs.size or 0, attrs.mtime or 0)
+
+    def _longname(self, name, longname, attrs):
+        if longname:
+            return longname
+        return '%s %s %s %s %d %s %s' % (
+            stat.filemode(attrs.mode or 0), '?', attrs.uid, attrs.gid,
+            attrs.size or 0,
+            time.strftime('%b %d %H:%M', time.localtime(attrs.mtime or 0)),
+            name)
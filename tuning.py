@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import posixpath
+import shutil
+import tempfile
+import time
+
+from pexpect import ExceptionPexpect
+
+from .psftp import psftp
+
+
+__all__ = ['autotune', 'cached_tuning']
+
+
+# Values tried for every setting, the first one is the sftp default.
+CANDIDATES = [
+    ('buffer_size', [None, 65536, 262144]),
+    ('num_requests', [None, 128, 256]),
+    ('compression', [False, True]),
+    ('cipher', [None, 'aes128-gcm@openssh.com',
+                'chacha20-poly1305@openssh.com']),
+]
+
+
+def _default_cache_file():
+    cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_dir, 'psftp', 'tuning.json')
+
+
+def _cache_key(server, username, port):
+    return '%s@%s:%d' % (username, server, int(port or 22))
+
+
+def _load_cache(cache_file):
+    try:
+        with open(cache_file) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _store_cache(cache_file, key, entry):
+    directory = os.path.dirname(cache_file)
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+    cache = _load_cache(cache_file)
+    cache[key] = entry
+    # Written aside and renamed, so that a concurrent reader never sees a
+    # partial file.
+    fd, path = tempfile.mkstemp(dir=directory, prefix='.tuning-')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+    os.rename(path, cache_file)
+
+
+def cached_tuning(server, username, port=None, cache_file=None,
+                  max_age=None):
+    '''The settings :func:`autotune` found for a host.
+
+    :max_age: seconds after which a result is ignored, None keeps it.
+
+    :return: dict of :meth:`psftp.login` keyword arguments, None if the host
+    was not tuned.
+    '''
+    cache = _load_cache(cache_file or _default_cache_file())
+    entry = cache.get(_cache_key(server, username, port))
+    if entry is None:
+        return None
+    if max_age is not None and time.time() - entry['time'] > max_age:
+        return None
+    return entry['tuning']
+
+
+def autotune(
+        server,
+        username,
+        password='',
+        port=None,
+        ssh_key=None,
+        remote_dir='.',
+        probe_size=8 << 20,
+        candidates=None,
+        cache_file=None,
+        max_age=7 * 86400,
+        **kwargs):
+    """Find the transfer settings of :meth:`psftp.login` that move data
+    fastest to and from a host. Every candidate logs in on its own and puts
+    and gets a probe file of probe_size bytes in remote_dir. The settings
+    are tried one after the other, each with the best values found so far
+    for the others, which takes far fewer probes than every combination.
+
+    The result is cached per user, host and port in cache_file, by default
+    ``~/.cache/psftp/tuning.json``, and reused while younger than max_age
+    seconds; max_age 0 always probes. Example::
+
+        tuning = psftp.autotune(hostname, username, password)
+        s = psftp.psftp()
+        s.login(hostname, username, password, **tuning)
+
+    :candidates: list of (setting, values) pairs, see :data:`CANDIDATES`.
+    Settings the host refuses, an unknown cipher for example, are skipped.
+    :kwargs: passed on to :class:`psftp`, options for example.
+
+    :return: dict of :meth:`psftp.login` keyword arguments.
+    """
+    cache_file = cache_file or _default_cache_file()
+    if max_age:
+        tuning = cached_tuning(server, username, port, cache_file, max_age)
+        if tuning is not None:
+            return tuning
+
+    workdir = tempfile.mkdtemp(prefix='psftp-autotune-')
+    try:
+        probe = os.path.join(workdir, 'probe')
+        with open(probe, 'wb') as f:
+            remaining = probe_size
+            while remaining > 0:
+                f.write(os.urandom(min(remaining, 1 << 20)))
+                remaining -= 1 << 20
+        remote = posixpath.join(remote_dir,
+                                '.psftp-autotune-%d' % os.getpid())
+
+        def rate(tuning):
+            s = psftp(**kwargs)
+            s.login(server, username, password, port=port, ssh_key=ssh_key,
+                    **tuning)
+            try:
+                start = time.time()
+                s.put(probe, remote)
+                s.get(remote, probe + '.get')
+                seconds = time.time() - start
+                s.rm(remote)
+                s.logout()
+            finally:
+                s.close()
+            return 2 * probe_size / max(seconds, 1e-6)
+
+        best = dict((name, values[0])
+                    for name, values in candidates or CANDIDATES)
+        best_rate = rate(best)
+        for name, values in candidates or CANDIDATES:
+            for value in values[1:]:
+                tuning = dict(best, **{name: value})
+                try:
+                    r = rate(tuning)
+                except ExceptionPexpect:
+                    continue
+                if r > best_rate:
+                    best, best_rate = tuning, r
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    _store_cache(cache_file, _cache_key(server, username, port), dict(
+        tuning=best, rate=best_rate, probe_size=probe_size, time=time.time()))
+    return best